@@ -1,11 +1,22 @@
 # admin/app.py
-from flask import Flask, request, jsonify, abort
+from flask import Flask, Response, request, jsonify, abort
 from flask_cors import CORS
 from functools import wraps
+from contextlib import contextmanager
+from datetime import datetime
+import atexit
+import base64
 import os
-import psycopg
+import time
+import redis
+from psycopg_pool import ConnectionPool, PoolTimeout
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 from dotenv import load_dotenv
 
+from cache import ResponseCache
+from export import buffered, copy_csv, json_array, ndjson, server_rows, started
+
 load_dotenv()
 
 app = Flask(__name__)
@@ -14,6 +25,71 @@ CORS(app)
 USER = os.getenv("ADMIN_BASIC_USER", "admin")
 PASS = os.getenv("ADMIN_BASIC_PASS", "changeme")
 DATABASE_URL = os.getenv("DATABASE_URL", "").replace("+asyncpg", "")
+# One pool per gunicorn worker process; size it to the worker's threads
+DB_POOL_MIN = int(os.getenv("ADMIN_DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("ADMIN_DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("ADMIN_DB_POOL_TIMEOUT", "5"))
+DB_POOL_MAX_IDLE = float(os.getenv("ADMIN_DB_POOL_MAX_IDLE", "300"))
+DB_POOL_MAX_LIFETIME = float(os.getenv("ADMIN_DB_POOL_MAX_LIFETIME", "3600"))
+MAX_PAGE_SIZE = int(os.getenv("ADMIN_MAX_PAGE_SIZE", "500"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+# Response cache lifetimes; the rollups behind stats/analytics are only
+# refreshed by the worker every ROLLUP_INTERVAL anyway
+CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "5"))
+STATS_CACHE_TTL = int(os.getenv("ADMIN_STATS_CACHE_TTL", "15"))
+
+# Connections are checked before being handed out, so one dropped by a
+# Postgres restart or an idle timeout is replaced instead of failing a request
+pool = ConnectionPool(
+    DATABASE_URL,
+    min_size=DB_POOL_MIN,
+    max_size=DB_POOL_MAX,
+    timeout=DB_POOL_TIMEOUT,
+    max_idle=DB_POOL_MAX_IDLE,
+    max_lifetime=DB_POOL_MAX_LIFETIME,
+    check=ConnectionPool.check_connection,
+    name="admin",
+    open=True
+)
+atexit.register(pool.close)
+
+POOL_WAIT = Histogram(
+    "admin_db_pool_wait_seconds",
+    "Time requests waited for a database connection",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+
+class PoolCollector:
+    """Exposes psycopg_pool's own counters at scrape time"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def collect(self):
+        stats = self.pool.get_stats()
+        for name, key, doc in (
+            ("admin_db_pool_size", "pool_size", "Connections open or being opened"),
+            ("admin_db_pool_available", "pool_available", "Idle connections in the pool"),
+            ("admin_db_pool_requests_waiting", "requests_waiting", "Requests queued for a connection"),
+        ):
+            yield GaugeMetricFamily(name, doc, value=stats.get(key, 0))
+        yield GaugeMetricFamily("admin_db_pool_max_size", "Configured pool maximum", value=self.pool.max_size)
+        for name, key, doc in (
+            ("admin_db_pool_requests", "requests_num", "Connections requested from the pool"),
+            ("admin_db_pool_requests_queued", "requests_queued", "Requests that had to wait for a connection"),
+            ("admin_db_pool_requests_errors", "requests_errors", "Requests that timed out waiting"),
+            ("admin_db_pool_connections_lost", "connections_lost", "Connections found broken by checks"),
+        ):
+            yield CounterMetricFamily(name, doc, value=stats.get(key, 0))
+
+
+REGISTRY.register(PoolCollector(pool))
+
+# Short socket timeouts: a slow Redis should fall through to Postgres
+cache = ResponseCache(
+    redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+)
 
 def check_auth(username, password):
     return username == USER and password == PASS
@@ -27,8 +103,64 @@ def requires_auth(f):
         return f(*args, **kwargs)
     return wrapped
 
+@contextmanager
 def get_db():
-    return psycopg.connect(DATABASE_URL)
+    """Borrow a pooled connection; committed and returned to the pool on exit"""
+    start = time.perf_counter()
+    with pool.connection() as conn:
+        POOL_WAIT.observe(time.perf_counter() - start)
+        yield conn
+
+@app.errorhandler(PoolTimeout)
+def pool_timeout(e):
+    app.logger.warning("Database pool exhausted: %s", e)
+    return jsonify({"error": "database busy, retry shortly"}), 503
+
+def encode_cursor(item):
+    raw = f"{item['created_at']}|{item['id']}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    """(created_at, id) of the last row of the previous page; 400 if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.split("|")
+        return datetime.fromisoformat(created_at), int(row_id)
+    except ValueError:
+        abort(400, "invalid cursor")
+
+def date_arg(name):
+    """Parse an ISO date or timestamp query argument; 400 if malformed"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, f"invalid {name}")
+
+def page_args():
+    """(limit, cursor position) for a keyset-paginated list endpoint"""
+    limit = max(1, min(request.args.get('limit', 50, type=int), MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor')
+    return limit, decode_cursor(cursor) if cursor else None
+
+def paginated(items, limit):
+    """
+    JSON list response for one page; X-Next-Cursor is set if there is more
+
+    Queries fetch limit + 1 rows: the extra one only tells whether
+    another page exists.
+    """
+    response = jsonify(items[:limit])
+    if len(items) > limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(items[limit - 1])
+        response.headers["Access-Control-Expose-Headers"] = "X-Next-Cursor"
+    return response
+
+@app.route("/metrics")
+def metrics():
+    return Response(generate_latest(REGISTRY), mimetype=CONTENT_TYPE_LATEST)
 
 @app.route("/health")
 def health():
@@ -36,52 +168,81 @@ def health():
 
 @app.route("/api/stats")
 @requires_auth
+@cache.cached(ttl=STATS_CACHE_TTL)
 def stats():
-    """Get system statistics"""
+    """Get system statistics; volume is per currency"""
     with get_db() as conn:
         with conn.cursor() as cur:
             # Total users
             cur.execute("SELECT COUNT(*) FROM users")
             total_users = cur.fetchone()[0]
-            
-            # Total transactions
-            cur.execute("SELECT COUNT(*) FROM transactions")
-            total_txs = cur.fetchone()[0]
-            
-            # Total volume
-            cur.execute("SELECT SUM(amount) FROM transactions WHERE status='completed'")
-            total_volume = cur.fetchone()[0] or 0
-            
-            # Pending transactions
-            cur.execute("SELECT COUNT(*) FROM transactions WHERE status='pending'")
-            pending_txs = cur.fetchone()[0]
-            
-            return jsonify({
-                "total_users": total_users,
-                "total_transactions": total_txs,
-                "total_volume": float(total_volume),
-                "pending_transactions": pending_txs
-            })
+
+            # Transaction counts and completed volume per currency, from
+            # the daily rollups the worker maintains
+            cur.execute("""
+                SELECT currency,
+                       SUM(tx_count)::bigint,
+                       SUM(tx_count) FILTER (WHERE status = 'pending')::bigint,
+                       SUM(amount_sum) FILTER (WHERE status = 'completed'),
+                       MAX(updated_at)
+                FROM transaction_daily_rollups
+                GROUP BY currency
+            """)
+            rows = cur.fetchall()
+
+    updated = [row[4] for row in rows if row[4]]
+    return jsonify({
+        "total_users": total_users,
+        "total_transactions": sum(row[1] for row in rows),
+        "total_volume": {row[0]: float(row[3] or 0) for row in rows},
+        "pending_transactions": sum(row[2] or 0 for row in rows),
+        "as_of": max(updated).isoformat() if updated else None
+    })
 
 @app.route("/api/transactions")
 @requires_auth
+@cache.cached(ttl=CACHE_TTL)
 def transactions():
-    """Get recent transactions"""
-    limit = request.args.get('limit', 50, type=int)
-    offset = request.args.get('offset', 0, type=int)
-    
+    """
+    Get transactions, newest first
+
+    Filters: status, type, currency, since, until (ISO dates, until is
+    exclusive). Pass the X-Next-Cursor response header back as `cursor`
+    for the next page.
+    """
+    limit, position = page_args()
+    where, params = [], []
+    for column in ("status", "type", "currency"):
+        value = request.args.get(column)
+        if value:
+            where.append(f"t.{column} = %s")
+            params.append(value.upper() if column == "currency" else value)
+    since, until = date_arg("since"), date_arg("until")
+    if since:
+        where.append("t.created_at >= %s")
+        params.append(since)
+    if until:
+        where.append("t.created_at < %s")
+        params.append(until)
+    if position:
+        where.append("(t.created_at, t.id) < (%s, %s)")
+        params.extend(position)
+
     with get_db() as conn:
         with conn.cursor() as cur:
-            cur.execute("""
-                SELECT t.id, t.type, t.amount, t.currency, t.status, 
+            # Served by the (created_at, id) index or its filter-prefixed
+            # variants, so a deep page costs the same as the first
+            cur.execute(f"""
+                SELECT t.id, t.type, t.amount, t.currency, t.status,
                        t.created_at, u.username, u.telegram_id
                 FROM transactions t
                 JOIN wallets w ON t.wallet_id = w.id
                 JOIN users u ON w.user_id = u.id
-                ORDER BY t.created_at DESC
-                LIMIT %s OFFSET %s
-            """, (limit, offset))
-            
+                {"WHERE " + " AND ".join(where) if where else ""}
+                ORDER BY t.created_at DESC, t.id DESC
+                LIMIT %s
+            """, (*params, limit + 1))
+
             rows = cur.fetchall()
             txs = []
             for row in rows:
@@ -95,27 +256,33 @@ def transactions():
                     "username": row[6],
                     "telegram_id": row[7]
                 })
-            
-            return jsonify(txs)
+
+            return paginated(txs, limit)
 
 @app.route("/api/users")
 @requires_auth
+@cache.cached(ttl=CACHE_TTL)
 def users():
-    """Get users list"""
-    limit = request.args.get('limit', 50, type=int)
-    offset = request.args.get('offset', 0, type=int)
-    
+    """Get users list, newest first; paginated like /api/transactions"""
+    limit, position = page_args()
+
     with get_db() as conn:
         with conn.cursor() as cur:
-            cur.execute("""
-                SELECT u.id, u.telegram_id, u.username, u.phone, 
-                       u.kyc_status, u.created_at,
-                       (SELECT SUM(balance) FROM wallets WHERE user_id = u.id) as total_balance
+            # The balance sum runs only for the page's rows, through the
+            # wallets user_id index
+            cur.execute(f"""
+                SELECT u.id, u.telegram_id, u.username, u.phone,
+                       u.kyc_status, u.created_at, b.total_balance
                 FROM users u
-                ORDER BY u.created_at DESC
-                LIMIT %s OFFSET %s
-            """, (limit, offset))
-            
+                LEFT JOIN LATERAL (
+                    SELECT SUM(w.balance) AS total_balance
+                    FROM wallets w WHERE w.user_id = u.id
+                ) b ON true
+                {"WHERE (u.created_at, u.id) < (%s, %s)" if position else ""}
+                ORDER BY u.created_at DESC, u.id DESC
+                LIMIT %s
+            """, (*(position or ()), limit + 1))
+
             rows = cur.fetchall()
             users_list = []
             for row in rows:
@@ -128,63 +295,111 @@ def users():
                     "created_at": row[5].isoformat(),
                     "total_balance": float(row[6] or 0)
                 })
-            
-            return jsonify(users_list)
+
+            return paginated(users_list, limit)
 
 @app.route("/api/wallets")
 @requires_auth
 def wallets():
-    """Get wallets list"""
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT w.id, w.currency, w.balance, w.reserved, 
-                       u.username, u.telegram_id
-                FROM wallets w
-                JOIN users u ON w.user_id = u.id
-                ORDER BY w.balance DESC
-            """)
-            
-            rows = cur.fetchall()
-            wallets_list = []
-            for row in rows:
-                wallets_list.append({
-                    "id": row[0],
-                    "currency": row[1],
-                    "balance": float(row[2]),
-                    "reserved": float(row[3]),
-                    "username": row[4],
-                    "telegram_id": row[5]
-                })
-            
-            return jsonify(wallets_list)
+    """Get wallets list, streamed from a server-side cursor"""
+    rows = server_rows(get_db, """
+        SELECT w.id, w.currency, w.balance, w.reserved,
+               u.username, u.telegram_id
+        FROM wallets w
+        JOIN users u ON w.user_id = u.id
+        ORDER BY w.balance DESC
+    """)
+    wallets_list = (
+        {
+            "id": row["id"],
+            "currency": row["currency"],
+            "balance": float(row["balance"]),
+            "reserved": float(row["reserved"]),
+            "username": row["username"],
+            "telegram_id": row["telegram_id"]
+        }
+        for row in rows
+    )
+    return Response(started(buffered(json_array(wallets_list))), mimetype="application/json")
+
+EXPORTS = {
+    "transactions": """
+        SELECT t.id, t.created_at, t.updated_at, t.type, t.status, t.amount,
+               t.currency, t.wallet_id, w.user_id, u.telegram_id, t.external_ref
+        FROM transactions t
+        JOIN wallets w ON t.wallet_id = w.id
+        JOIN users u ON w.user_id = u.id
+        WHERE t.created_at >= %s AND t.created_at < %s
+        ORDER BY t.created_at, t.id
+    """,
+    "wallets": """
+        SELECT w.id, w.user_id, u.telegram_id, u.username, w.currency,
+               w.balance, w.reserved, w.created_at, w.updated_at
+        FROM wallets w
+        JOIN users u ON w.user_id = u.id
+        WHERE w.created_at >= %s AND w.created_at < %s
+        ORDER BY w.id
+    """,
+}
+
+@app.route("/api/export/<kind>")
+@requires_auth
+def export(kind):
+    """
+    Stream all transactions or wallets as CSV or NDJSON
+
+    Query args: format (csv or ndjson), since/until (ISO dates on
+    created_at, until exclusive), gzip=1 for a .gz download. Amounts are
+    exact decimal strings.
+    """
+    if kind not in EXPORTS:
+        abort(404)
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "ndjson"):
+        abort(400, "format must be csv or ndjson")
+    since = date_arg("since") or datetime.min
+    until = date_arg("until") or datetime.max
+    gzip = request.args.get("gzip", "0").lower() in ("1", "true", "yes")
+
+    if fmt == "csv":
+        chunks = copy_csv(get_db, EXPORTS[kind], (since, until))
+        mimetype = "text/csv"
+    else:
+        chunks = ndjson(server_rows(get_db, EXPORTS[kind], (since, until)))
+        mimetype = "application/x-ndjson"
+    filename = f"{kind}.{fmt}"
+    if gzip:
+        filename += ".gz"
+        mimetype = "application/gzip"
+
+    response = Response(started(buffered(chunks, gzip=gzip)), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
 
 @app.route("/api/analytics/daily")
 @requires_auth
+@cache.cached(ttl=STATS_CACHE_TTL)
 def daily_analytics():
-    """Get daily transaction analytics"""
+    """Get daily transaction analytics (UTC days); volume is per currency"""
     with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute("""
-                SELECT DATE(created_at) as date,
-                       COUNT(*) as count,
-                       SUM(CASE WHEN status='completed' THEN amount ELSE 0 END) as volume
-                FROM transactions
-                WHERE created_at >= NOW() - INTERVAL '30 days'
-                GROUP BY DATE(created_at)
-                ORDER BY date DESC
+                SELECT day, currency,
+                       SUM(tx_count)::bigint,
+                       SUM(amount_sum) FILTER (WHERE status = 'completed')
+                FROM transaction_daily_rollups
+                WHERE day >= (now() AT TIME ZONE 'UTC')::date - 30
+                GROUP BY day, currency
+                ORDER BY day DESC
             """)
-            
             rows = cur.fetchall()
-            analytics = []
-            for row in rows:
-                analytics.append({
-                    "date": row[0].isoformat(),
-                    "count": row[1],
-                    "volume": float(row[2])
-                })
-            
-            return jsonify(analytics)
+
+    analytics = {}
+    for day, currency, count, volume in rows:
+        entry = analytics.setdefault(day, {"date": day.isoformat(), "count": 0, "volume": {}})
+        entry["count"] += count
+        entry["volume"][currency] = float(volume or 0)
+    return jsonify(list(analytics.values()))
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=False)
@@ -0,0 +1,126 @@
+# admin/cache.py
+import hashlib
+import json
+import logging
+import time
+import uuid
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import Response, make_response, request
+from prometheus_client import Counter
+from redis.exceptions import RedisError
+
+logger = logging.getLogger("mahavaba_admin")
+
+# Response headers worth replaying from the cache
+CACHED_HEADERS = ("X-Next-Cursor", "Access-Control-Expose-Headers")
+
+# Delete a fill lock only if it is still held by ARGV[1]
+UNLOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+CACHE_REQUESTS = Counter(
+    "admin_cache_requests_total",
+    "Cached endpoint requests by outcome (hit, wait, miss, error)",
+    ["endpoint", "result"],
+)
+
+
+class ResponseCache:
+    """
+    Redis read-through cache for JSON GET endpoints
+
+    Entries are keyed by path and sorted query string and shared by every
+    admin process. On a miss one request takes a short fill lock and runs
+    the query; identical requests arriving meanwhile poll for its result
+    instead of querying too, and fall back to querying themselves only if
+    the fill outlives `lock_ttl`. Responses carry a content ETag, so
+    pollers sending If-None-Match get a 304 while nothing changed.
+    If Redis is unavailable, requests go straight to the database.
+    """
+
+    def __init__(self, redis, prefix="admin:cache", lock_ttl=10, poll_interval=0.05):
+        self.redis = redis
+        self.prefix = prefix
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self.unlock = redis.register_script(UNLOCK_LUA)
+
+    def cached(self, ttl):
+        """Decorate a view whose 200 responses may be served for `ttl` seconds"""
+        def decorator(f):
+            @wraps(f)
+            def wrapped(*args, **kwargs):
+                endpoint = request.endpoint
+                key = f"{self.prefix}:{request.path}?{urlencode(sorted(request.args.items(multi=True)))}"
+                try:
+                    entry, token, result = self._lookup(key)
+                except RedisError as e:
+                    logger.warning("Response cache unavailable: %s", e)
+                    CACHE_REQUESTS.labels(endpoint, "error").inc()
+                    return f(*args, **kwargs)
+                CACHE_REQUESTS.labels(endpoint, result).inc()
+                if entry is not None:
+                    return self._respond(entry)
+
+                try:
+                    response = make_response(f(*args, **kwargs))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    entry = self._entry(response)
+                    try:
+                        self.redis.set(key, json.dumps(entry), ex=ttl)
+                    except RedisError as e:
+                        logger.warning("Response cache unavailable: %s", e)
+                finally:
+                    if token:
+                        try:
+                            self.unlock(keys=[f"{key}:lock"], args=[token])
+                        except RedisError:
+                            pass  # expires with lock_ttl
+                return self._respond(entry)
+            return wrapped
+        return decorator
+
+    def _lookup(self, key):
+        """
+        (entry, None, "hit"|"wait") if cached, (None, token, "miss") if this
+        request should fill the entry, (None, None, "miss") if the fill
+        lock timed out
+        """
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_ttl
+        result = "hit"
+        while True:
+            raw = self.redis.get(key)
+            if raw is not None:
+                return json.loads(raw), None, result
+            if self.redis.set(f"{key}:lock", token, nx=True, px=int(self.lock_ttl * 1000)):
+                return None, token, "miss"
+            if time.monotonic() >= deadline:
+                return None, None, "miss"
+            result = "wait"
+            time.sleep(self.poll_interval)
+
+    @staticmethod
+    def _entry(response):
+        body = response.get_data()
+        return {
+            "body": body.decode(),
+            "mimetype": response.mimetype,
+            "etag": hashlib.sha1(body).hexdigest(),
+            "headers": {h: response.headers[h] for h in CACHED_HEADERS if h in response.headers},
+        }
+
+    @staticmethod
+    def _respond(entry):
+        response = Response(entry["body"], mimetype=entry["mimetype"], headers=entry["headers"])
+        response.set_etag(entry["etag"])
+        # Clients may keep the body but must revalidate (cheap 304s)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response.make_conditional(request)
@@ -0,0 +1,94 @@
+# admin/export.py
+"""
+Constant-memory streaming of query results to HTTP responses
+
+Rows come from Postgres in batches (COPY TO STDOUT for CSV, a server-side
+cursor otherwise) and are written out as they arrive, so a response of
+millions of rows never sits in memory.
+"""
+import json
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+
+from psycopg.rows import dict_row
+
+CHUNK_SIZE = 64 * 1024
+FETCH_SIZE = 2000
+
+
+def _json_default(value):
+    # Decimals as strings: amounts keep all 8 places
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def copy_csv(get_db, query, params=()):
+    """Yield `query` as CSV with a header row, straight from COPY TO STDOUT"""
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            with cur.copy(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", params) as copy:
+                for data in copy:
+                    yield bytes(data)
+
+
+def server_rows(get_db, query, params=()):
+    """Yield `query` rows as dicts, FETCH_SIZE at a time from a server-side cursor"""
+    with get_db() as conn:
+        with conn.cursor(name="admin_stream", row_factory=dict_row) as cur:
+            cur.itersize = FETCH_SIZE
+            cur.execute(query, params)
+            yield from cur
+
+
+def ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, default=_json_default).encode() + b"\n"
+
+
+def json_array(items):
+    """Encode an iterable of dicts as one JSON array, element by element"""
+    yield b"["
+    for i, item in enumerate(items):
+        yield (b"," if i else b"") + json.dumps(item, default=_json_default).encode()
+    yield b"]"
+
+
+def buffered(chunks, gzip=False):
+    """Coalesce small chunks into CHUNK_SIZE writes, gzip-compressed if asked"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        if len(buf) >= CHUNK_SIZE:
+            out = compressor.compress(bytes(buf)) if compressor else bytes(buf)
+            buf.clear()
+            if out:
+                yield out
+    tail = compressor.compress(bytes(buf)) + compressor.flush() if compressor else bytes(buf)
+    if tail:
+        yield tail
+
+
+def started(chunks):
+    """
+    Run a chunk generator up to its first chunk before the response starts
+
+    Connection and query errors then raise inside the view and get a
+    normal error response, instead of cutting off a 200 half-way.
+    """
+    first = next(chunks, None)
+
+    def stream():
+        try:
+            if first is not None:
+                yield first
+            yield from chunks
+        finally:
+            # Returns the connection to the pool if the client goes away
+            chunks.close()
+
+    return stream()
@@ -0,0 +1,14 @@
+# admin/gunicorn.conf.py
+import os
+
+bind = f"0.0.0.0:{os.getenv('ADMIN_PORT', '8000')}"
+# Threaded workers: requests mostly wait on Postgres, so one process serves
+# many concurrently. Each process has its own pool and /metrics registry;
+# scale with threads (and ADMIN_DB_POOL_MAX) before adding processes.
+worker_class = "gthread"
+workers = int(os.getenv("ADMIN_WORKERS", "1"))
+threads = int(os.getenv("ADMIN_THREADS", "8"))
+timeout = int(os.getenv("ADMIN_REQUEST_TIMEOUT", "60"))
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
@@ -1,23 +1,60 @@
 # bot/app.py
 import os
+import sys
 import logging
 import asyncio
+import hashlib
+import signal
+import uuid
 from decimal import Decimal
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.types import Message
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 import json
 from dotenv import load_dotenv
-import aioredis
+from redis import asyncio as aioredis
 from datetime import datetime
 
+# ledger/ sits at the repository root (copied next to this file in the image)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ledger import AtomicLedger, BalanceNotLoaded, InsufficientFunds
+from cache import TTLCache
+from throttling import ThrottlingMiddleware
+
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# redis: balances are read from the worker's AtomicLedger before Postgres
+LEDGER_MODE = os.getenv("LEDGER_MODE", "postgres")
+# polling: one replica, for local development; webhook: any number of
+# replicas behind a load balancer
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+# Token buckets: rate is tokens per second, burst the bucket size
+THROTTLE_USER_RATE = float(os.getenv("THROTTLE_USER_RATE", "1"))
+THROTTLE_USER_BURST = float(os.getenv("THROTTLE_USER_BURST", "5"))
+THROTTLE_PAYMENT_RATE = float(os.getenv("THROTTLE_PAYMENT_RATE", "0.2"))
+THROTTLE_PAYMENT_BURST = float(os.getenv("THROTTLE_PAYMENT_BURST", "3"))
+THROTTLE_GLOBAL_RATE = float(os.getenv("THROTTLE_GLOBAL_RATE", "200"))
+THROTTLE_GLOBAL_BURST = float(os.getenv("THROTTLE_GLOBAL_BURST", "400"))
+# Redis remembers request keys this long; the database index is permanent
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+# Identical payment commands from one user this close together are double taps
+DOUBLE_TAP_WINDOW = int(os.getenv("DOUBLE_TAP_WINDOW", "10"))
+BOT_CACHE_SIZE = int(os.getenv("BOT_CACHE_SIZE", "100000"))
+BOT_CACHE_TTL = float(os.getenv("BOT_CACHE_TTL", "3600"))
 
 # logging
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
@@ -64,57 +101,275 @@ transactions = sa.Table(
     sa.Column("status", sa.String, nullable=False, server_default="pending"),
     sa.Column("external_ref", sa.String),
     sa.Column("metadata", sa.JSON),
+    sa.Column("idempotency_key", sa.String, unique=True),
     sa.Column("created_at", sa.TIMESTAMP(timezone=True), server_default=sa.text("now()")),
     sa.Column("updated_at", sa.TIMESTAMP(timezone=True), server_default=sa.text("now()"))
 )
 
 # Redis queue
 redis = None
+ledger = None
+
+# Ids never change once created, so lookups are cached per process
+user_ids = TTLCache(BOT_CACHE_SIZE, BOT_CACHE_TTL)    # telegram_id -> users.id
+wallet_ids = TTLCache(BOT_CACHE_SIZE, BOT_CACHE_TTL)  # (users.id, currency) -> wallets.id
 
 # Telegram bot
 bot = Bot(token=TELEGRAM_TOKEN)
 dp = Dispatcher()
 
 # UTIL: DB helper
+# Upserts: one round trip each, and concurrent callers (a /start storm)
+# converge on the same row instead of racing on the unique constraint.
+# DO UPDATE (rather than DO NOTHING) makes RETURNING yield existing rows.
+def upsert_user_stmt(telegram_id:int, username:str=None, phone:str=None):
+    ins = pg_insert(users).values(telegram_id=telegram_id, username=username, phone=phone)
+    return ins.on_conflict_do_update(
+        index_elements=[users.c.telegram_id],
+        set_={
+            # Keep the Telegram username current for /send lookups
+            "username": sa.func.coalesce(ins.excluded.username, users.c.username),
+            "phone": sa.func.coalesce(ins.excluded.phone, users.c.phone)
+        }
+    ).returning(*users.c)
+
+def upsert_wallet_stmt(user_id:int, currency:str='ETB'):
+    ins = pg_insert(wallets).values(user_id=user_id, currency=currency, balance=0)
+    return ins.on_conflict_do_update(
+        index_elements=[wallets.c.user_id, wallets.c.currency],
+        set_={"currency": ins.excluded.currency}
+    ).returning(*wallets.c)
+
 async def get_or_create_user(telegram_id:int, username:str=None, phone:str=None, db:AsyncSession=None):
-    q = sa.select(users).where(users.c.telegram_id==telegram_id).limit(1)
-    r = await db.execute(q)
-    row = r.first()
-    if row:
-        return row._mapping
-    ins = users.insert().values(telegram_id=telegram_id, username=username, phone=phone)
-    res = await db.execute(ins)
+    r = await db.execute(upsert_user_stmt(telegram_id, username, phone))
+    user = r.one()._mapping
     await db.commit()
-    uid = res.inserted_primary_key[0]
-    q2 = sa.select(users).where(users.c.id==uid)
-    r2 = await db.execute(q2)
-    return r2.first()._mapping
+    user_ids.set(telegram_id, user['id'])
+    return user
 
 # UTIL: create/get wallet (currency default 'ETB')
 async def get_or_create_wallet(user_id:int, currency:str='ETB', db:AsyncSession=None):
-    q = sa.select(wallets).where(sa.and_(wallets.c.user_id==user_id, wallets.c.currency==currency)).limit(1)
-    r = await db.execute(q)
-    row = r.first()
-    if row:
-        return row._mapping
-    ins = wallets.insert().values(user_id=user_id, currency=currency, balance=0)
+    r = await db.execute(upsert_wallet_stmt(user_id, currency))
+    wallet = r.one()._mapping
+    await db.commit()
+    wallet_ids.set((user_id, currency), wallet['id'])
+    return wallet
+
+# UTIL: onboarding - user and default wallet in a single transaction
+async def onboard_user(telegram_id:int, username:str=None, phone:str=None, currency:str='ETB', db:AsyncSession=None):
+    r = await db.execute(upsert_user_stmt(telegram_id, username, phone))
+    user = r.one()._mapping
+    r = await db.execute(upsert_wallet_stmt(user['id'], currency))
+    wallet = r.one()._mapping
+    await db.commit()
+    user_ids.set(telegram_id, user['id'])
+    wallet_ids.set((user['id'], currency), wallet['id'])
+    return user, wallet
+
+async def wallet_balance(user_id:int, wallet):
+    """Available balance of a wallet row, from Redis first in redis mode
+
+    Postgres only lags the ledger, so a wallet Redis doesn't hold yet is
+    seeded from its row.
+    """
+    if ledger is None:
+        return Decimal(wallet['balance'])
+    return await ledger.seed_balance(user_id, wallet['currency'], wallet['balance'], wallet['reserved'])
+
+# UTIL: cached id lookups; misses fall through to the DB and fill the cache
+async def get_user_id(telegram_id:int, db:AsyncSession=None):
+    """users.id for a Telegram user, or None if they never used /start"""
+    uid = user_ids.get(telegram_id)
+    if uid is None:
+        r = await db.execute(sa.select(users.c.id).where(users.c.telegram_id==telegram_id).limit(1))
+        uid = r.scalar_one_or_none()
+        if uid is not None:
+            user_ids.set(telegram_id, uid)
+    return uid
+
+async def get_wallet_id(user_id:int, currency:str='ETB', db:AsyncSession=None):
+    """wallets.id for (user, currency), creating the wallet if missing"""
+    wid = wallet_ids.get((user_id, currency))
+    if wid is None:
+        wid = (await get_or_create_wallet(user_id, currency, db=db))['id']
+    return wid
+
+# UTIL: internal transfer between two wallets of the same currency
+async def transfer_funds(sender:dict, recipient:dict, amount:Decimal, db:AsyncSession=None):
+    """
+    Move `amount` from one wallet to another, posting a signed transfer
+    row on each side (both share external_ref `transfer:<uuid>`)
+
+    Postgres mode debits, credits and posts both rows in one transaction.
+    The two wallet rows are locked in id order first, so concurrent
+    transfers between the same wallets (in either direction) queue
+    instead of deadlocking. Redis mode records the pair as pending, moves
+    the balances with ledger.transfer() under the same ref and then
+    completes the rows. If the ledger call fails any other way, the ref
+    is voided to learn whether the debit ran and the rows are settled to
+    match; rows still pending after that are settled by the reconciler.
+    Returns the ref, or None if the sender lacks funds.
+    """
+    ref = f"transfer:{uuid.uuid4()}"
+    legs = [
+        dict(wallet_id=sender['id'], amount=-amount, metadata={"to_wallet_id": recipient['id']}),
+        dict(wallet_id=recipient['id'], amount=amount, metadata={"from_wallet_id": sender['id']})
+    ]
+    
+    if ledger is not None:
+        await db.execute(transactions.insert(), [
+            dict(leg, type="transfer", currency=sender['currency'], status="pending", external_ref=ref)
+            for leg in legs
+        ])
+        await db.commit()
+        try:
+            await ledger_transfer(sender, recipient, amount, ref)
+            status = "completed"
+        except InsufficientFunds:
+            status = "failed"
+        except Exception as e:
+            logger.exception("Ledger transfer %s failed: %s", ref, e)
+            voided = await ledger.void_transfer(sender['user_id'], recipient['user_id'], ref)
+            status = "failed" if voided else "completed"
+        await db.execute(
+            transactions.update().where(
+                transactions.c.external_ref==ref,
+                transactions.c.status=="pending"
+            ).values(status=status)
+        )
+        await db.commit()
+        return ref if status == "completed" else None
+    
+    await db.execute(
+        sa.select(wallets.c.id).where(wallets.c.id.in_([sender['id'], recipient['id']]))
+        .order_by(wallets.c.id).with_for_update()
+    )
+    debit = await db.execute(
+        wallets.update().where(
+            wallets.c.id==sender['id'],
+            wallets.c.balance >= amount
+        ).values(balance=wallets.c.balance - amount)
+    )
+    if debit.rowcount != 1:
+        await db.rollback()
+        return None
+    await db.execute(
+        wallets.update().where(wallets.c.id==recipient['id']).values(balance=wallets.c.balance + amount)
+    )
+    await db.execute(transactions.insert(), [
+        dict(leg, type="transfer", currency=sender['currency'], status="completed", external_ref=ref)
+        for leg in legs
+    ])
+    await db.commit()
+    return ref
+
+async def ledger_transfer(sender:dict, recipient:dict, amount:Decimal, ref:str):
+    """ledger.transfer(), seeding either side from its wallet row if needed"""
+    for _ in range(2):
+        try:
+            return await ledger.transfer(sender['user_id'], recipient['user_id'], sender['currency'], amount, ref=ref)
+        except BalanceNotLoaded as e:
+            w = sender if e.user_id == sender['user_id'] else recipient
+            await ledger.seed_balance(w['user_id'], w['currency'], w['balance'], w['reserved'])
+    return await ledger.transfer(sender['user_id'], recipient['user_id'], sender['currency'], amount, ref=ref)
+
+# UTIL: idempotency for payment commands
+def request_key(message:Message, action:str, *args):
+    """(idempotency key, double-tap fingerprint) of a payment command"""
+    key = f"{action}:{message.chat.id}:{message.message_id}"
+    fingerprint = hashlib.sha256(
+        ":".join(map(str, (message.from_user.id, action, *args))).encode()
+    ).hexdigest()
+    return key, fingerprint
+
+async def claim_request(message:Message, action:str, *args):
+    """
+    Idempotency key for a payment command, or None if it's a duplicate
+
+    The key comes from the Telegram message, so a redelivered update maps
+    to the same key; the fingerprint of (user, action, arguments) catches
+    a double tap, which arrives as a second message. Both are claimed
+    with SET NX as a fast path. The unique index on
+    transactions.idempotency_key remains the guarantee, so if Redis is
+    down the key is still returned. A command that ends without recording
+    its transaction must release_request() the claim, or its retry would
+    be taken for a duplicate.
+    """
+    key, fingerprint = request_key(message, action, *args)
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.set(f"idem:{key}", 1, nx=True, ex=IDEMPOTENCY_TTL)
+            pipe.set(f"idem:fp:{fingerprint}", 1, nx=True, ex=DOUBLE_TAP_WINDOW)
+            new_key, new_tap = await pipe.execute()
+    except Exception as e:
+        logger.warning("Idempotency fast path unavailable: %s", e)
+        return key
+    return key if new_key and new_tap else None
+
+async def release_request(message:Message, action:str, *args):
+    """Drop a claim_request() claim whose transaction was never recorded"""
+    key, fingerprint = request_key(message, action, *args)
+    try:
+        await redis.delete(f"idem:{key}", f"idem:fp:{fingerprint}")
+    except Exception as e:
+        # Both expire; until then a retry is answered as a duplicate
+        logger.warning("Could not release request %s: %s", key, e)
+
+async def insert_request_tx(db:AsyncSession, **values):
+    """Insert a payment transaction unless its idempotency key exists; returns its id or None"""
+    ins = pg_insert(transactions).values(**values).on_conflict_do_nothing(
+        index_elements=[transactions.c.idempotency_key]
+    ).returning(transactions.c.id)
     res = await db.execute(ins)
     await db.commit()
-    wid = res.inserted_primary_key[0]
-    q2 = sa.select(wallets).where(wallets.c.id==wid)
-    r2 = await db.execute(q2)
-    return r2.first()._mapping
+    return res.scalar_one_or_none()
+
+async def pending_request_tx(db:AsyncSession, key:str):
+    """Id of the transaction recorded under `key` if the worker hasn't picked it up yet"""
+    r = await db.execute(
+        sa.select(transactions.c.id).where(
+            transactions.c.idempotency_key==key,
+            transactions.c.status=="pending"
+        )
+    )
+    return r.scalar_one_or_none()
 
 # Placeholder: enqueue a payment request in redis for async worker
 async def enqueue_payment_request(payload:dict):
     await redis.lpush("payments:queue", json.dumps(payload))
 
+def request_payload(tx_id:int, key:str, uid:int, amount:Decimal, currency:str, phone:str=None):
+    """Worker job for a deposit or withdrawal transaction"""
+    return {
+        "tx_id": tx_id, 
+        "user_id": uid, 
+        "amount": str(amount), 
+        "currency": currency, 
+        "phone": phone, 
+        "provider":"mpesa",
+        "idempotency_key": key
+    }
+
+async def requeue_request(db:AsyncSession, key:str, uid:int, amount:Decimal, currency:str, phone:str=None):
+    """
+    Enqueue a request recorded earlier again if it is still pending
+
+    Its first enqueue may have failed after the insert committed, and
+    then nothing else would ever pick it up. A job the worker already has
+    is harmless to repeat: duplicates of a tx wait for its lease and are
+    skipped once it is settled.
+    """
+    tx_id = await pending_request_tx(db, key)
+    if tx_id is not None:
+        await enqueue_payment_request(request_payload(tx_id, key, uid, amount, currency, phone))
+
 # Command handlers
 @dp.message(Command(commands=["start"]))
 async def cmd_start(message: Message):
-    async with AsyncSessionLocal() as db:
-        user = await get_or_create_user(message.from_user.id, message.from_user.username, None, db=db)
-        await get_or_create_wallet(user['id'], "ETB", db=db)
+    uid = user_ids.get(message.from_user.id)
+    if uid is None or wallet_ids.get((uid, "ETB")) is None:
+        async with AsyncSessionLocal() as db:
+            await onboard_user(message.from_user.id, message.from_user.username, None, "ETB", db=db)
     
     welcome_text = """
 🎉 እንኳን ደህና መጡ MahavabaPay Bot!
@@ -124,6 +379,7 @@ async def cmd_start(message: Message):
 💰 /balance - የሂሳብ ቀሪ ሂሳብ ይመልከቱ
 📥 /deposit - ገንዘብ ያስገቡ
 📤 /withdraw - ገንዘብ ያውጡ
+💸 /send - ገንዘብ ይላኩ
 💱 /trade - ክሪፕቶ ይገበያዩ
 📊 /history - የግብይት ታሪክ
 ℹ️ /help - እገዛ
@@ -148,6 +404,9 @@ async def cmd_help(message: Message):
 📤 /withdraw <መጠን> <ገንዘብ> <ስልክ>
    ምሳሌ: /withdraw 50 ETB +251912345678
 
+💸 /send <መጠን> <ገንዘብ> <@ተጠቃሚ>
+   ምሳሌ: /send 100 ETB @abebe
+
 💱 /trade <BUY/SELL> <ምልክት> <መጠን>
    ምሳሌ: /trade BUY BTC 0.001
 
@@ -175,14 +434,11 @@ async def cmd_help(message: Message):
 @dp.message(Command(commands=["balance"]))
 async def cmd_balance(message: Message):
     async with AsyncSessionLocal() as db:
-        q = sa.select(users).where(users.c.telegram_id==message.from_user.id).limit(1)
-        r = await db.execute(q)
-        row = r.first()
-        if not row:
+        uid = await get_user_id(message.from_user.id, db=db)
+        if uid is None:
             await message.reply("እባክዎን /start ይጠቀሙ ለመጀመር.")
             return
-        user = row._mapping
-        q2 = sa.select(wallets).where(wallets.c.user_id==user['id'])
+        q2 = sa.select(wallets).where(wallets.c.user_id==uid)
         rr = await db.execute(q2)
         rows = rr.fetchall()
         if not rows:
@@ -191,7 +447,7 @@ async def cmd_balance(message: Message):
         text = "💰 የእርስዎ ሀብት:\n\n"
         for w in rows:
             wallet = w._mapping
-            text += f"• {wallet['currency']}: {wallet['balance']}\n"
+            text += f"• {wallet['currency']}: {await wallet_balance(uid, wallet)}\n"
         await message.reply(text)
 
 @dp.message(Command(commands=["deposit"]))
@@ -216,41 +472,44 @@ async def cmd_deposit(message: Message):
         await message.reply("❌ ያልተደገፈ ገንዘብ። የሚደገፉ: ETB, USD, USDT, BTC, ETH")
         return
     
-    async with AsyncSessionLocal() as db:
-        q = sa.select(users).where(users.c.telegram_id==message.from_user.id).limit(1)
-        r = await db.execute(q)
-        user_row = r.first()
-        if not user_row:
-            await message.reply("እባክዎን /start ይጠቀሙ.")
-            return
-        user = user_row._mapping
-        w = await get_or_create_wallet(user['id'], currency, db=db)
-        
-        # create transaction (pending)
-        ins = transactions.insert().values(
-            wallet_id=w['id'], 
-            type="deposit", 
-            amount=amount, 
-            currency=currency, 
-            status="pending", 
-            metadata={"via":"mpesa","phone":phone}
-        )
-        res = await db.execute(ins)
-        await db.commit()
-        tx_id = res.inserted_primary_key[0]
-        
-        # enqueue provider call
-        payload = {
-            "tx_id": tx_id, 
-            "user_id": user['id'], 
-            "amount": str(amount), 
-            "currency": currency, 
-            "phone": phone, 
-            "provider":"mpesa"
-        }
-        await enqueue_payment_request(payload)
-        
-        await message.reply(f"✅ የተጠየቀ ድምር ተመዝግቧል (tx={tx_id}).\n\n⏳ እባክዎን ሲስተሙ ይታወቃል።")
+    claim = ("deposit", amount, currency, phone)
+    key = await claim_request(message, *claim)
+    if key is None:
+        await message.reply("ℹ️ ይህ ጥያቄ አስቀድሞ ተመዝግቧል።")
+        return
+    
+    try:
+        async with AsyncSessionLocal() as db:
+            uid = await get_user_id(message.from_user.id, db=db)
+            if uid is None:
+                await release_request(message, *claim)
+                await message.reply("እባክዎን /start ይጠቀሙ.")
+                return
+            wallet_id = await get_wallet_id(uid, currency, db=db)
+            
+            # create transaction (pending), once per request
+            tx_id = await insert_request_tx(
+                db,
+                wallet_id=wallet_id, 
+                type="deposit", 
+                amount=amount, 
+                currency=currency, 
+                status="pending", 
+                metadata={"via":"mpesa","phone":phone},
+                idempotency_key=key
+            )
+            if tx_id is None:
+                await requeue_request(db, key, uid, amount, currency, phone)
+                await message.reply("ℹ️ ይህ ጥያቄ አስቀድሞ ተመዝግቧል።")
+                return
+            
+            # enqueue provider call
+            await enqueue_payment_request(request_payload(tx_id, key, uid, amount, currency, phone))
+    except Exception:
+        await release_request(message, *claim)
+        raise
+    
+    await message.reply(f"✅ የተጠየቀ ድምር ተመዝግቧል (tx={tx_id}).\n\n⏳ እባክዎን ሲስተሙ ይታወቃል።")
 
 @dp.message(Command(commands=["withdraw"]))
 async def cmd_withdraw(message: Message):
@@ -270,47 +529,102 @@ async def cmd_withdraw(message: Message):
     currency = parts[2]
     phone = parts[3] if len(parts) > 3 else None
     
+    claim = ("withdraw", amount, currency, phone)
+    key = await claim_request(message, *claim)
+    if key is None:
+        await message.reply("ℹ️ ይህ ጥያቄ አስቀድሞ ተመዝግቧል።")
+        return
+    
+    try:
+        async with AsyncSessionLocal() as db:
+            uid = await get_user_id(message.from_user.id, db=db)
+            if uid is None:
+                await release_request(message, *claim)
+                await message.reply("እባክዎን /start ይጠቀሙ.")
+                return
+            
+            q2 = sa.select(wallets).where(sa.and_(wallets.c.user_id==uid, wallets.c.currency==currency)).limit(1)
+            r2 = await db.execute(q2)
+            wrow = r2.first()
+            if not wrow or await wallet_balance(uid, wrow._mapping) < amount:
+                await release_request(message, *claim)
+                await message.reply("❌ እባክዎን የተያዙ ዋሌት ወይም በሂሳብ ያለው ብቃት አልባ.")
+                return
+            w = wrow._mapping
+            
+            # mark transaction pending, once per request
+            tx_id = await insert_request_tx(
+                db,
+                wallet_id=w['id'], 
+                type="withdraw", 
+                amount=amount, 
+                currency=currency, 
+                status="pending", 
+                metadata={"phone":phone},
+                idempotency_key=key
+            )
+            if tx_id is None:
+                await requeue_request(db, key, uid, amount, currency, phone)
+                await message.reply("ℹ️ ይህ ጥያቄ አስቀድሞ ተመዝግቧል።")
+                return
+            
+            await enqueue_payment_request(request_payload(tx_id, key, uid, amount, currency, phone))
+    except Exception:
+        await release_request(message, *claim)
+        raise
+    
+    await message.reply(f"✅ የወጪ ጥያቄ ተመዝግቧል (tx={tx_id}).\n\n⏳ እርምጃ በታዳጊ ይቀጥላል።")
+
+@dp.message(Command(commands=["send"]))
+async def cmd_send(message: Message):
+    parts = message.text.split()
+    if len(parts) < 4:
+        await message.reply("❌ ለምሳሌ: /send 100 ETB @username")
+        return
+    try:
+        amount = Decimal(parts[1])
+        if amount <= 0:
+            await message.reply("❌ መጠን ከ0 በላይ መሆን አለበት")
+            return
+    except:
+        await message.reply("❌ እባክዎን ትክክለኛ መጠን ያስገቡ.")
+        return
+    
+    currency = parts[2].upper()
+    target = parts[3].lstrip("@")
+    
     async with AsyncSessionLocal() as db:
-        q = sa.select(users).where(users.c.telegram_id==message.from_user.id).limit(1)
-        r = await db.execute(q)
-        user_row = r.first()
-        if not user_row:
+        uid = await get_user_id(message.from_user.id, db=db)
+        if uid is None:
             await message.reply("እባክዎን /start ይጠቀሙ.")
             return
-        user = user_row._mapping
         
-        q2 = sa.select(wallets).where(sa.and_(wallets.c.user_id==user['id'], wallets.c.currency==currency)).limit(1)
+        # Recipient by @username, or by numeric Telegram id
+        cond = users.c.telegram_id==int(target) if target.isdigit() else users.c.username==target
+        r = await db.execute(sa.select(users).where(cond).limit(1))
+        recipient_row = r.first()
+        if not recipient_row:
+            await message.reply("❌ ተቀባዩ አልተገኘም። ተቀባዩ መጀመሪያ /start መጠቀም አለበት።")
+            return
+        recipient = recipient_row._mapping
+        if recipient['id'] == uid:
+            await message.reply("❌ ለራስዎ መላክ አይችሉም።")
+            return
+        
+        q2 = sa.select(wallets).where(sa.and_(wallets.c.user_id==uid, wallets.c.currency==currency)).limit(1)
         r2 = await db.execute(q2)
         wrow = r2.first()
-        if not wrow or Decimal(wrow._mapping['balance']) < amount:
+        if not wrow or await wallet_balance(uid, wrow._mapping) < amount:
             await message.reply("❌ እባክዎን የተያዙ ዋሌት ወይም በሂሳብ ያለው ብቃት አልባ.")
             return
-        w = wrow._mapping
-        
-        # mark transaction pending
-        ins = transactions.insert().values(
-            wallet_id=w['id'], 
-            type="withdraw", 
-            amount=amount, 
-            currency=currency, 
-            status="pending", 
-            metadata={"phone":phone}
-        )
-        res = await db.execute(ins)
-        await db.commit()
-        tx_id = res.inserted_primary_key[0]
+        to_wallet = await get_or_create_wallet(recipient['id'], currency, db=db)
         
-        payload = {
-            "tx_id": tx_id, 
-            "user_id": user['id'], 
-            "amount": str(amount), 
-            "currency": currency, 
-            "phone": phone, 
-            "provider":"mpesa"
-        }
-        await enqueue_payment_request(payload)
+        ref = await transfer_funds(wrow._mapping, to_wallet, amount, db=db)
+        if ref is None:
+            await message.reply("❌ እባክዎን የተያዙ ዋሌት ወይም በሂሳብ ያለው ብቃት አልባ.")
+            return
         
-        await message.reply(f"✅ የወጪ ጥያቄ ተመዝግቧል (tx={tx_id}).\n\n⏳ እርምጃ በታዳጊ ይቀጥላል።")
+        await message.reply(f"✅ {amount} {currency} ወደ @{recipient['username'] or target} ተልኳል።")
 
 @dp.message(Command(commands=["trade"]))
 async def cmd_trade(message: Message):
@@ -333,25 +647,16 @@ async def cmd_trade(message: Message):
 @dp.message(Command(commands=["history"]))
 async def cmd_history(message: Message):
     async with AsyncSessionLocal() as db:
-        q = sa.select(users).where(users.c.telegram_id==message.from_user.id).limit(1)
-        r = await db.execute(q)
-        row = r.first()
-        if not row:
+        uid = await get_user_id(message.from_user.id, db=db)
+        if uid is None:
             await message.reply("እባክዎን /start ይጠቀሙ.")
             return
-        user = row._mapping
-        
-        # Get user's wallets
-        q2 = sa.select(wallets.c.id).where(wallets.c.user_id==user['id'])
-        wallet_ids = [w[0] for w in await db.execute(q2)]
         
-        if not wallet_ids:
-            await message.reply("ምንም ግብይቶች የሉም።")
-            return
-        
-        # Get recent transactions
-        q3 = sa.select(transactions).where(
-            transactions.c.wallet_id.in_(wallet_ids)
+        # Get recent transactions across the user's wallets
+        q3 = sa.select(transactions).select_from(
+            transactions.join(wallets, wallets.c.id==transactions.c.wallet_id)
+        ).where(
+            wallets.c.user_id==uid
         ).order_by(transactions.c.created_at.desc()).limit(10)
         
         txs = await db.execute(q3)
@@ -364,7 +669,7 @@ async def cmd_history(message: Message):
         text = "📊 የቅርብ ጊዜ ግብይቶች:\n\n"
         for tx in tx_list:
             t = tx._mapping
-            emoji = "📥" if t['type'] == 'deposit' else "📤"
+            emoji = "📥" if t['type'] == 'deposit' else "💸" if t['type'] == 'transfer' else "📤"
             text += f"{emoji} {t['type'].upper()}\n"
             text += f"   መጠን: {t['amount']} {t['currency']}\n"
             text += f"   ሁኔታ: {t['status']}\n"
@@ -374,19 +679,79 @@ async def cmd_history(message: Message):
 
 # startup/shutdown
 async def on_startup():
-    global redis
+    global redis, ledger
     redis = await aioredis.from_url(REDIS_URL)
     logger.info("Connected to Redis")
+    # Commands that create transactions and queue jobs get a tighter limit
+    payment_limit = (THROTTLE_PAYMENT_RATE, THROTTLE_PAYMENT_BURST)
+    dp.message.outer_middleware(ThrottlingMiddleware(
+        redis,
+        user_limit=(THROTTLE_USER_RATE, THROTTLE_USER_BURST),
+        global_limit=(THROTTLE_GLOBAL_RATE, THROTTLE_GLOBAL_BURST),
+        command_limits={"deposit": payment_limit, "withdraw": payment_limit, "send": payment_limit},
+        notice="⏳ በጣም ብዙ ጥያቄዎች ልከዋል። እባክዎን ከ{wait} ሰከንድ በኋላ ይሞክሩ።"
+    ))
+    if LEDGER_MODE == "redis":
+        ledger = AtomicLedger(redis)
+        await ledger.load()
     # ensure DB ready: create tables if missing (simple)
     async with engine.begin() as conn:
         await conn.run_sync(metadata.create_all)
     logger.info("DB tables ensured")
 
+async def healthz(request):
+    return web.json_response({"status": "ok"})
+
+async def run_webhook():
+    """
+    Serve updates pushed by Telegram instead of long polling
+
+    Requests without the X-Telegram-Bot-Api-Secret-Token header matching
+    WEBHOOK_SECRET are rejected. Valid updates are answered 200 right away
+    and handled in a background task, so a slow handler never makes
+    Telegram retry. No state lives in the process beyond caches, so any
+    number of replicas can share the webhook.
+    """
+    if not (WEBHOOK_URL and WEBHOOK_SECRET):
+        raise RuntimeError("BOT_MODE=webhook needs WEBHOOK_URL and WEBHOOK_SECRET")
+    
+    # Every replica registers the same URL; setWebhook is idempotent
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=True
+    ).register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/healthz", healthz)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    logger.info("Serving webhook on %s:%s%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+    
+    # The webhook stays registered on shutdown; other replicas keep serving
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+    await stopping.wait()
+    await runner.cleanup()
+
 async def main():
     await on_startup()
     try:
-        logger.info("Starting MahavabaPay Bot...")
-        await dp.start_polling(bot)
+        logger.info("Starting MahavabaPay Bot (%s)...", BOT_MODE)
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
     finally:
         await bot.session.close()
 
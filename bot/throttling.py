@@ -0,0 +1,121 @@
+# bot/throttling.py
+import logging
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message
+
+from cache import TTLCache
+
+logger = logging.getLogger("mahavabapay")
+
+# Token buckets, checked and charged together: either every bucket has a
+# token and each loses one, or nothing is charged and the reply is how
+# many seconds until the emptiest bucket refills one.
+# KEYS: bucket hashes; ARGV: rate (tokens/s) and burst for each key
+TOKEN_BUCKET_LUA = """
+local t = redis.call("TIME")
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local burst = tonumber(ARGV[2 * i])
+    local state = redis.call("HMGET", key, "tokens", "ts")
+    local level = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    level = math.min(burst, level + math.max(0, now - ts) * rate)
+    if level < 1 then
+        wait = math.max(wait, (1 - level) / rate)
+    end
+    tokens[i] = level
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local burst = tonumber(ARGV[2 * i])
+    redis.call("HSET", key, "tokens", tokens[i] - 1, "ts", now)
+    redis.call("EXPIRE", key, math.ceil(burst / rate) + 1)
+end
+return "0"
+"""
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Rate-limits messages per user, per user and command, and globally
+
+    One Redis script call per message charges all applicable buckets, so
+    limits hold across bot replicas. Two in-process checks run first and
+    drop obvious floods without touching Redis: a user recently denied
+    stays blocked locally until their bucket refills, and a local bucket
+    with the per-user limit (which only sees this replica's share of the
+    user's messages, so it never denies what Redis would allow).
+    If Redis is unavailable, messages are let through.
+    """
+
+    def __init__(self, redis, user_limit, global_limit, command_limits=None, notice=None):
+        """
+        Args:
+            redis: redis.asyncio client
+            user_limit: (rate per second, burst) for each user
+            global_limit: (rate per second, burst) across all users
+            command_limits: {command: (rate, burst)} per user, e.g. "deposit"
+            notice: reply for a newly throttled user; {wait} is filled in
+        """
+        self.redis = redis
+        self.user_limit = user_limit
+        self.global_limit = global_limit
+        self.command_limits = command_limits or {}
+        self.notice = notice
+        self.script = redis.register_script(TOKEN_BUCKET_LUA)
+        self.blocked = TTLCache(100000, ttl=3600)  # user id -> monotonic unblock time
+        self.local = TTLCache(100000, ttl=3600)    # user id -> (tokens, monotonic ts)
+
+    def _local_allow(self, user_id):
+        now = time.monotonic()
+        if self.blocked.get(user_id, 0) > now:
+            return False
+        rate, burst = self.user_limit
+        tokens, ts = self.local.get(user_id, (burst, now))
+        tokens = min(burst, tokens + (now - ts) * rate)
+        if tokens < 1:
+            return False
+        self.local.set(user_id, (tokens - 1, now))
+        return True
+
+    async def __call__(self, handler, event, data):
+        if not isinstance(event, Message) or event.from_user is None:
+            return await handler(event, data)
+        user_id = event.from_user.id
+        if not self._local_allow(user_id):
+            return None
+
+        keys = [f"throttle:user:{user_id}", "throttle:global"]
+        args = [*self.user_limit, *self.global_limit]
+        command = command_name(event.text)
+        if command in self.command_limits:
+            keys.append(f"throttle:user:{user_id}:{command}")
+            args.extend(self.command_limits[command])
+        try:
+            wait = float(await self.script(keys=keys, args=args))
+        except Exception as e:
+            logger.warning("Rate limiter unavailable, letting message through: %s", e)
+            wait = 0
+        if wait <= 0:
+            return await handler(event, data)
+
+        self.blocked.set(user_id, time.monotonic() + wait)
+        logger.info("Throttled user %s (%s) for %.1fs", user_id, command or "message", wait)
+        if self.notice:
+            await event.answer(self.notice.format(wait=max(1, round(wait))))
+        return None
+
+
+def command_name(text):
+    """`deposit` for "/deposit@MahavabaBot 100 ETB", None for plain text"""
+    if not text or not text.startswith("/"):
+        return None
+    return text.split()[0][1:].split("@")[0].lower()
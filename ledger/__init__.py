@@ -0,0 +1,13 @@
+from .atomic import AtomicLedger, BalanceNotLoaded, InsufficientFunds, LedgerError, journal_keys, wallet_key
+from .writebehind import JournalFlusher, Reconciler
+
+__all__ = [
+    "AtomicLedger",
+    "BalanceNotLoaded",
+    "InsufficientFunds",
+    "JournalFlusher",
+    "journal_keys",
+    "LedgerError",
+    "Reconciler",
+    "wallet_key",
+]
@@ -1,23 +1,165 @@
-import aioredis
+import json
 import os
+import time
+import uuid
+from decimal import Decimal
+
+from redis.exceptions import NoScriptError, ResponseError
+
+# Users are spread over a fixed number of buckets. Each bucket is one
+# Redis Cluster hash tag holding its users' ledger hashes, op markers and
+# write-behind journal, so every script stays on one slot. Changing the
+# bucket count needs a migration (see ledger.migrate).
+LEDGER_BUCKETS = int(os.getenv("LEDGER_BUCKETS", "64"))
+# How long an op ref is remembered for at-most-once application
+OP_TTL = int(os.getenv("LEDGER_OP_TTL", str(7 * 24 * 3600)))
+# Amounts are stored as integers of 1e-8, the precision of NUMERIC(30,8)
+PRECISION = 8
+# Scripts loaded by AtomicLedger.load(), by name
+SCRIPTS = {"balance": "atomic_balance.lua", "transfer": "transfer.lua"}
+
+
+class LedgerError(Exception):
+    """Base class for ledger failures"""
+
+
+class InsufficientFunds(LedgerError):
+    """The change would take the balance below zero"""
+
+    def __init__(self, user_id, currency):
+        super().__init__(f"Insufficient {currency} funds for user {user_id}")
+        self.user_id = user_id
+        self.currency = currency
+
+
+class BalanceNotLoaded(LedgerError):
+    """No Redis balance yet; seed it from Postgres and retry"""
+
+    def __init__(self, user_id, currency):
+        super().__init__(f"No {currency} balance loaded for user {user_id}")
+        self.user_id = user_id
+        self.currency = currency
+
+
+def _ledger_error(e, user_id, currency):
+    """Map a script error reply to the matching LedgerError"""
+    message = str(e)
+    if "insufficient_funds" in message:
+        return InsufficientFunds(user_id, currency)
+    if "not_loaded" in message:
+        # The transfer script names the user that is missing
+        if " " in message:
+            user_id = int(message.split()[-1])
+        return BalanceNotLoaded(user_id, currency)
+    return e
+
+
+def bucket(user_id):
+    """Ledger bucket of a user"""
+    return int(user_id) % LEDGER_BUCKETS
+
+
+def wallet_key(user_id):
+    """Hash with a user's bal:<currency> and res:<currency> fields"""
+    return f"ledger:{{b{bucket(user_id)}}}:{user_id}"
+
+
+def journal_key(bucket_id):
+    """Write-behind journal stream of one bucket"""
+    return f"ledger:journal:{{b{bucket_id}}}"
+
+
+def journal_keys():
+    """Journal streams of every bucket"""
+    return [journal_key(b) for b in range(LEDGER_BUCKETS)]
+
+
+def deadletter_key(stream):
+    """Where the flusher parks journal entries of `stream` Postgres rejects"""
+    return stream.replace("ledger:journal:", "ledger:deadletter:", 1)
+
+
+def transfer_key(bucket_id):
+    """Credits owed by cross-bucket transfers debited in one bucket, by debit ref"""
+    return f"ledger:transfers:{{b{bucket_id}}}"
+
+
+def transfer_keys():
+    """Pending transfer credits of every bucket"""
+    return [transfer_key(b) for b in range(LEDGER_BUCKETS)]
+
+
+def op_key(user_id, ref):
+    """At-most-once marker for op `ref`, kept in the user's bucket"""
+    return f"ledger:op:{{b{bucket(user_id)}}}:{ref}"
+
+
+def to_units(amount):
+    """Convert an amount to integer 1e-8 units; ValueError if finer than that"""
+    scaled = Decimal(str(amount)).scaleb(PRECISION)
+    if scaled != scaled.to_integral_value():
+        raise ValueError(f"{amount} has more than {PRECISION} decimal places")
+    return int(scaled)
+
+
+def from_units(units):
+    """Convert stored 1e-8 units back to a Decimal amount"""
+    return Decimal(int(units or 0)).scaleb(-PRECISION)
+
 
 class AtomicLedger:
     """
     Atomic ledger for microsecond-level balance operations
     Uses Redis LUA scripts to ensure race-condition-free updates
+
+    Balances and reservations are integers of 1e-8 units, so every
+    operation is exact. Each user has one hash (see wallet_key) and every
+    change is journaled to the user's bucket stream by the same script;
+    ledger.writebehind flushes the journals to Postgres and reconciles
+    the two.
     """
     
     def __init__(self, redis):
         self.redis = redis
-        self.script = None
+        self.scripts = {}
 
     async def load(self):
-        """Load LUA script into Redis"""
-        with open(os.path.join(os.path.dirname(__file__), "atomic_balance.lua")) as f:
-            lua = f.read()
-        self.script = await self.redis.script_load(lua)
+        """Load LUA scripts into Redis"""
+        for name, filename in SCRIPTS.items():
+            with open(os.path.join(os.path.dirname(__file__), filename)) as f:
+                lua = f.read()
+            self.scripts[name] = await self.redis.script_load(lua)
 
-    async def apply(self, user_id, currency, delta):
+    async def _eval(self, name, keys, args):
+        """EVALSHA a loaded script, reloading it once if Redis lost it"""
+        try:
+            return await self.redis.evalsha(self.scripts[name], len(keys), *keys, *args)
+        except NoScriptError:
+            # Restart or failover flushed the script cache
+            await self.load()
+            return await self.redis.evalsha(self.scripts[name], len(keys), *keys, *args)
+
+    def _change_call(self, user_id, currency, delta, reserved_delta, ref, owed=None):
+        """Keys and args of one balance script run; `owed` needs a ref"""
+        keys = [wallet_key(user_id), journal_key(bucket(user_id))]
+        if ref:
+            keys.append(op_key(user_id, ref))
+        args = [to_units(delta), to_units(reserved_delta), user_id, currency, ref or "", OP_TTL]
+        if owed:
+            keys.append(transfer_key(bucket(user_id)))
+            args.append(owed)
+        return keys, args
+
+    async def _change(self, user_id, currency, delta, reserved_delta, ref, owed=None):
+        """Run the balance script; returns (balance, reserved) as Decimals"""
+        keys, args = self._change_call(user_id, currency, delta, reserved_delta, ref, owed)
+        try:
+            balance, reserved = await self._eval("balance", keys, args)
+        except ResponseError as e:
+            raise _ledger_error(e, user_id, currency)
+        return from_units(balance), from_units(reserved)
+
+    async def apply(self, user_id, currency, delta, ref=None):
         """
         Apply balance change atomically
         
@@ -25,35 +167,201 @@ class AtomicLedger:
             user_id: User ID
             currency: Currency code (ETB, USD, etc.)
             delta: Amount to add (positive) or subtract (negative)
+            ref: Optional operation reference; a ref is applied at most once
         
         Returns:
-            New balance or error
+            New balance (Decimal)
+
+        Raises:
+            InsufficientFunds, BalanceNotLoaded
+        """
+        balance, _ = await self._change(user_id, currency, delta, 0, ref)
+        return balance
+
+    async def seed_balance(self, user_id, currency, balance, reserved=0):
+        """
+        Load a balance from Postgres unless Redis already holds one
+
+        Returns the balance Redis ends up with.
+        """
+        key = wallet_key(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hsetnx(key, f"bal:{currency}", to_units(balance))
+            pipe.hsetnx(key, f"res:{currency}", to_units(reserved))
+            pipe.hget(key, f"bal:{currency}")
+            *_, current = await pipe.execute()
+        return from_units(current)
+
+    async def apply_many(self, changes):
+        """
+        Apply many balance changes in one pipelined round trip
+
+        Args:
+            changes: Iterable of (user_id, currency, delta, ref)
+
+        Returns:
+            One entry per change, in order: the new balance (Decimal), or
+            the InsufficientFunds/BalanceNotLoaded it failed with. Each
+            change is atomic on its own; the batch is not.
+        """
+        changes = list(changes)
+        calls = [self._change_call(user_id, currency, delta, 0, ref)
+                 for user_id, currency, delta, ref in changes]
+        results = await self._pipeline("balance", calls)
+        for i, (res, (user_id, currency, _, _)) in enumerate(zip(results, changes)):
+            if isinstance(res, Exception):
+                results[i] = _ledger_error(res, user_id, currency)
+            else:
+                results[i] = from_units(res[0])
+        return results
+
+    async def _pipeline(self, name, calls):
+        """
+        EVALSHA `calls` (keys, args) in one pipeline
+
+        Errors come back in place. Commands that failed with NOSCRIPT are
+        run again, alone, after reloading the scripts.
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for keys, args in calls:
+                pipe.evalsha(self.scripts[name], len(keys), *keys, *args)
+            results = await pipe.execute(raise_on_error=False)
+        missing = [i for i, res in enumerate(results) if isinstance(res, NoScriptError)]
+        if missing:
+            await self.load()
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for i in missing:
+                    keys, args = calls[i]
+                    pipe.evalsha(self.scripts[name], len(keys), *keys, *args)
+                retried = await pipe.execute(raise_on_error=False)
+            for i, res in zip(missing, retried):
+                results[i] = res
+        return results
+
+    async def transfer(self, from_user_id, to_user_id, currency, amount, ref=None):
+        """
+        Move `amount` between two users' balances
+
+        Users in the same bucket are settled by one atomic script. Across
+        buckets (different cluster slots) the debit and the credit are two
+        scripts, each applied at most once under `ref`: if the credit
+        fails, calling again with the same ref completes it. The debit
+        also records the credit it owes in its bucket, cleared once the
+        credit is in; complete_transfers() applies credits a dead caller
+        left behind.
+
+        Returns:
+            (source balance, destination balance) as Decimals
+
+        Raises:
+            InsufficientFunds, BalanceNotLoaded (naming the missing user)
+        """
+        if Decimal(str(amount)) <= 0:
+            raise ValueError("Transfer amount must be positive")
+        if bucket(from_user_id) != bucket(to_user_id):
+            ref = ref or f"transfer:{uuid.uuid4()}"
+            owed = json.dumps({
+                "user": to_user_id, "ccy": currency, "amount": to_units(amount),
+                "ref": f"{ref}:credit", "at": time.time()
+            })
+            source, _ = await self._change(
+                from_user_id, currency, -Decimal(str(amount)), 0, f"{ref}:debit", owed
+            )
+            destination = await self.apply(to_user_id, currency, amount, ref=f"{ref}:credit")
+            await self.redis.hdel(transfer_key(bucket(from_user_id)), f"{ref}:debit")
+            return source, destination
+
+        keys = [wallet_key(from_user_id), wallet_key(to_user_id), journal_key(bucket(from_user_id))]
+        if ref:
+            keys.append(op_key(from_user_id, ref))
+        args = [to_units(amount), from_user_id, to_user_id, currency, ref or "", OP_TTL]
+        try:
+            source, destination = await self._eval("transfer", keys, args)
+        except ResponseError as e:
+            raise _ledger_error(e, from_user_id, currency)
+        return from_units(source), from_units(destination)
+
+    async def void_transfer(self, from_user_id, to_user_id, ref):
+        """
+        Settle a transfer whose call failed without a clear outcome
+
+        Claims the op marker of its debit: if the debit hadn't run, it now
+        never will and True is returned. False means the debit went through
+        (and its credit is applied or owed). A voided ref must not be
+        replayed.
+        """
+        if bucket(from_user_id) != bucket(to_user_id):
+            ref = f"{ref}:debit"
+        return bool(await self.redis.set(op_key(from_user_id, ref), "void", nx=True, ex=OP_TTL))
+
+    async def complete_transfers(self, seed, min_age=60):
         """
-        key = f"balance:{user_id}:{currency}"
-        res = await self.redis.evalsha(self.script, 1, key, delta)
-        return res
+        Apply the credits of cross-bucket transfers interrupted after the debit
+
+        Credits owed for more than `min_age` seconds are applied under
+        their own ref, so one a live transfer applies meanwhile still
+        lands once. `seed(user_id, currency)` must load a balance Redis
+        doesn't hold yet. Returns the number of transfers completed.
+        """
+        keys = transfer_keys()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+            owed_by_bucket = await pipe.execute()
+
+        completed = 0
+        cutoff = time.time() - min_age
+        for key, owed in zip(keys, owed_by_bucket):
+            for debit_ref, raw in owed.items():
+                credit = json.loads(raw)
+                if credit["at"] > cutoff:
+                    continue
+                args = (credit["user"], credit["ccy"], from_units(credit["amount"]))
+                try:
+                    await self.apply(*args, ref=credit["ref"])
+                except BalanceNotLoaded:
+                    await seed(credit["user"], credit["ccy"])
+                    await self.apply(*args, ref=credit["ref"])
+                await self.redis.hdel(key, debit_ref)
+                completed += 1
+        return completed
+
+    async def get_many(self, pairs):
+        """
+        Get the balances of many (user_id, currency) pairs
+
+        One pipelined HGET per pair, a single round trip; keys live in
+        different slots, so there is no cross-key MGET.
+        """
+        pairs = list(pairs)
+        if not pairs:
+            return []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id, currency in pairs:
+                pipe.hget(wallet_key(user_id), f"bal:{currency}")
+            values = await pipe.execute()
+        return [from_units(value) for value in values]
 
     async def get_balance(self, user_id, currency):
         """Get current balance"""
-        key = f"balance:{user_id}:{currency}"
-        balance = await self.redis.get(key)
-        return float(balance) if balance else 0.0
+        return from_units(await self.redis.hget(wallet_key(user_id), f"bal:{currency}"))
+
+    async def get_reserved(self, user_id, currency):
+        """Get funds currently held for pending transactions"""
+        return from_units(await self.redis.hget(wallet_key(user_id), f"res:{currency}"))
 
     async def set_balance(self, user_id, currency, amount):
         """Set balance directly (use with caution)"""
-        key = f"balance:{user_id}:{currency}"
-        await self.redis.set(key, str(amount))
+        await self.redis.hset(wallet_key(user_id), f"bal:{currency}", to_units(amount))
 
-    async def reserve_funds(self, user_id, currency, amount):
+    async def reserve_funds(self, user_id, currency, amount, ref=None):
         """Reserve funds for pending transaction"""
-        key = f"reserved:{user_id}:{currency}"
-        current = await self.redis.get(key)
-        current = float(current) if current else 0.0
-        await self.redis.set(key, str(current + amount))
+        return await self._change(user_id, currency, -Decimal(str(amount)), amount, ref)
 
-    async def release_reserved(self, user_id, currency, amount):
+    async def release_reserved(self, user_id, currency, amount, ref=None):
         """Release reserved funds"""
-        key = f"reserved:{user_id}:{currency}"
-        current = await self.redis.get(key)
-        current = float(current) if current else 0.0
-        await self.redis.set(key, str(max(0, current - amount)))
+        return await self._change(user_id, currency, amount, -Decimal(str(amount)), ref)
+
+    async def capture_reserved(self, user_id, currency, amount, ref=None):
+        """Consume reserved funds once the pending transaction went through"""
+        return await self._change(user_id, currency, 0, -Decimal(str(amount)), ref)
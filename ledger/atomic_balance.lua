@@ -1,16 +1,64 @@
 -- Redis LUA script for atomic balance updates
 -- This ensures race-condition-free balance operations
+--
+-- KEYS[1] user's ledger hash, KEYS[2] bucket journal stream,
+-- KEYS[3] (optional) op marker, KEYS[4] (optional) bucket's pending
+-- transfer credits; all share the bucket's hash tag
+-- ARGV[1] balance delta, ARGV[2] reserved delta, ARGV[3] user id,
+-- ARGV[4] currency, ARGV[5] op ref, ARGV[6] op marker TTL in seconds,
+-- ARGV[7] (with KEYS[4]) the credit this debit owes another bucket
+--
+-- The hash holds bal:<currency> and res:<currency> fields. Amounts are
+-- integers in 1e-8 units. They are only ever added by HINCRBY (64-bit,
+-- exact); Lua inspects just the sign of the results, which survives the
+-- conversion to a double.
+--
+-- Every applied change is appended to the journal in the same script, so
+-- the balance and its write-behind record can never disagree. With an op
+-- marker the change is applied at most once per ref. The debit leg of a
+-- cross-bucket transfer records its credit under the ref in the same
+-- step, so the credit can be completed even if the caller dies.
+--
+-- Returns {balance, reserved} as strings.
 
-local key = KEYS[1]
-local delta = tonumber(ARGV[1])
-local balance = tonumber(redis.call("GET", key) or "0")
+-- Negate an integer string without going through a double
+local function negate(n)
+    if n == "0" then
+        return n
+    elseif string.sub(n, 1, 1) == "-" then
+        return string.sub(n, 2)
+    end
+    return "-" .. n
+end
+
+local bal = "bal:" .. ARGV[4]
+local res = "res:" .. ARGV[4]
+
+-- Balances are seeded from Postgres first; never invent a zero
+if redis.call("HEXISTS", KEYS[1], bal) == 0 then
+    return {err="not_loaded"}
+end
 
-local newbal = balance + delta
+if KEYS[3] and redis.call("EXISTS", KEYS[3]) == 1 then
+    return redis.call("HMGET", KEYS[1], bal, res)
+end
+
+local balance = redis.call("HINCRBY", KEYS[1], bal, ARGV[1])
+local reserved = redis.call("HINCRBY", KEYS[1], res, ARGV[2])
 
--- Prevent negative balance
-if newbal < 0 then
+-- Prevent negative balance (or reservation)
+if balance < 0 or reserved < 0 then
+    redis.call("HINCRBY", KEYS[1], bal, negate(ARGV[1]))
+    redis.call("HINCRBY", KEYS[1], res, negate(ARGV[2]))
     return {err="insufficient_funds"}
 end
 
-redis.call("SET", key, newbal)
-return newbal
+redis.call("XADD", KEYS[2], "*", "user", ARGV[3], "ccy", ARGV[4],
+    "delta", ARGV[1], "reserved", ARGV[2], "ref", ARGV[5])
+if KEYS[3] then
+    redis.call("SET", KEYS[3], "1", "EX", ARGV[6])
+end
+if KEYS[4] then
+    redis.call("HSET", KEYS[4], ARGV[5], ARGV[7])
+end
+return redis.call("HMGET", KEYS[1], bal, res)
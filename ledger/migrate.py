@@ -0,0 +1,89 @@
+"""
+Move Redis ledger balances from the flat key layout to bucketed hashes
+
+    python -m ledger.migrate [--dry-run] [--keep-old]
+
+The old layout kept `balance:<user>:<ccy>` and `reserved:<user>:<ccy>`
+as unrelated keys with one `ledger:journal` stream. This tool first
+flushes that journal to Postgres, then copies every balance and
+reservation into the user's bucket hash (see ledger.atomic.wallet_key)
+and deletes the old keys. Fields already present in the new layout are
+left alone and reported.
+
+Stop the workers first. In-flight op markers are not carried over; they
+only matter for jobs interrupted between the ledger and the database,
+which a clean shutdown doesn't leave behind. Uses REDIS_URL and
+DATABASE_URL from the environment.
+"""
+import argparse
+import asyncio
+import os
+
+from dotenv import load_dotenv
+from redis import asyncio as aioredis
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from .atomic import wallet_key
+from .writebehind import JournalFlusher
+
+LEGACY_JOURNAL = "ledger:journal"
+
+
+async def migrate(redis, engine, dry_run=False, keep_old=False, batch_size=500):
+    """Migrate every legacy balance; returns (moved, conflicts)"""
+    flusher = JournalFlusher(redis, engine, streams=[LEGACY_JOURNAL])
+    while not dry_run and await flusher.flush_once():
+        pass
+
+    moved = conflicts = 0
+    cursor = 0
+    while True:
+        cursor, keys = await redis.scan(cursor, match="balance:*", count=batch_size)
+        keys = [k.decode() if isinstance(k, bytes) else k for k in keys]
+        if keys:
+            async with redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.get(key)
+                    pipe.get(key.replace("balance:", "reserved:", 1))
+                values = await pipe.execute()
+
+            found = [
+                (key, balance, reserved)
+                for key, balance, reserved in zip(keys, values[::2], values[1::2])
+                if balance is not None
+            ]
+            moved += len(found)
+            if not dry_run:
+                async with redis.pipeline(transaction=False) as pipe:
+                    for key, balance, reserved in found:
+                        _, user_id, currency = key.split(":")
+                        new_key = wallet_key(user_id)
+                        pipe.hsetnx(new_key, f"bal:{currency}", balance)
+                        pipe.hsetnx(new_key, f"res:{currency}", reserved or 0)
+                    written = await pipe.execute()
+                conflicts += sum(1 for ok in written[::2] if not ok)
+                if not keep_old:
+                    await redis.delete(*keys, *(k.replace("balance:", "reserved:", 1) for k in keys))
+        if cursor == 0:
+            break
+    return moved, conflicts
+
+
+async def main(args):
+    load_dotenv()
+    redis = await aioredis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    engine = create_async_engine(os.getenv("DATABASE_URL"), future=True)
+    try:
+        moved, conflicts = await migrate(redis, engine, args.dry_run, args.keep_old)
+    finally:
+        await redis.close()
+        await engine.dispose()
+    prefix = "Would migrate" if args.dry_run else "Migrated"
+    print(f"{prefix} {moved} balance(s); {conflicts} already present in the new layout")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate the Redis ledger key layout")
+    parser.add_argument("--dry-run", action="store_true", help="only count legacy balances")
+    parser.add_argument("--keep-old", action="store_true", help="don't delete legacy keys")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,40 @@
+-- Redis LUA script for atomic two-leg transfers
+-- Debits one balance and credits another in a single step
+--
+-- KEYS[1] source user's ledger hash, KEYS[2] destination user's ledger
+-- hash, KEYS[3] bucket journal stream, KEYS[4] (optional) op marker; both
+-- users must be in the same bucket so all keys share one hash tag
+-- ARGV[1] amount, ARGV[2] source user id, ARGV[3] destination user id,
+-- ARGV[4] currency, ARGV[5] op ref, ARGV[6] op marker TTL in seconds
+--
+-- Amounts are integers in 1e-8 units (see atomic_balance.lua). Each leg
+-- is journaled as its own entry under the same ref.
+--
+-- Returns {source balance, destination balance} as strings.
+
+local bal = "bal:" .. ARGV[4]
+
+for i = 1, 2 do
+    if redis.call("HEXISTS", KEYS[i], bal) == 0 then
+        return {err="not_loaded " .. ARGV[i + 1]}
+    end
+end
+
+if KEYS[4] and redis.call("EXISTS", KEYS[4]) == 1 then
+    return {redis.call("HGET", KEYS[1], bal), redis.call("HGET", KEYS[2], bal)}
+end
+
+if redis.call("HINCRBY", KEYS[1], bal, "-" .. ARGV[1]) < 0 then
+    redis.call("HINCRBY", KEYS[1], bal, ARGV[1])
+    return {err="insufficient_funds"}
+end
+redis.call("HINCRBY", KEYS[2], bal, ARGV[1])
+
+redis.call("XADD", KEYS[3], "*", "user", ARGV[2], "ccy", ARGV[4],
+    "delta", "-" .. ARGV[1], "reserved", "0", "ref", ARGV[5])
+redis.call("XADD", KEYS[3], "*", "user", ARGV[3], "ccy", ARGV[4],
+    "delta", ARGV[1], "reserved", "0", "ref", ARGV[5])
+if KEYS[4] then
+    redis.call("SET", KEYS[4], "1", "EX", ARGV[6])
+end
+return {redis.call("HGET", KEYS[1], bal), redis.call("HGET", KEYS[2], bal)}
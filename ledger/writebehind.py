@@ -0,0 +1,340 @@
+import logging
+from collections import defaultdict
+
+import sqlalchemy as sa
+
+from .atomic import (
+    AtomicLedger, bucket, deadletter_key, from_units, journal_key, journal_keys, to_units, wallet_key
+)
+
+logger = logging.getLogger("mahavaba_ledger")
+
+# Reset a balance and its reservation (hash fields ARGV[1], ARGV[2]) only
+# if neither changed since they were read (a missing field reads as "")
+REPAIR_LUA = """
+if (redis.call("HGET", KEYS[1], ARGV[1]) or "") == ARGV[3]
+        and (redis.call("HGET", KEYS[1], ARGV[2]) or "") == ARGV[4] then
+    redis.call("HSET", KEYS[1], ARGV[1], ARGV[5], ARGV[2], ARGV[6])
+    return 1
+end
+return 0
+"""
+
+APPLY_SQL = (
+    "UPDATE wallets SET balance = balance + :delta, "
+    "reserved = reserved + :reserved "
+    "WHERE user_id = :user_id AND currency = :currency"
+)
+
+# Pair legs of redis-mode transfers left pending (see bot transfer_funds)
+STALE_TRANSFERS_SQL = """
+SELECT t.external_ref,
+       max(w.user_id) FILTER (WHERE t.amount < 0) AS from_user,
+       max(w.user_id) FILTER (WHERE t.amount > 0) AS to_user
+FROM transactions t JOIN wallets w ON w.id = t.wallet_id
+WHERE t.type = 'transfer' AND t.status = 'pending'
+  AND t.created_at < now() - make_interval(secs => :age)
+GROUP BY t.external_ref
+"""
+
+# Errors that fail the same batch every time (CHECK violations, overflow)
+# rather than the connection
+POISON_ERRORS = (sa.exc.IntegrityError, sa.exc.DataError)
+
+
+def _as_str(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _stream_id(entry_id):
+    ms, _, seq = _as_str(entry_id).partition("-")
+    return int(ms), int(seq or 0)
+
+
+def aggregate(entries):
+    """Sum journal entries into {(user_id, currency): [delta, reserved]} units"""
+    deltas = defaultdict(lambda: [0, 0])
+    for _, fields in entries:
+        fields = {_as_str(k): _as_str(v) for k, v in fields.items()}
+        sums = deltas[(int(fields["user"]), fields["ccy"])]
+        sums[0] += int(fields["delta"])
+        sums[1] += int(fields["reserved"])
+    return deltas
+
+
+async def _lock_offset(conn, stream, skip_locked=False):
+    """
+    Return the last flushed entry id of `stream`, row-locked
+
+    The lock serializes flushers (and the reconciler) across workers, so
+    entries are applied in order and exactly once. With `skip_locked`,
+    None is returned if someone else holds the stream.
+    """
+    await conn.execute(
+        sa.text(
+            "INSERT INTO ledger_journal_offsets (stream, last_id) VALUES (:s, '0-0') "
+            "ON CONFLICT (stream) DO NOTHING"
+        ),
+        {"s": stream}
+    )
+    r = await conn.execute(
+        sa.text(
+            "SELECT last_id FROM ledger_journal_offsets WHERE stream = :s FOR UPDATE"
+            + (" SKIP LOCKED" if skip_locked else "")
+        ),
+        {"s": stream}
+    )
+    return r.scalar_one_or_none()
+
+
+class JournalFlusher:
+    """
+    Writes the Redis ledger journals through to `wallets`
+
+    Each bucket stream is flushed on its own: the entries after its stored
+    offset are summed per wallet and applied with the new offset in one
+    Postgres transaction, then trimmed from the stream. Streams another
+    worker is flushing are skipped, so flushers share the buckets. Each
+    tick first reads every stream's last entry id in one pipeline and
+    only opens a transaction for streams past the offset last seen, so
+    an idle ledger costs one Redis round trip.
+
+    A wallet whose sum Postgres rejects (e.g. the balance >= 0 CHECK)
+    would stall its stream forever; its entries are moved to the
+    bucket's `ledger:deadletter:` stream instead and the rest of the
+    batch is applied. The reconciler then resets that Redis balance to
+    Postgres, and the dead letters are left for someone to settle.
+    """
+
+    def __init__(self, redis, engine, streams=None, batch_size=500):
+        self.redis = redis
+        self.engine = engine
+        self.streams = streams or journal_keys()
+        self.batch_size = batch_size
+        # Last flushed id seen per stream (by any worker); unknown until read
+        self.offsets = {}
+
+    async def flush_once(self):
+        """Flush one batch per stream with new entries; returns the most any stream had"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for stream in self.streams:
+                pipe.xrevrange(stream, count=1)
+            tips = await pipe.execute()
+
+        flushed = 0
+        for stream, tip in zip(self.streams, tips):
+            if not tip:
+                continue
+            seen = self.offsets.get(stream)
+            if seen is not None and _stream_id(tip[0][0]) <= _stream_id(seen):
+                continue
+            flushed = max(flushed, await self.flush_stream(stream))
+        return flushed
+
+    async def flush_stream(self, stream):
+        """Flush one batch of `stream`; returns the number of entries applied"""
+        async with self.engine.begin() as conn:
+            last_id = await _lock_offset(conn, stream, skip_locked=True)
+            if last_id is None:
+                return 0
+            self.offsets[stream] = last_id
+            entries = await self.redis.xrange(
+                stream, min=f"({last_id}", count=self.batch_size
+            )
+            if not entries:
+                return 0
+
+            deltas = aggregate(entries)
+            rows = [
+                {
+                    "user_id": user_id,
+                    "currency": currency,
+                    "delta": from_units(delta),
+                    "reserved": from_units(reserved)
+                }
+                for (user_id, currency), (delta, reserved) in sorted(deltas.items())
+                if delta or reserved
+            ]
+            if rows:
+                # Sorted by (user_id, currency), so concurrent writers lock
+                # wallets in the same order
+                try:
+                    async with conn.begin_nested():
+                        await conn.execute(sa.text(APPLY_SQL), rows)
+                except POISON_ERRORS as e:
+                    logger.error("Journal batch of %s rejected, applying per wallet: %s", stream, e)
+                    rejected = await self._apply_each(conn, rows)
+                    await self._dead_letter(stream, entries, rejected)
+            last_id = _as_str(entries[-1][0])
+            await conn.execute(
+                sa.text(
+                    "UPDATE ledger_journal_offsets SET last_id = :id, updated_at = now() "
+                    "WHERE stream = :s"
+                ),
+                {"id": last_id, "s": stream}
+            )
+
+        self.offsets[stream] = last_id
+        # Entries before last_id are in Postgres now
+        await self.redis.xtrim(stream, minid=last_id, approximate=False)
+        return len(entries)
+
+    @staticmethod
+    async def _apply_each(conn, rows):
+        """Apply rows one savepoint each; returns {(user_id, currency): error} of the rejected"""
+        rejected = {}
+        for row in rows:
+            try:
+                async with conn.begin_nested():
+                    await conn.execute(sa.text(APPLY_SQL), row)
+            except POISON_ERRORS as e:
+                rejected[(row["user_id"], row["currency"])] = str(getattr(e, "orig", e))
+        return rejected
+
+    async def _dead_letter(self, stream, entries, rejected):
+        """Copy the entries of rejected wallets to the dead-letter stream"""
+        if not rejected:
+            return
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for entry_id, fields in entries:
+                fields = {_as_str(k): _as_str(v) for k, v in fields.items()}
+                error = rejected.get((int(fields["user"]), fields["ccy"]))
+                if error is not None:
+                    pipe.xadd(deadletter_key(stream), {**fields, "entry": _as_str(entry_id), "error": error})
+            await pipe.execute()
+        for (user_id, currency), error in rejected.items():
+            logger.error(
+                "Dead-lettered %s journal entries of user %s %s: %s", stream, user_id, currency, error
+            )
+
+
+class Reconciler:
+    """
+    Detects and repairs drift between Redis balances and Postgres
+
+    The expected Redis balance and reservation are the wallet row plus
+    the journal entries not flushed yet. For every bucket, its users'
+    values and its journal tip are read in one MULTI (one slot), and all
+    offset rows stay locked for the whole pass so no flusher can move
+    underneath. Drifted fields are reset to the expected values, unless
+    they changed in the meantime. One pass runs at a time across
+    workers; the others skip. Each pass first completes cross-bucket
+    transfers whose caller died between the debit and the credit, and
+    settles transfer rows left pending for `transfer_age` seconds.
+    """
+
+    def __init__(self, redis, engine, batch_size=1000, transfer_age=300):
+        self.redis = redis
+        self.engine = engine
+        self.batch_size = batch_size
+        self.transfer_age = transfer_age
+        self.repair = redis.register_script(REPAIR_LUA)
+        self.ledger = AtomicLedger(redis)
+
+    async def run_once(self):
+        """Check every wallet once; returns the number of drifted balances, or None if skipped"""
+        drifted = 0
+        async with self.engine.begin() as conn:
+            r = await conn.execute(sa.text("SELECT pg_try_advisory_xact_lock(hashtext('ledger_reconciler'))"))
+            if not r.scalar():
+                return None
+            await self._complete_transfers(conn)
+            await self._settle_transfer_rows(conn)
+            # Streams in a fixed order, so two reconcilers can't deadlock
+            tips = {}
+            for b, stream in enumerate(journal_keys()):
+                tips[b] = await _lock_offset(conn, stream)
+            pending = defaultdict(lambda: [0, 0])
+            after_id = 0
+            while True:
+                r = await conn.execute(
+                    sa.text(
+                        "SELECT id, user_id, currency, balance, reserved FROM wallets "
+                        "WHERE id > :after ORDER BY id LIMIT :n"
+                    ),
+                    {"after": after_id, "n": self.batch_size}
+                )
+                batch = r.fetchall()
+                if not batch:
+                    break
+                after_id = batch[-1].id
+
+                by_bucket = defaultdict(list)
+                for w in batch:
+                    by_bucket[bucket(w.user_id)].append(w)
+                for b, wallets in by_bucket.items():
+                    drifted += await self._check_bucket(b, wallets, tips, pending)
+        return drifted
+
+    async def _complete_transfers(self, conn):
+        async def seed(user_id, currency):
+            r = await conn.execute(
+                sa.text(
+                    "SELECT balance, reserved FROM wallets WHERE user_id = :u AND currency = :c"
+                ),
+                {"u": user_id, "c": currency}
+            )
+            balance, reserved = r.one()
+            await self.ledger.seed_balance(user_id, currency, balance, reserved)
+
+        if not self.ledger.scripts:
+            await self.ledger.load()
+        completed = await self.ledger.complete_transfers(seed)
+        if completed:
+            logger.warning("Completed %s interrupted cross-bucket transfer(s)", completed)
+
+    async def _settle_transfer_rows(self, conn):
+        """Complete or fail pending transfer pairs, by whether their debit ran"""
+        r = await conn.execute(sa.text(STALE_TRANSFERS_SQL), {"age": self.transfer_age})
+        for ref, from_user, to_user in r.fetchall():
+            voided = await self.ledger.void_transfer(from_user, to_user, ref)
+            await conn.execute(
+                sa.text(
+                    "UPDATE transactions SET status = :s "
+                    "WHERE external_ref = :ref AND type = 'transfer' AND status = 'pending'"
+                ),
+                {"s": "failed" if voided else "completed", "ref": ref}
+            )
+            logger.warning("Settled stale transfer %s as %s", ref, "failed" if voided else "completed")
+
+    async def _check_bucket(self, b, wallets, tips, pending):
+        """Compare one bucket's share of a wallet batch; returns drift count"""
+        stream = journal_key(b)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for w in wallets:
+                pipe.hmget(wallet_key(w.user_id), f"bal:{w.currency}", f"res:{w.currency}")
+            pipe.xrevrange(stream, count=1)
+            *values, last = await pipe.execute()
+
+        # Unflushed deltas up to the tip seen with these values
+        if last and _stream_id(last[0][0]) > _stream_id(tips[b]):
+            entries = await self.redis.xrange(
+                stream, min=f"({tips[b]}", max=_as_str(last[0][0])
+            )
+            for key, (delta, reserved) in aggregate(entries).items():
+                pending[key][0] += delta
+                pending[key][1] += reserved
+            tips[b] = _as_str(last[0][0])
+
+        drifted = 0
+        for w, (balance, reserved) in zip(wallets, values):
+            if balance is None:
+                # Not loaded yet; seeded from Postgres on first use
+                continue
+            observed = (_as_str(balance), _as_str(reserved) or "")
+            delta, reserved_delta = pending.get((w.user_id, w.currency), (0, 0))
+            expected = (
+                str(to_units(w.balance) + delta),
+                str(to_units(w.reserved) + reserved_delta)
+            )
+            if int(observed[0]) == int(expected[0]) and int(observed[1] or 0) == int(expected[1]):
+                continue
+            drifted += 1
+            key = wallet_key(w.user_id)
+            logger.warning(
+                "Ledger drift on %s %s: redis=%s expected=%s", key, w.currency, observed, expected
+            )
+            fields = [f"bal:{w.currency}", f"res:{w.currency}"]
+            if not await self.repair(keys=[key], args=[*fields, *observed, *expected]):
+                logger.info("Skipped repair of %s %s, changed meanwhile", key, w.currency)
+        return drifted
@@ -36,12 +36,19 @@ CREATE TABLE IF NOT EXISTS transactions (
   type TEXT NOT NULL CHECK (type IN ('deposit', 'withdraw', 'transfer', 'fee', 'trade')),
   amount NUMERIC(30,8) NOT NULL,
   currency TEXT NOT NULL,
-  status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'processing', 'completed', 'failed', 'cancelled')),
+  status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'processing', 'completed', 'failed', 'cancelled', 'review')),
   external_ref TEXT,
   metadata JSONB,
+  idempotency_key TEXT,
   created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
   updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
 );
+-- Databases created before idempotency keys
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+-- 'review': payout outcome unknown, held for manual settlement (funds stay reserved)
+ALTER TABLE transactions DROP CONSTRAINT IF EXISTS transactions_status_check;
+ALTER TABLE transactions ADD CONSTRAINT transactions_status_check
+  CHECK (status IN ('pending', 'processing', 'completed', 'failed', 'cancelled', 'review'));
 
 -- Payment requests (to track outgoing bank/mpesa requests, retries)
 CREATE TABLE IF NOT EXISTS payment_requests (
@@ -49,14 +56,42 @@ CREATE TABLE IF NOT EXISTS payment_requests (
   transaction_id BIGINT REFERENCES transactions(id),
   provider TEXT NOT NULL CHECK (provider IN ('mpesa', 'telebirr', 'chapa', 'okx', 'bank')),
   provider_ref TEXT,
-  status TEXT DEFAULT 'queued' CHECK (status IN ('queued', 'processing', 'completed', 'failed', 'retrying')),
+  status TEXT DEFAULT 'queued' CHECK (status IN ('queued', 'sending', 'processing', 'completed', 'failed', 'retrying')),
   attempt_count INT DEFAULT 0,
+  status_checks INT DEFAULT 0,
   max_attempts INT DEFAULT 3,
   last_error TEXT,
   created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
   updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
 );
 
+-- Databases created before status checks were counted
+ALTER TABLE payment_requests ADD COLUMN IF NOT EXISTS status_checks INT DEFAULT 0;
+-- 'sending': charge or payout handed to the provider, reply not recorded yet
+ALTER TABLE payment_requests DROP CONSTRAINT IF EXISTS payment_requests_status_check;
+ALTER TABLE payment_requests ADD CONSTRAINT payment_requests_status_check
+  CHECK (status IN ('queued', 'sending', 'processing', 'completed', 'failed', 'retrying'));
+
+-- Write-behind progress of the Redis ledger journal (LEDGER_MODE=redis)
+CREATE TABLE IF NOT EXISTS ledger_journal_offsets (
+  stream TEXT PRIMARY KEY,
+  last_id TEXT NOT NULL DEFAULT '0-0',
+  updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+
+-- Transaction counts and amounts per UTC day, maintained by the worker
+-- (worker/rollups.py) for the admin stats and analytics endpoints
+CREATE TABLE IF NOT EXISTS transaction_daily_rollups (
+  day DATE NOT NULL,
+  currency TEXT NOT NULL,
+  type TEXT NOT NULL,
+  status TEXT NOT NULL,
+  tx_count BIGINT NOT NULL DEFAULT 0,
+  amount_sum NUMERIC(30,8) NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+  PRIMARY KEY (day, currency, type, status)
+);
+
 -- Audit log for all operations
 CREATE TABLE IF NOT EXISTS audit_log (
   id BIGSERIAL PRIMARY KEY,
@@ -86,13 +121,26 @@ CREATE TABLE IF NOT EXISTS kyc_documents (
 
 -- Indexes for performance
 CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id);
+CREATE INDEX IF NOT EXISTS idx_users_created_at_id ON users(created_at DESC, id DESC);
 CREATE INDEX IF NOT EXISTS idx_wallets_user_id ON wallets(user_id);
 CREATE INDEX IF NOT EXISTS idx_wallets_currency ON wallets(currency);
 CREATE INDEX IF NOT EXISTS idx_transactions_wallet_id ON transactions(wallet_id);
-CREATE INDEX IF NOT EXISTS idx_transactions_status ON transactions(status);
-CREATE INDEX IF NOT EXISTS idx_transactions_created_at ON transactions(created_at DESC);
+-- Admin keyset pagination: (created_at, id) cursors, optionally filtered
+-- by status, type or currency. These cover the old single-column indexes.
+DROP INDEX IF EXISTS idx_transactions_status;
+DROP INDEX IF EXISTS idx_transactions_created_at;
+CREATE INDEX IF NOT EXISTS idx_transactions_created_at_id ON transactions(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_transactions_status_created_at ON transactions(status, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_transactions_type_created_at ON transactions(type, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_transactions_currency_created_at ON transactions(currency, created_at DESC, id DESC);
+-- Rollup refreshes find the days touched since the last run
+CREATE INDEX IF NOT EXISTS idx_transactions_updated_at ON transactions(updated_at);
+-- One transaction per originating request (bot: <action>:<chat>:<message>)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_idempotency_key ON transactions(idempotency_key);
 CREATE INDEX IF NOT EXISTS idx_payment_requests_status ON payment_requests(status);
-CREATE INDEX IF NOT EXISTS idx_payment_requests_transaction_id ON payment_requests(transaction_id);
+-- One attempts row per transaction; the worker upserts on it
+DROP INDEX IF EXISTS idx_payment_requests_transaction_id;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_payment_requests_transaction_id_unique ON payment_requests(transaction_id);
 CREATE INDEX IF NOT EXISTS idx_audit_log_user_id ON audit_log(user_id);
 CREATE INDEX IF NOT EXISTS idx_audit_log_created_at ON audit_log(created_at DESC);
 
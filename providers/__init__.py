@@ -0,0 +1,33 @@
+from .base import (
+    BaseProvider, ProviderBusy, ProviderError, build_client, is_transient, never_sent, SUCCESS, PENDING, FAILED
+)
+from .breaker import AdaptiveLimiter, CircuitBreaker, CircuitOpen
+from .chapa import ChapaProvider
+from .fake import FakeProvider
+from .mpesa import MPesaProvider
+from .okx import OKXProvider
+from .registry import ProviderRegistry
+from .runtime import ProviderRuntime
+from .telebirr import TelebirrProvider
+
+__all__ = [
+    "AdaptiveLimiter",
+    "BaseProvider",
+    "build_client",
+    "ChapaProvider",
+    "CircuitBreaker",
+    "CircuitOpen",
+    "FakeProvider",
+    "is_transient",
+    "MPesaProvider",
+    "never_sent",
+    "OKXProvider",
+    "ProviderBusy",
+    "ProviderError",
+    "ProviderRegistry",
+    "ProviderRuntime",
+    "TelebirrProvider",
+    "SUCCESS",
+    "PENDING",
+    "FAILED",
+]
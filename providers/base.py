@@ -0,0 +1,165 @@
+import os
+import asyncio
+import httpx
+
+try:
+    import h2  # noqa: F401  (httpx needs it for HTTP/2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+# Normalized outcomes of a provider operation
+SUCCESS = "success"
+PENDING = "pending"
+FAILED = "failed"
+
+
+class ProviderError(Exception):
+    """
+    A provider rejected the request or could not be reached
+
+    `transient` marks provider-side trouble (5xx, gateway errors) as
+    opposed to a rejection of this particular request; only transient
+    errors count against the provider's circuit breaker. `unsent` marks
+    a request the provider turned away before acting on it (429).
+    """
+
+    def __init__(self, message, transient=False, unsent=False):
+        super().__init__(message)
+        self.transient = transient
+        self.unsent = unsent
+
+
+class ProviderBusy(Exception):
+    """The provider can't take the call right now; retry after `retry_after` seconds"""
+
+    def __init__(self, provider, retry_after=1.0):
+        super().__init__(provider)
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+def is_transient(exc):
+    """True if `exc` says the provider is unhealthy rather than the request bad"""
+    if isinstance(exc, ProviderError):
+        return exc.transient
+    return isinstance(exc, (httpx.TransportError, httpx.TimeoutException, asyncio.TimeoutError))
+
+
+def never_sent(exc):
+    """
+    True if `exc` proves the request never reached the provider
+
+    Read timeouts, dropped connections and 5xx replies may follow a
+    request the provider already acted on; only failures to connect and
+    explicit load shedding are safe to send again.
+    """
+    if isinstance(exc, ProviderError):
+        return exc.unsent
+    return isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def provider_setting(prefix, name, default):
+    """Read `{prefix}_{name}`, falling back to `PROVIDER_{name}`"""
+    return os.getenv(f"{prefix}_{name}", os.getenv(f"PROVIDER_{name}", default))
+
+
+def build_client(prefix="PROVIDER"):
+    """
+    Build a long-lived, connection-pooled HTTP client
+
+    Limits and timeouts come from `{prefix}_*` environment variables,
+    falling back to the shared PROVIDER_* values, e.g.
+    MPESA_MAX_CONNECTIONS overrides PROVIDER_MAX_CONNECTIONS.
+    """
+    def setting(name, default):
+        return provider_setting(prefix, name, default)
+
+    limits = httpx.Limits(
+        max_connections=int(setting("MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(setting("MAX_KEEPALIVE", "20")),
+        keepalive_expiry=float(setting("KEEPALIVE_EXPIRY", "30")),
+    )
+    timeout = httpx.Timeout(
+        float(setting("TIMEOUT", "10")),
+        connect=float(setting("CONNECT_TIMEOUT", "5")),
+        pool=float(setting("POOL_TIMEOUT", "5")),
+    )
+    http2 = setting("HTTP2", "true").lower() == "true" and HTTP2_AVAILABLE
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2)
+
+
+class BaseProvider:
+    """
+    Common interface for payment provider integrations
+
+    charge(), payout() and query_status() return a dict with a normalized
+    `status` (success / pending / failed), the provider-side `ref` to use
+    for later status queries, and the `raw` response. query_status() is
+    told which operation the ref belongs to, since providers look up
+    collections and payouts through different APIs. Requests the
+    provider rejects outright raise ProviderError.
+    """
+
+    # Prefix for per-provider client settings (see build_client)
+    env_prefix = "PROVIDER"
+
+    def __init__(self, client=None):
+        # Normally injected by ProviderRuntime; standalone instances still
+        # get their own long-lived client instead of one per call
+        self.client = client or build_client(self.env_prefix)
+
+    async def aclose(self):
+        """Close the underlying HTTP client"""
+        await self.client.aclose()
+
+    def parse_response(self, res):
+        """
+        Decode a provider's JSON reply
+
+        5xx and 429 mean the provider is unwell or shedding load, whatever
+        the body says, so they raise a transient ProviderError; they often
+        come from a gateway with an HTML body anyway. Other statuses are
+        returned decoded for the provider's own error fields.
+        """
+        name = type(self).__name__
+        if res.status_code >= 500 or res.status_code == 429:
+            raise ProviderError(
+                f"{name}: HTTP {res.status_code}", transient=True, unsent=res.status_code == 429
+            )
+        try:
+            return res.json()
+        except ValueError:
+            raise ProviderError(f"{name}: HTTP {res.status_code} with a non-JSON body")
+
+    @staticmethod
+    def result(status, ref, raw=None):
+        """Build a normalized provider result"""
+        return {"status": status, "ref": str(ref) if ref is not None else None, "raw": raw}
+
+    async def charge(self, tx_id, amount, currency, phone=None, **kwargs):
+        """Collect funds from the customer (deposit)"""
+        raise ProviderError(f"{type(self).__name__} does not support charges")
+
+    async def payout(self, tx_id, amount, currency, phone=None, **kwargs):
+        """Send funds to the customer (withdrawal)"""
+        raise ProviderError(f"{type(self).__name__} does not support payouts")
+
+    async def query_status(self, ref, operation="charge"):
+        """Look up the outcome of an earlier charge or payout by its ref"""
+        raise ProviderError(f"{type(self).__name__} does not support status queries")
+
+    @staticmethod
+    def reference(tx_id, operation="charge"):
+        """
+        Our reference for a tx's charge or payout, sent to the provider
+
+        Derived from the tx id only, so a resent request carries the same
+        reference and the provider can dedupe or look it up.
+        """
+        return f"MAH-{'PAYOUT-' if operation == 'payout' else ''}{tx_id}"
+
+    def verify_callback(self, data, signature):
+        """Check that a callback really came from the provider"""
+        return False
@@ -0,0 +1,148 @@
+import asyncio
+import time
+
+from prometheus_client import Counter, Gauge
+
+from .base import ProviderBusy
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CIRCUIT_TRANSITIONS = Counter(
+    "provider_circuit_transitions_total",
+    "Circuit breaker state changes per provider",
+    ["provider", "from_state", "to_state"],
+)
+CIRCUIT_STATE = Gauge(
+    "provider_circuit_state",
+    "Circuit breaker state per provider (0=closed, 1=half_open, 2=open)",
+    ["provider"],
+)
+CIRCUIT_REJECTIONS = Counter(
+    "provider_circuit_rejections_total",
+    "Calls fast-failed because the provider's circuit was open",
+    ["provider"],
+)
+CONCURRENCY_LIMIT = Gauge(
+    "provider_concurrency_limit",
+    "Current adaptive concurrency limit per provider",
+    ["provider"],
+)
+INFLIGHT = Gauge(
+    "provider_inflight_calls",
+    "Provider calls currently in flight",
+    ["provider"],
+)
+
+
+class CircuitOpen(ProviderBusy):
+    """Fast-fail: the provider's circuit is open"""
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker for one provider
+
+    closed -> open after `failure_threshold` transient failures in a row;
+    open -> half_open once `recovery_time` seconds have passed, letting
+    `half_open_calls` probes through; a successful probe closes the
+    circuit, a failed one opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=5, recovery_time=30.0, half_open_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        CIRCUIT_STATE.labels(name).set(_STATE_VALUES[CLOSED])
+
+    def _transition(self, state):
+        if state == self.state:
+            return
+        CIRCUIT_TRANSITIONS.labels(self.name, self.state, state).inc()
+        CIRCUIT_STATE.labels(self.name).set(_STATE_VALUES[state])
+        self.state = state
+        self.probes = 0
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+
+    def before_call(self):
+        """Raise CircuitOpen unless a call may go through right now"""
+        if self.state == OPEN:
+            remaining = self.opened_at + self.recovery_time - time.monotonic()
+            if remaining > 0:
+                CIRCUIT_REJECTIONS.labels(self.name).inc()
+                raise CircuitOpen(self.name, retry_after=remaining)
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self.probes >= self.half_open_calls:
+                CIRCUIT_REJECTIONS.labels(self.name).inc()
+                raise CircuitOpen(self.name, retry_after=min(self.recovery_time, 1.0))
+            self.probes += 1
+
+    def cancel_call(self):
+        """The call admitted by before_call() never reached the provider"""
+        if self.state == HALF_OPEN and self.probes:
+            self.probes -= 1
+
+    def record_success(self):
+        self.failures = 0
+        self._transition(CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self._transition(OPEN)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit for one provider
+
+    Each successful call under `latency_target` (if set) grows the limit by
+    1/limit, i.e. roughly +1 per window of calls; a transient failure or a
+    slow call multiplies it by `backoff`. Callers that can't get a slot
+    within `timeout` seconds get ProviderBusy.
+    """
+
+    def __init__(self, name, initial=20, min_limit=1, max_limit=200, backoff=0.5, latency_target=None):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_target = latency_target
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.inflight = 0
+        self._cond = asyncio.Condition()
+        CONCURRENCY_LIMIT.labels(name).set(self.limit)
+
+    async def acquire(self, timeout):
+        async with self._cond:
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: self.inflight < int(self.limit)),
+                    timeout=timeout,
+                )
+            except asyncio.TimeoutError:
+                raise ProviderBusy(self.name, retry_after=timeout)
+            self.inflight += 1
+            INFLIGHT.labels(self.name).set(self.inflight)
+
+    async def release(self, ok, latency):
+        """Free a slot; `ok` None (call cancelled) leaves the limit alone"""
+        async with self._cond:
+            self.inflight -= 1
+            INFLIGHT.labels(self.name).set(self.inflight)
+            if ok and (self.latency_target is None or latency <= self.latency_target):
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            elif ok is not None:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+            CONCURRENCY_LIMIT.labels(self.name).set(self.limit)
+            self._cond.notify_all()
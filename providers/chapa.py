@@ -1,11 +1,20 @@
 import os
-import httpx
+import time
+import hmac
+import hashlib
+import json
 
-class ChapaProvider:
+from .base import BaseProvider, ProviderError, SUCCESS, PENDING, FAILED
+
+class ChapaProvider(BaseProvider):
     """Chapa Payment Integration"""
     
-    def __init__(self):
+    env_prefix = "CHAPA"
+    
+    def __init__(self, client=None):
+        super().__init__(client)
         self.secret = os.getenv("CHAPA_SECRET")
+        self.webhook_secret = os.getenv("CHAPA_WEBHOOK_SECRET", "")
         self.base_url = "https://api.chapa.co/v1"
 
     async def create_charge(self, tx_id, amount, currency="ETB", email=None, phone=None):
@@ -13,7 +22,7 @@ class ChapaProvider:
         payload = {
             "amount": str(amount),
             "currency": currency,
-            "tx_ref": f"MAH-{tx_id}",
+            "tx_ref": self.reference(tx_id),
             "callback_url": os.getenv("CHAPA_CALLBACK"),
             "return_url": os.getenv("CHAPA_RETURN_URL"),
             "customization": {
@@ -27,50 +36,96 @@ class ChapaProvider:
         if phone:
             payload["phone_number"] = phone
         
-        async with httpx.AsyncClient() as client:
-            res = await client.post(
-                f"{self.base_url}/transaction/initialize",
-                json=payload,
-                headers={"Authorization": f"Bearer {self.secret}"}
-            )
+        res = await self.client.post(
+            f"{self.base_url}/transaction/initialize",
+            json=payload,
+            headers={"Authorization": f"Bearer {self.secret}"}
+        )
         
-        return res.json()
+        return self.parse_response(res)
 
     async def verify_payment(self, tx_ref):
         """Verify payment status"""
-        async with httpx.AsyncClient() as client:
-            res = await client.get(
-                f"{self.base_url}/transaction/verify/{tx_ref}",
-                headers={"Authorization": f"Bearer {self.secret}"}
-            )
+        res = await self.client.get(
+            f"{self.base_url}/transaction/verify/{tx_ref}",
+            headers={"Authorization": f"Bearer {self.secret}"}
+        )
         
-        return res.json()
+        return self.parse_response(res)
 
     async def get_banks(self):
         """Get list of supported banks"""
-        async with httpx.AsyncClient() as client:
-            res = await client.get(
-                f"{self.base_url}/banks",
-                headers={"Authorization": f"Bearer {self.secret}"}
-            )
+        res = await self.client.get(
+            f"{self.base_url}/banks",
+            headers={"Authorization": f"Bearer {self.secret}"}
+        )
         
-        return res.json()
+        return self.parse_response(res)
 
-    async def transfer(self, account_number, bank_code, amount, currency="ETB"):
+    async def transfer(self, account_number, bank_code, amount, currency="ETB", reference=None):
         """Transfer funds to bank account"""
         payload = {
             "account_number": account_number,
             "bank_code": bank_code,
             "amount": str(amount),
             "currency": currency,
-            "reference": f"MAH-TRANSFER-{int(time.time())}"
+            "reference": reference or f"MAH-TRANSFER-{int(time.time())}"
         }
         
-        async with httpx.AsyncClient() as client:
-            res = await client.post(
-                f"{self.base_url}/transfers",
-                json=payload,
-                headers={"Authorization": f"Bearer {self.secret}"}
-            )
+        res = await self.client.post(
+            f"{self.base_url}/transfers",
+            json=payload,
+            headers={"Authorization": f"Bearer {self.secret}"}
+        )
+        
+        return self.parse_response(res)
+
+    async def verify_transfer(self, reference):
+        """Verify transfer status"""
+        res = await self.client.get(
+            f"{self.base_url}/transfers/verify/{reference}",
+            headers={"Authorization": f"Bearer {self.secret}"}
+        )
         
-        return res.json()
+        return self.parse_response(res)
+
+    async def charge(self, tx_id, amount, currency, phone=None, **kwargs):
+        """Deposit via hosted checkout; completes when the customer pays"""
+        data = await self.create_charge(tx_id, amount, currency, kwargs.get("email"), phone)
+        if data.get("status") != "success":
+            raise ProviderError(data.get("message") or str(data))
+        return self.result(PENDING, self.reference(tx_id), data)
+
+    async def payout(self, tx_id, amount, currency, phone=None, **kwargs):
+        """Withdrawal to a bank account (`account_number`, `bank_code`)"""
+        account_number = kwargs.get("account_number") or phone
+        bank_code = kwargs.get("bank_code")
+        if not account_number or not bank_code:
+            raise ProviderError("Chapa payouts need account_number and bank_code")
+        reference = self.reference(tx_id, "payout")
+        data = await self.transfer(account_number, bank_code, amount, currency, reference)
+        if data.get("status") != "success":
+            raise ProviderError(data.get("message") or str(data))
+        return self.result(PENDING, reference, data)
+
+    async def query_status(self, ref, operation="charge"):
+        if operation == "payout":
+            data = await self.verify_transfer(ref)
+        else:
+            data = await self.verify_payment(ref)
+        status = str((data.get("data") or {}).get("status", "")).lower()
+        if status == "success":
+            return self.result(SUCCESS, ref, data)
+        if status in ("failed", "cancelled"):
+            return self.result(FAILED, ref, data)
+        return self.result(PENDING, ref, data)
+
+    def verify_callback(self, data, signature):
+        """Check the HMAC-SHA256 webhook signature (raw body or parsed JSON)"""
+        if not self.webhook_secret or not signature:
+            return False
+        body = data if isinstance(data, (bytes, str)) else json.dumps(data, separators=(",", ":"))
+        if isinstance(body, str):
+            body = body.encode()
+        expected = hmac.new(self.webhook_secret.encode(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature)
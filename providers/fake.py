@@ -0,0 +1,53 @@
+import os
+import hmac
+import hashlib
+import json
+
+from .base import BaseProvider, ProviderError
+
+
+class FakeProvider(BaseProvider):
+    """
+    Provider stand-in that talks to providers/fake_server.py
+
+    Used for local development and tests: set FAKE_PROVIDER_URL and the
+    registry routes every provider name to an instance of this class, so
+    the full HTTP path (pooling, timeouts, dispatch) is exercised without
+    real credentials.
+    """
+    
+    env_prefix = "FAKE_PROVIDER"
+    name = "fake"
+    base_url = None
+    
+    def __init__(self, client=None):
+        super().__init__(client)
+        self.base_url = (self.base_url or os.getenv("FAKE_PROVIDER_URL", "http://localhost:8099")).rstrip("/")
+        self.secret = os.getenv("FAKE_PROVIDER_SECRET", "fake-secret")
+
+    async def _call(self, method, path, **kwargs):
+        res = await self.client.request(method, f"{self.base_url}{path}", **kwargs)
+        data = self.parse_response(res)
+        if res.status_code >= 400:
+            raise ProviderError(data.get("error") or f"HTTP {res.status_code}")
+        return self.result(data["status"], data.get("ref"), data)
+
+    async def charge(self, tx_id, amount, currency, phone=None, **kwargs):
+        return await self._call("POST", "/charge", json={
+            "provider": self.name, "tx_id": tx_id, "ref": self.reference(tx_id, "charge"),
+            "amount": str(amount), "currency": currency, "phone": phone
+        })
+
+    async def payout(self, tx_id, amount, currency, phone=None, **kwargs):
+        return await self._call("POST", "/payout", json={
+            "provider": self.name, "tx_id": tx_id, "ref": self.reference(tx_id, "payout"),
+            "amount": str(amount), "currency": currency, "phone": phone
+        })
+
+    async def query_status(self, ref, operation="charge"):
+        return await self._call("GET", f"/status/{ref}")
+
+    def verify_callback(self, data, signature):
+        body = json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+        expected = hmac.new(self.secret.encode(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or "")
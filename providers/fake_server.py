@@ -0,0 +1,131 @@
+"""
+Local fake payment provider for development and tests
+
+    python -m providers.fake_server --port 8099 --latency 0.1 --failure-rate 0.05
+
+Accepts POST /charge and POST /payout and answers GET /status/<ref>, with
+configurable latency, failure rate and share of `pending` and `failed`
+outcomes, so the worker can be exercised end to end (including slow or
+failing partners) without touching real provider APIs.
+
+Operations are stored under the reference the client sends (derived
+from the tx id, see BaseProvider.reference), so a resent request is
+answered with the stored outcome and a status query by that reference
+finds it. `--lost-reply-rate` carries out an operation but answers 502,
+the ambiguous case the worker resolves by querying the reference.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    # Filled in by serve()
+    latency = 0.0
+    failure_rate = 0.0
+    pending_rate = 0.0
+    reject_rate = 0.0
+    lost_reply_rate = 0.0
+    operations = {}
+    lock = threading.Lock()
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _simulate(self):
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        return random.random() >= self.failure_rate
+
+    def do_POST(self):
+        if self.path not in ("/charge", "/payout"):
+            return self._reply(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not self._simulate():
+            return self._reply(502, {"status": "failed", "error": "simulated provider failure"})
+
+        ref = body.get("ref") or f"{body.get('provider', 'fake')}-{uuid.uuid4().hex[:12]}"
+        with self.lock:
+            op = self.operations.get(ref)
+            if op is None:
+                # First request for this reference; resends get its outcome
+                if random.random() < self.reject_rate:
+                    status = "failed"
+                elif random.random() < self.pending_rate:
+                    status = "pending"
+                else:
+                    status = "success"
+                op = self.operations[ref] = dict(body, status=status)
+        if random.random() < self.lost_reply_rate:
+            return self._reply(502, {"status": "failed", "error": "simulated lost reply"})
+        self._reply(200, {"status": op["status"], "ref": ref, "tx_id": body.get("tx_id")})
+
+    def do_GET(self):
+        if self.path == "/health":
+            return self._reply(200, {"status": "ok"})
+        if not self.path.startswith("/status/"):
+            return self._reply(404, {"error": "not found"})
+        if not self._simulate():
+            return self._reply(502, {"status": "failed", "error": "simulated provider failure"})
+
+        ref = self.path[len("/status/"):]
+        with self.lock:
+            op = self.operations.get(ref)
+            if op is None:
+                return self._reply(404, {"status": "failed", "error": "unknown ref"})
+            # Pending operations settle on the first status query
+            if op["status"] == "pending":
+                op["status"] = "success"
+        self._reply(200, {"status": op["status"], "ref": ref})
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def serve(host="127.0.0.1", port=8099, latency=0.0, failure_rate=0.0, pending_rate=0.0,
+          reject_rate=0.0, lost_reply_rate=0.0):
+    """Start the fake provider in a background thread; returns the server"""
+    handler = type("Handler", (FakeProviderHandler,), {
+        "latency": latency,
+        "failure_rate": failure_rate,
+        "pending_rate": pending_rate,
+        "reject_rate": reject_rate,
+        "lost_reply_rate": lost_reply_rate,
+        "operations": {},
+        "lock": threading.Lock(),
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake payment provider")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.1, help="mean seconds per call")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--pending-rate", type=float, default=0.0)
+    parser.add_argument("--reject-rate", type=float, default=0.0)
+    parser.add_argument("--lost-reply-rate", type=float, default=0.0, help="act, then answer 502")
+    args = parser.parse_args()
+
+    server = serve(
+        args.host, args.port, args.latency, args.failure_rate, args.pending_rate,
+        args.reject_rate, args.lost_reply_rate
+    )
+    print(f"Fake provider listening on {args.host}:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
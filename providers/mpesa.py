@@ -1,13 +1,17 @@
 import os
 import time
 import base64
-import httpx
 from typing import Dict
 
-class MPesaProvider:
+from .base import BaseProvider, ProviderError, SUCCESS, PENDING, FAILED
+
+class MPesaProvider(BaseProvider):
     """MPesa Daraja API Integration"""
     
-    def __init__(self):
+    env_prefix = "MPESA"
+    
+    def __init__(self, client=None):
+        super().__init__(client)
         self.consumer_key = os.getenv("MPESA_API_KEY")
         self.consumer_secret = os.getenv("MPESA_API_SECRET")
         self.short_code = os.getenv("MPESA_SHORTCODE")
@@ -25,13 +29,12 @@ class MPesaProvider:
             f"{self.consumer_key}:{self.consumer_secret}".encode()
         ).decode()
         
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(
-                self.base + "/oauth/v1/generate?grant_type=client_credentials",
-                headers={"Authorization": f"Basic {auth}"}
-            )
+        resp = await self.client.get(
+            self.base + "/oauth/v1/generate?grant_type=client_credentials",
+            headers={"Authorization": f"Basic {auth}"}
+        )
         
-        data = resp.json()
+        data = self.parse_response(resp)
         self._token = data["access_token"]
         self._token_expiry = time.time() + 3400
         return self._token
@@ -58,20 +61,20 @@ class MPesaProvider:
             "TransactionDesc": "MahavabaPay Deposit"
         }
 
-        async with httpx.AsyncClient() as client:
-            res = await client.post(
-                self.base + "/mpesa/stkpush/v1/processrequest",
-                json=payload,
-                headers={"Authorization": f"Bearer {token}"}
-            )
+        res = await self.client.post(
+            self.base + "/mpesa/stkpush/v1/processrequest",
+            json=payload,
+            headers={"Authorization": f"Bearer {token}"}
+        )
         
-        return res.json()
+        return self.parse_response(res)
 
     async def b2c_payment(self, amount, phone, tx_id):
         """Business to Customer payment for withdrawal"""
         token = await self._get_token()
         
         payload = {
+            "OriginatorConversationID": self.reference(tx_id, "payout"),
             "InitiatorName": "testapi",
             "SecurityCredential": "your_security_credential",
             "CommandID": "BusinessPayment",
@@ -84,16 +87,108 @@ class MPesaProvider:
             "Occasion": str(tx_id)
         }
         
-        async with httpx.AsyncClient() as client:
-            res = await client.post(
-                self.base + "/mpesa/b2c/v1/paymentrequest",
-                json=payload,
-                headers={"Authorization": f"Bearer {token}"}
-            )
+        res = await self.client.post(
+            self.base + "/mpesa/b2c/v1/paymentrequest",
+            json=payload,
+            headers={"Authorization": f"Bearer {token}"}
+        )
         
-        return res.json()
+        return self.parse_response(res)
+
+    async def stk_query(self, checkout_request_id):
+        """Query the status of an STK Push"""
+        token = await self._get_token()
+        timestamp = time.strftime("%Y%m%d%H%M%S")
+        password = base64.b64encode(
+            f"{self.short_code}{self.passkey}{timestamp}".encode()
+        ).decode()
+
+        payload = {
+            "BusinessShortCode": self.short_code,
+            "Password": password,
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id
+        }
+
+        res = await self.client.post(
+            self.base + "/mpesa/stkpushquery/v1/query",
+            json=payload,
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        
+        return self.parse_response(res)
+
+    async def transaction_status(self, originator_conversation_id):
+        """Query the status of a B2C payment by our OriginatorConversationID"""
+        token = await self._get_token()
+        
+        payload = {
+            "Initiator": "testapi",
+            "SecurityCredential": "your_security_credential",
+            "CommandID": "TransactionStatusQuery",
+            "TransactionID": "",
+            "OriginalConversationID": originator_conversation_id,
+            "PartyA": self.short_code,
+            "IdentifierType": "4",
+            "ResultURL": os.getenv("MPESA_RESULT_URL"),
+            "QueueTimeOutURL": os.getenv("MPESA_TIMEOUT_URL"),
+            "Remarks": "MahavabaPay Withdrawal Status",
+            "Occasion": originator_conversation_id
+        }
+        
+        res = await self.client.post(
+            self.base + "/mpesa/transactionstatus/v1/query",
+            json=payload,
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        
+        return self.parse_response(res)
 
     async def confirm(self, mpesa_receipt_number):
         """Verify transaction status"""
         # Implement transaction status query
         return {"status": "success"}
+
+    async def charge(self, tx_id, amount, currency, phone=None, **kwargs):
+        """Deposit via STK Push; completes when the customer approves"""
+        data = await self.stk_push(amount, phone, tx_id)
+        if data.get("ResponseCode") != "0":
+            raise ProviderError(data.get("errorMessage") or data.get("ResponseDescription") or str(data))
+        return self.result(PENDING, data.get("CheckoutRequestID"), data)
+
+    async def payout(self, tx_id, amount, currency, phone=None, **kwargs):
+        """Withdrawal via B2C; the outcome arrives on the result URL"""
+        data = await self.b2c_payment(amount, phone, tx_id)
+        if data.get("ResponseCode") != "0":
+            raise ProviderError(data.get("errorMessage") or data.get("ResponseDescription") or str(data))
+        return self.result(PENDING, data.get("OriginatorConversationID") or self.reference(tx_id, "payout"), data)
+
+    async def query_status(self, ref, operation="charge"):
+        if operation == "payout":
+            return await self.payout_status(ref)
+        data = await self.stk_query(ref)
+        if "ResultCode" not in data:
+            # Still being processed on the customer's handset
+            return self.result(PENDING, ref, data)
+        return self.result(SUCCESS if str(data["ResultCode"]) == "0" else FAILED, ref, data)
+
+    async def payout_status(self, ref):
+        """
+        B2C outcome via the Transaction Status API
+
+        Daraja usually acknowledges the query and posts the result to
+        MPESA_RESULT_URL; only a reply that already carries a Result
+        settles the payout here, anything else stays pending.
+        """
+        data = await self.transaction_status(ref)
+        result = data.get("Result") or {}
+        if "ResultCode" not in result:
+            if data.get("ResponseCode") not in (None, "0"):
+                raise ProviderError(data.get("errorMessage") or data.get("ResponseDescription") or str(data))
+            return self.result(PENDING, ref, data)
+        return self.result(SUCCESS if str(result["ResultCode"]) == "0" else FAILED, ref, data)
+
+    def verify_callback(self, data, signature=None):
+        """Daraja callbacks are unsigned (secure them by source IP); check the shape"""
+        callback = (data or {}).get("Body", {}).get("stkCallback")
+        return bool(callback) and "CheckoutRequestID" in callback
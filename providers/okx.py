@@ -2,14 +2,18 @@ import os
 import hmac
 import hashlib
 import time
-import httpx
 import base64
 import json
 
-class OKXProvider:
+from .base import BaseProvider, ProviderError, SUCCESS, PENDING, FAILED
+
+class OKXProvider(BaseProvider):
     """OKX Exchange Integration"""
     
-    def __init__(self):
+    env_prefix = "OKX"
+    
+    def __init__(self, client=None):
+        super().__init__(client)
         self.key = os.getenv("OKX_API_KEY")
         self.secret = os.getenv("OKX_API_SECRET")
         self.passphrase = os.getenv("OKX_PASSPHRASE")
@@ -35,50 +39,51 @@ class OKXProvider:
         
         sign = self._sign(timestamp, "GET", request_path)
         
-        async with httpx.AsyncClient() as client:
-            res = await client.get(
-                self.base_url + request_path,
-                headers={
-                    "OK-ACCESS-KEY": self.key,
-                    "OK-ACCESS-SIGN": sign,
-                    "OK-ACCESS-TIMESTAMP": timestamp,
-                    "OK-ACCESS-PASSPHRASE": self.passphrase,
-                    "Content-Type": "application/json"
-                }
-            )
-        
-        return res.json()
+        res = await self.client.get(
+            self.base_url + request_path,
+            headers={
+                "OK-ACCESS-KEY": self.key,
+                "OK-ACCESS-SIGN": sign,
+                "OK-ACCESS-TIMESTAMP": timestamp,
+                "OK-ACCESS-PASSPHRASE": self.passphrase,
+                "Content-Type": "application/json"
+            }
+        )
+        
+        return self.parse_response(res)
 
-    async def withdraw(self, amount, to_address, currency="USDT", chain="TRC20"):
+    async def withdraw(self, amount, to_address, currency="USDT", chain="TRC20", client_id=None):
         """Withdraw cryptocurrency"""
         timestamp = str(time.time())
         request_path = "/api/v5/asset/withdrawal"
         
-        body = json.dumps({
+        payload = {
             "ccy": currency,
             "amt": str(amount),
             "dest": "4",  # On-chain withdrawal
             "toAddr": to_address,
             "chain": chain,
             "fee": "1"
-        })
+        }
+        if client_id:
+            payload["clientId"] = client_id
+        body = json.dumps(payload)
         
         sign = self._sign(timestamp, "POST", request_path, body)
         
-        async with httpx.AsyncClient() as client:
-            res = await client.post(
-                self.base_url + request_path,
-                headers={
-                    "OK-ACCESS-KEY": self.key,
-                    "OK-ACCESS-SIGN": sign,
-                    "OK-ACCESS-TIMESTAMP": timestamp,
-                    "OK-ACCESS-PASSPHRASE": self.passphrase,
-                    "Content-Type": "application/json"
-                },
-                content=body
-            )
-        
-        return res.json()
+        res = await self.client.post(
+            self.base_url + request_path,
+            headers={
+                "OK-ACCESS-KEY": self.key,
+                "OK-ACCESS-SIGN": sign,
+                "OK-ACCESS-TIMESTAMP": timestamp,
+                "OK-ACCESS-PASSPHRASE": self.passphrase,
+                "Content-Type": "application/json"
+            },
+            content=body
+        )
+        
+        return self.parse_response(res)
 
     async def place_order(self, symbol, side, amount, order_type="market"):
         """Place a trading order"""
@@ -95,26 +100,102 @@ class OKXProvider:
         
         sign = self._sign(timestamp, "POST", request_path, body)
         
-        async with httpx.AsyncClient() as client:
-            res = await client.post(
-                self.base_url + request_path,
-                headers={
-                    "OK-ACCESS-KEY": self.key,
-                    "OK-ACCESS-SIGN": sign,
-                    "OK-ACCESS-TIMESTAMP": timestamp,
-                    "OK-ACCESS-PASSPHRASE": self.passphrase,
-                    "Content-Type": "application/json"
-                },
-                content=body
-            )
-        
-        return res.json()
+        res = await self.client.post(
+            self.base_url + request_path,
+            headers={
+                "OK-ACCESS-KEY": self.key,
+                "OK-ACCESS-SIGN": sign,
+                "OK-ACCESS-TIMESTAMP": timestamp,
+                "OK-ACCESS-PASSPHRASE": self.passphrase,
+                "Content-Type": "application/json"
+            },
+            content=body
+        )
+        
+        return self.parse_response(res)
+
+    async def get_withdrawal_status(self, wd_id):
+        """Get the state of a withdrawal"""
+        return await self._get_signed(f"/api/v5/asset/deposit-withdraw-status?wdId={wd_id}")
+
+    async def get_withdrawal_history(self, client_id):
+        """Get a withdrawal by the clientId it was sent with"""
+        return await self._get_signed(f"/api/v5/asset/withdrawal-history?clientId={client_id}")
+
+    async def _get_signed(self, request_path):
+        timestamp = str(time.time())
+        
+        sign = self._sign(timestamp, "GET", request_path)
+        
+        res = await self.client.get(
+            self.base_url + request_path,
+            headers={
+                "OK-ACCESS-KEY": self.key,
+                "OK-ACCESS-SIGN": sign,
+                "OK-ACCESS-TIMESTAMP": timestamp,
+                "OK-ACCESS-PASSPHRASE": self.passphrase,
+                "Content-Type": "application/json"
+            }
+        )
+        
+        return self.parse_response(res)
 
     async def get_ticker(self, symbol):
         """Get ticker information"""
-        async with httpx.AsyncClient() as client:
-            res = await client.get(
-                f"{self.base_url}/api/v5/market/ticker?instId={symbol}"
-            )
+        res = await self.client.get(
+            f"{self.base_url}/api/v5/market/ticker?instId={symbol}"
+        )
         
-        return res.json()
+        return self.parse_response(res)
+
+    async def payout(self, tx_id, amount, currency, phone=None, **kwargs):
+        """On-chain withdrawal to `to_address`"""
+        to_address = kwargs.get("to_address")
+        if not to_address:
+            raise ProviderError("OKX payouts need a to_address")
+        data = await self.withdraw(
+            amount, to_address, currency, kwargs.get("chain", "TRC20"), self.reference(tx_id, "payout")
+        )
+        if data.get("code") != "0":
+            raise ProviderError(data.get("msg") or str(data))
+        # Accepted: a reply without a wdId is still a payout in flight,
+        # looked up later by the clientId it was sent with
+        rows = data.get("data")
+        row = rows[0] if isinstance(rows, list) and rows and isinstance(rows[0], dict) else {}
+        return self.result(PENDING, row.get("wdId") or self.reference(tx_id, "payout"), data)
+
+    @staticmethod
+    def reference(tx_id, operation="charge"):
+        # clientId: letters and digits only, up to 32
+        return f"MAH{'P' if operation == 'payout' else ''}{tx_id}"
+
+    async def query_status(self, ref, operation="payout"):
+        if str(ref).startswith(self.reference("", "payout")):
+            return await self._query_by_client_id(ref)
+        data = await self.get_withdrawal_status(ref)
+        if data.get("code") != "0":
+            raise ProviderError(data.get("msg") or str(data))
+        state = str((data.get("data") or [{}])[0].get("state", "")).lower()
+        if "success" in state or "completed" in state:
+            return self.result(SUCCESS, ref, data)
+        if "fail" in state or "cancel" in state:
+            return self.result(FAILED, ref, data)
+        return self.result(PENDING, ref, data)
+
+    async def _query_by_client_id(self, client_id):
+        """Outcome of a payout we only know our clientId for (reply never recorded)"""
+        data = await self.get_withdrawal_history(client_id)
+        if data.get("code") != "0":
+            raise ProviderError(data.get("msg") or str(data))
+        rows = data.get("data") or []
+        if not rows:
+            # Not (yet) known to OKX; resolved by later checks or review
+            return self.result(PENDING, client_id, data)
+        # state: -2 canceled, -1 failed, 2 success, anything else in progress
+        state = str(rows[0].get("state", ""))
+        ref = rows[0].get("wdId") or client_id
+        if state == "2":
+            return self.result(SUCCESS, ref, data)
+        if state in ("-1", "-2"):
+            return self.result(FAILED, ref, data)
+        return self.result(PENDING, ref, data)
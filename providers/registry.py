@@ -0,0 +1,134 @@
+import os
+import time
+from contextlib import asynccontextmanager
+
+from .base import ProviderError, is_transient, provider_setting
+from .breaker import AdaptiveLimiter, CircuitBreaker
+from .fake import FakeProvider
+from .runtime import PROVIDER_CLASSES, ProviderRuntime
+
+
+class ProviderRegistry:
+    """
+    Routes payment operations to providers by name
+
+    Each provider gets its own circuit breaker and AIMD concurrency limit
+    ({PREFIX}_CONCURRENCY is the starting limit, default
+    PROVIDER_CONCURRENCY), so a slow or failing partner can only tie up
+    its own share of in-flight calls. An open circuit fails fast with
+    CircuitOpen; a limit that stays full for PROVIDER_ACQUIRE_TIMEOUT
+    seconds raises ProviderBusy. Both carry `retry_after` so the caller
+    can park the job instead of a worker slot.
+
+    With FAKE_PROVIDER_URL set, every name resolves to a FakeProvider
+    pointed at providers/fake_server.py.
+    """
+
+    def __init__(self, runtime=None, fake_url=None):
+        fake_url = fake_url if fake_url is not None else os.getenv("FAKE_PROVIDER_URL")
+        if fake_url:
+            # Keep each name's env prefix so pool settings still apply
+            classes = {
+                name: type(f"Fake{cls.__name__}", (FakeProvider,), {
+                    "env_prefix": cls.env_prefix, "name": name, "base_url": fake_url
+                })
+                for name, cls in PROVIDER_CLASSES.items()
+            }
+        else:
+            classes = PROVIDER_CLASSES
+        self.runtime = runtime or ProviderRuntime(classes)
+        self.acquire_timeout = float(os.getenv("PROVIDER_ACQUIRE_TIMEOUT", "1"))
+        self._breakers = {}
+        self._limiters = {}
+
+    @property
+    def names(self):
+        return sorted(self.runtime.classes)
+
+    def get(self, name):
+        """Return the provider instance registered under `name`"""
+        if name not in self.runtime.classes:
+            raise ProviderError(f"Unknown provider: {name}")
+        return self.runtime.get(name)
+
+    def _setting(self, name, key, default):
+        return provider_setting(self.runtime.classes[name].env_prefix, key, default)
+
+    def breaker(self, name):
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                name,
+                failure_threshold=int(self._setting(name, "BREAKER_THRESHOLD", "5")),
+                recovery_time=float(self._setting(name, "BREAKER_RECOVERY", "30")),
+                half_open_calls=int(self._setting(name, "BREAKER_PROBES", "1")),
+            )
+            self._breakers[name] = breaker
+        return breaker
+
+    def limiter(self, name):
+        limiter = self._limiters.get(name)
+        if limiter is None:
+            target = self._setting(name, "LATENCY_TARGET", "")
+            limiter = AdaptiveLimiter(
+                name,
+                initial=int(self._setting(name, "CONCURRENCY", "20")),
+                min_limit=int(self._setting(name, "MIN_CONCURRENCY", "1")),
+                max_limit=int(self._setting(name, "MAX_CONCURRENCY", "200")),
+                latency_target=float(target) if target else None,
+            )
+            self._limiters[name] = limiter
+        return limiter
+
+    @asynccontextmanager
+    async def slot(self, name):
+        """Hold one of the provider's concurrency slots for a single call"""
+        breaker = self.breaker(name)
+        limiter = self.limiter(name)
+        breaker.before_call()
+        try:
+            await limiter.acquire(self.acquire_timeout)
+        except BaseException:
+            breaker.cancel_call()
+            raise
+        started = time.monotonic()
+        healthy = True
+        try:
+            yield
+        except Exception as e:
+            healthy = not is_transient(e)
+            raise
+        except BaseException:
+            # Cancelled (drain timeout, shutdown): says nothing about the
+            # provider, so free the slot without recording an outcome
+            healthy = None
+            raise
+        finally:
+            await limiter.release(healthy, time.monotonic() - started)
+            if healthy is None:
+                breaker.cancel_call()
+            elif healthy:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
+    async def charge(self, name, tx_id, amount, currency, phone=None, **kwargs):
+        provider = self.get(name)
+        async with self.slot(name):
+            return await provider.charge(tx_id, amount, currency, phone, **kwargs)
+
+    async def payout(self, name, tx_id, amount, currency, phone=None, **kwargs):
+        provider = self.get(name)
+        async with self.slot(name):
+            return await provider.payout(tx_id, amount, currency, phone, **kwargs)
+
+    async def query_status(self, name, ref, operation="charge"):
+        provider = self.get(name)
+        async with self.slot(name):
+            return await provider.query_status(ref, operation)
+
+    def verify_callback(self, name, data, signature):
+        return self.get(name).verify_callback(data, signature)
+
+    async def aclose(self):
+        await self.runtime.aclose()
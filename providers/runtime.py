@@ -0,0 +1,40 @@
+from .base import build_client
+from .chapa import ChapaProvider
+from .mpesa import MPesaProvider
+from .okx import OKXProvider
+from .telebirr import TelebirrProvider
+
+PROVIDER_CLASSES = {
+    "chapa": ChapaProvider,
+    "mpesa": MPesaProvider,
+    "okx": OKXProvider,
+    "telebirr": TelebirrProvider,
+}
+
+
+class ProviderRuntime:
+    """
+    Owns one pooled HTTP client and provider instance per provider
+
+    Create it once at service startup, fetch providers with get(), and
+    call aclose() on shutdown so keep-alive connections are released.
+    """
+
+    def __init__(self, classes=None):
+        self.classes = classes or PROVIDER_CLASSES
+        self._providers = {}
+
+    def get(self, name):
+        """Return the shared provider instance for `name`"""
+        provider = self._providers.get(name)
+        if provider is None:
+            cls = self.classes[name]
+            provider = cls(client=build_client(cls.env_prefix))
+            self._providers[name] = provider
+        return provider
+
+    async def aclose(self):
+        """Close every client opened by this runtime"""
+        providers, self._providers = self._providers, {}
+        for provider in providers.values():
+            await provider.aclose()
@@ -1,14 +1,18 @@
 import os
-import httpx
 import json
 import hashlib
 import base64
 import time
 
-class TelebirrProvider:
+from .base import BaseProvider, ProviderError, SUCCESS, PENDING, FAILED
+
+class TelebirrProvider(BaseProvider):
     """Telebirr Payment Integration"""
     
-    def __init__(self):
+    env_prefix = "TELEBIRR"
+    
+    def __init__(self, client=None):
+        super().__init__(client)
         self.app_id = os.getenv("TELEBIRR_APP_ID")
         self.app_key = os.getenv("TELEBIRR_APP_KEY")
         self.short_code = os.getenv("TELEBIRR_SHORTCODE")
@@ -35,14 +39,13 @@ class TelebirrProvider:
         }
         payload["signature"] = self._sign(payload)
 
-        async with httpx.AsyncClient() as client:
-            res = await client.post(
-                f"{self.base_url}/api/v1/init",
-                json=payload,
-                headers={"Content-Type": "application/json"}
-            )
+        res = await self.client.post(
+            f"{self.base_url}/api/v1/init",
+            json=payload,
+            headers={"Content-Type": "application/json"}
+        )
         
-        return res.json()
+        return self.parse_response(res)
 
     async def query_payment(self, tx_id):
         """Query payment status"""
@@ -53,14 +56,29 @@ class TelebirrProvider:
         }
         payload["signature"] = self._sign(payload)
 
-        async with httpx.AsyncClient() as client:
-            res = await client.post(
-                f"{self.base_url}/api/v1/query",
-                json=payload,
-                headers={"Content-Type": "application/json"}
-            )
+        res = await self.client.post(
+            f"{self.base_url}/api/v1/query",
+            json=payload,
+            headers={"Content-Type": "application/json"}
+        )
         
-        return res.json()
+        return self.parse_response(res)
+
+    async def charge(self, tx_id, amount, currency, phone=None, **kwargs):
+        """Deposit; completes when the customer pays on the returned page"""
+        data = await self.init_payment(amount, phone, tx_id)
+        if str(data.get("code")) not in ("0", "200"):
+            raise ProviderError(data.get("message") or str(data))
+        return self.result(PENDING, tx_id, data)
+
+    async def query_status(self, ref, operation="charge"):
+        data = await self.query_payment(ref)
+        trade_status = str((data.get("data") or {}).get("tradeStatus", "")).upper()
+        if trade_status in ("SUCCESS", "COMPLETED", "PAID"):
+            return self.result(SUCCESS, ref, data)
+        if trade_status in ("FAILED", "FAIL", "CLOSED", "EXPIRED"):
+            return self.result(FAILED, ref, data)
+        return self.result(PENDING, ref, data)
 
     def verify_callback(self, data: dict, signature: str):
         """Verify callback signature"""
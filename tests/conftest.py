@@ -0,0 +1,124 @@
+"""
+Integration fixtures: the bot and worker modules against a real Postgres and Redis
+
+Uses DATABASE_URL and REDIS_URL like the services do. The database is
+rebuilt from migrations/schema.sql once per session, so it must be a
+throwaway one: its name has to end in `_test`.
+"""
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+from sqlalchemy.engine import make_url
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT / "bot"), str(ROOT / "worker"), str(ROOT)]
+# aiogram checks the token's shape when the bot module creates its Bot
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test_token")
+
+
+@pytest.fixture(scope="session")
+def database_url():
+    url = os.getenv("DATABASE_URL")
+    if not url:
+        pytest.skip("DATABASE_URL is not set")
+    if not make_url(url).database.endswith("_test"):
+        pytest.skip("refusing to rebuild a database whose name doesn't end in _test")
+
+    import psycopg
+    dsn = make_url(url).set(drivername="postgresql").render_as_string(hide_password=False)
+    with psycopg.connect(dsn, autocommit=True) as conn:
+        conn.execute("DROP SCHEMA public CASCADE")
+        conn.execute("CREATE SCHEMA public")
+        conn.execute((ROOT / "migrations" / "schema.sql").read_text())
+    return url
+
+
+@pytest.fixture(scope="session")
+def app_module(database_url):
+    import redis
+
+    # Ids restart with the schema; balances cached under old ids must go
+    client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    for pattern in ("ledger:*", "idem:*"):
+        for key in client.scan_iter(match=pattern, count=1000):
+            client.delete(key)
+    client.close()
+
+    import app
+    return app
+
+
+@pytest_asyncio.fixture
+async def app(app_module):
+    """The bot module with a fresh Redis client, Postgres ledger and empty caches"""
+    from redis import asyncio as aioredis
+
+    app_module.redis = aioredis.from_url(app_module.REDIS_URL)
+    app_module.ledger = None
+    app_module.user_ids.clear()
+    app_module.wallet_ids.clear()
+    yield app_module
+    # aclose() from redis 5.0.1 on
+    await getattr(app_module.redis, "aclose", app_module.redis.close)()
+    # Pooled connections belong to this test's event loop
+    await app_module.engine.dispose()
+
+
+@pytest.fixture(scope="session")
+def worker_module(database_url):
+    import worker
+    return worker
+
+
+@pytest_asyncio.fixture
+async def worker(worker_module):
+    """The worker module; its pooled connections are dropped after the test"""
+    yield worker_module
+    await worker_module.engine.dispose()
+
+
+@pytest_asyncio.fixture
+async def queue():
+    """A ReliableQueue under keys no other test uses"""
+    from redis import asyncio as aioredis
+    from jobqueue import ReliableQueue
+
+    client = aioredis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    queue = ReliableQueue(client, f"test:{uuid.uuid4().hex}:queue")
+    yield queue
+    keys = [key async for key in client.scan_iter(match=f"{queue.queue_key}*")]
+    if keys:
+        await client.delete(*keys)
+    await getattr(client, "aclose", client.close)()
+
+
+@pytest.fixture
+def fake_provider():
+    """providers/fake_server.py on a free port; tune it through RequestHandlerClass"""
+    from providers.fake_server import serve
+
+    server = serve(port=0)
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest_asyncio.fixture
+async def registry(fake_provider):
+    """A ProviderRegistry routing every provider name to the fake server"""
+    from providers import ProviderRegistry
+
+    registry = ProviderRegistry(fake_url=fake_provider.url)
+    yield registry
+    await registry.aclose()
+
+
+@pytest.fixture
+def telegram_id():
+    """A Telegram id no other test uses"""
+    return lambda: uuid.uuid4().int % 10**12
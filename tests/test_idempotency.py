@@ -0,0 +1,111 @@
+from itertools import count
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+import pytest_asyncio
+import sqlalchemy as sa
+
+message_ids = count(1)
+
+
+def command(text, telegram_id, message_id=None):
+    return SimpleNamespace(
+        text=text,
+        message_id=message_id or next(message_ids),
+        chat=SimpleNamespace(id=telegram_id),
+        from_user=SimpleNamespace(id=telegram_id, username=None),
+        reply=AsyncMock()
+    )
+
+
+@pytest_asyncio.fixture
+async def user(app, telegram_id, monkeypatch):
+    """An onboarded Telegram id; enqueued payloads are collected, not sent"""
+    tg = telegram_id()
+    async with app.AsyncSessionLocal() as db:
+        await app.onboard_user(tg, db=db)
+    queued = []
+    monkeypatch.setattr(app, "enqueue_payment_request", AsyncMock(side_effect=queued.append))
+    return SimpleNamespace(telegram_id=tg, queued=queued)
+
+
+async def deposits(app, key):
+    async with app.AsyncSessionLocal() as db:
+        r = await db.execute(
+            sa.select(sa.func.count()).select_from(app.transactions)
+            .where(app.transactions.c.idempotency_key==key)
+        )
+        return r.scalar_one()
+
+
+@pytest.mark.asyncio
+async def test_redelivered_command_is_recorded_once(app, user):
+    message = command("/deposit 100 ETB", user.telegram_id)
+
+    await app.cmd_deposit(message)
+    await app.cmd_deposit(message)
+
+    assert len(user.queued) == 1
+    assert await deposits(app, user.queued[0]["idempotency_key"]) == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_insert_releases_the_claim(app, user, monkeypatch):
+    """A redelivery after a failed insert is processed, not taken for a duplicate"""
+    message = command("/deposit 250 ETB", user.telegram_id)
+    insert = app.insert_request_tx
+    monkeypatch.setattr(app, "insert_request_tx", AsyncMock(side_effect=ConnectionError("db down")))
+
+    with pytest.raises(ConnectionError):
+        await app.cmd_deposit(message)
+    assert user.queued == []
+
+    monkeypatch.setattr(app, "insert_request_tx", insert)
+    await app.cmd_deposit(message)
+
+    assert len(user.queued) == 1
+    assert await deposits(app, user.queued[0]["idempotency_key"]) == 1
+
+
+@pytest.mark.asyncio
+async def test_rejected_withdrawal_releases_the_double_tap_window(app, user):
+    """A withdrawal refused for funds can be sent again right away"""
+    await app.cmd_withdraw(command("/withdraw 50 ETB", user.telegram_id))
+    async with app.AsyncSessionLocal() as db:
+        await db.execute(
+            app.wallets.update().where(app.wallets.c.user_id==app.user_ids.get(user.telegram_id))
+            .values(balance=100)
+        )
+        await db.commit()
+
+    await app.cmd_withdraw(command("/withdraw 50 ETB", user.telegram_id))
+
+    assert len(user.queued) == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_enqueue_is_requeued_on_retry(app, user, monkeypatch):
+    """A retry after the job was lost re-enqueues the pending transaction"""
+    message = command("/withdraw 30 ETB", user.telegram_id)
+    async with app.AsyncSessionLocal() as db:
+        await db.execute(
+            app.wallets.update().where(app.wallets.c.user_id==app.user_ids.get(user.telegram_id))
+            .values(balance=100)
+        )
+        await db.commit()
+    enqueue = app.enqueue_payment_request
+    monkeypatch.setattr(app, "enqueue_payment_request", AsyncMock(side_effect=ConnectionError("redis down")))
+
+    with pytest.raises(ConnectionError):
+        await app.cmd_withdraw(message)
+
+    monkeypatch.setattr(app, "enqueue_payment_request", enqueue)
+    await app.cmd_withdraw(message)
+
+    assert len(user.queued) == 1
+    key = user.queued[0]["idempotency_key"]
+    assert await deposits(app, key) == 1
+    async with app.AsyncSessionLocal() as db:
+        r = await db.execute(sa.select(app.transactions.c.id).where(app.transactions.c.idempotency_key==key))
+        assert user.queued[0]["tx_id"] == r.scalar_one()
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from jobqueue import ReliableQueue
+
+
+def peer(queue, worker_id, heartbeat_ttl=30):
+    """Another worker on the same queue"""
+    return ReliableQueue(queue.redis, queue.queue_key, worker_id=worker_id, heartbeat_ttl=heartbeat_ttl)
+
+
+async def queued(queue):
+    return await queue.redis.lrange(queue.queue_key, 0, -1)
+
+
+async def processing(queue):
+    return await queue.redis.lrange(queue.processing_key, 0, -1)
+
+
+@pytest.mark.asyncio
+async def test_fetch_is_fifo_and_ack_forgets(queue):
+    for job in (b"1", b"2", b"3"):
+        await queue.redis.lpush(queue.queue_key, job)
+
+    assert await queue.fetch(1) == b"1"
+    assert await queue.fetch_batch(5, 1) == [b"2", b"3"]
+    assert await queued(queue) == []
+
+    await queue.ack(b"1")
+    await queue.ack_many([b"2", b"3"])
+    assert await processing(queue) == []
+    assert await queue.fetch(1) is None
+
+
+@pytest.mark.asyncio
+async def test_nack_hands_the_job_back(queue):
+    await queue.redis.lpush(queue.queue_key, b"job")
+    raw = await queue.fetch(1)
+
+    await queue.nack(raw)
+
+    assert await processing(queue) == []
+    assert await peer(queue, "other").fetch(1) == b"job"
+
+
+@pytest.mark.asyncio
+async def test_reaper_reclaims_jobs_of_dead_workers_only(queue):
+    """Jobs of a worker whose heartbeat expired go back; a live worker keeps its own"""
+    dead, alive, reaper = peer(queue, "dead", heartbeat_ttl=1), peer(queue, "alive"), peer(queue, "reaper")
+    for worker, job in ((dead, b"lost"), (alive, b"busy")):
+        await worker.heartbeat()
+        await queue.redis.lpush(queue.queue_key, job)
+        assert await worker.fetch(1) == job
+
+    await asyncio.sleep(1.1)
+    assert await reaper.reap(lock_ttl=1) == 1
+
+    assert await queued(queue) == [b"lost"]
+    assert await processing(dead) == []
+    assert await processing(alive) == [b"busy"]
+    # One reaper per lock window
+    await dead.fetch(1)
+    assert await peer(queue, "second").reap(lock_ttl=1) == 0
+
+
+@pytest.mark.asyncio
+async def test_deferred_job_comes_back_when_due(queue):
+    await queue.redis.lpush(queue.queue_key, b"later")
+    raw = await queue.fetch(1)
+
+    await queue.defer(raw, 0.3)
+
+    assert await processing(queue) == []
+    assert await queue.promote_due() == 0
+    assert await queue.next_due() is not None
+    await asyncio.sleep(0.35)
+    assert await queue.promote_due() == 1
+    assert await queue.next_due() is None
+    assert await queue.fetch(1) == b"later"
+
+
+@pytest.mark.asyncio
+async def test_lease_is_exclusive_to_its_holder(queue):
+    other = peer(queue, "other")
+
+    assert await queue.lease("tx:1", 30)
+    assert not await other.lease("tx:1", 30)
+    # Only the holder can give it up
+    await other.unlease("tx:1")
+    assert not await other.lease("tx:1", 30)
+    await queue.unlease("tx:1")
+    assert await other.lease("tx:1", 30)
+
+
+@pytest.mark.asyncio
+async def test_release_requeues_unacked_jobs_on_shutdown(queue):
+    await queue.heartbeat()
+    for job in (b"1", b"2"):
+        await queue.redis.lpush(queue.queue_key, job)
+    await queue.fetch_batch(2, 1)
+
+    assert await queue.release() == 2
+
+    assert await processing(queue) == []
+    assert not await queue.redis.exists(queue.heartbeat_key)
+    assert await queue.fetch_batch(2, 1) == [b"1", b"2"]
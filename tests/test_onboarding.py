@@ -0,0 +1,50 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+import sqlalchemy as sa
+
+STARTS = 25
+
+
+def start_message(telegram_id, username="storm"):
+    return SimpleNamespace(
+        from_user=SimpleNamespace(id=telegram_id, username=username),
+        reply=AsyncMock()
+    )
+
+
+async def count(app, table, cond):
+    async with app.AsyncSessionLocal() as db:
+        r = await db.execute(sa.select(sa.func.count()).select_from(table).where(cond))
+        return r.scalar_one()
+
+
+@pytest.mark.asyncio
+async def test_parallel_start_creates_one_user_and_wallet(app, telegram_id):
+    """A /start storm for one user: no IntegrityError, one user, one wallet"""
+    tg = telegram_id()
+    messages = [start_message(tg) for _ in range(STARTS)]
+
+    await asyncio.gather(*(app.cmd_start(m) for m in messages))
+
+    assert all(m.reply.await_count == 1 for m in messages)
+    assert await count(app, app.users, app.users.c.telegram_id==tg) == 1
+    uid = app.user_ids.get(tg)
+    assert await count(app, app.wallets, app.wallets.c.user_id==uid) == 1
+
+
+@pytest.mark.asyncio
+async def test_parallel_onboarding_returns_the_same_rows(app, telegram_id):
+    """Every concurrent onboard_user call gets the winner's user and wallet"""
+    tg = telegram_id()
+
+    async def onboard():
+        async with app.AsyncSessionLocal() as db:
+            return await app.onboard_user(tg, "storm", db=db)
+
+    results = await asyncio.gather(*(onboard() for _ in range(STARTS)))
+
+    assert len({user['id'] for user, _ in results}) == 1
+    assert len({wallet['id'] for _, wallet in results}) == 1
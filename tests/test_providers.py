@@ -0,0 +1,69 @@
+import asyncio
+
+import httpx
+import pytest
+
+from providers import CircuitOpen, OKXProvider, ProviderError
+
+
+@pytest.mark.asyncio
+async def test_breaker_opens_and_half_opens(registry, fake_provider, monkeypatch):
+    monkeypatch.setenv("MPESA_BREAKER_THRESHOLD", "2")
+    monkeypatch.setenv("MPESA_BREAKER_RECOVERY", "0.3")
+    handler = fake_provider.RequestHandlerClass
+    breaker = registry.breaker("mpesa")
+
+    handler.failure_rate = 1.0
+    for tx_id in (1, 2):
+        with pytest.raises(ProviderError) as e:
+            await registry.charge("mpesa", tx_id, "10", "ETB")
+        assert e.value.transient
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpen):
+        await registry.charge("mpesa", 3, "10", "ETB")
+    assert "MAH-3" not in handler.operations
+
+    # After the recovery time one probe goes through; the rest still fail fast
+    handler.failure_rate = 0.0
+    handler.latency = 0.2
+    await asyncio.sleep(0.3)
+    probe = asyncio.create_task(registry.charge("mpesa", 4, "10", "ETB"))
+    await asyncio.sleep(0.05)
+    assert breaker.state == "half_open"
+    with pytest.raises(CircuitOpen):
+        await registry.charge("mpesa", 5, "10", "ETB")
+
+    assert (await probe)["status"] == "success"
+    assert breaker.state == "closed"
+    assert (await registry.charge("mpesa", 5, "10", "ETB"))["ref"] == "MAH-5"
+
+
+@pytest.mark.asyncio
+async def test_resent_reference_gets_its_first_outcome(registry, fake_provider):
+    handler = fake_provider.RequestHandlerClass
+    handler.reject_rate = 1.0
+    assert await registry.payout("mpesa", 9, "10", "ETB") == {
+        "status": "failed", "ref": "MAH-PAYOUT-9", "raw": {"status": "failed", "ref": "MAH-PAYOUT-9", "tx_id": 9}
+    }
+
+    handler.reject_rate = 0.0
+    assert (await registry.payout("mpesa", 9, "10", "ETB"))["status"] == "failed"
+    assert (await registry.query_status("mpesa", "MAH-PAYOUT-9", "payout"))["status"] == "failed"
+    with pytest.raises(ProviderError):
+        await registry.query_status("mpesa", "MAH-PAYOUT-10", "payout")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("reply", [{"code": "0", "data": []}, {"code": "0"}, {"code": "0", "data": [None]}])
+async def test_accepted_okx_payout_without_wd_id_stays_pending(reply, monkeypatch):
+    """An accepted withdrawal is never an error: it is followed up by its clientId"""
+    for name in ("OKX_API_KEY", "OKX_API_SECRET", "OKX_PASSPHRASE"):
+        monkeypatch.setenv(name, "test")
+    okx = OKXProvider(client=httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(200, json=reply))
+    ))
+
+    result = await okx.payout(5, "12", "USDT", to_address="TAddr")
+
+    assert (result["status"], result["ref"]) == ("pending", "MAHP5")
+    await okx.aclose()
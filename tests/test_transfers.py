@@ -0,0 +1,139 @@
+import asyncio
+from decimal import Decimal
+
+import pytest
+import sqlalchemy as sa
+
+from ledger import AtomicLedger
+from ledger.atomic import bucket
+
+SENDERS = 40
+
+
+async def make_wallet(app, telegram_id, balance=Decimal("0")):
+    async with app.AsyncSessionLocal() as db:
+        _, wallet = await app.onboard_user(telegram_id(), db=db)
+        await db.execute(
+            app.wallets.update().where(app.wallets.c.id==wallet['id']).values(balance=balance)
+        )
+        await db.commit()
+        r = await db.execute(sa.select(app.wallets).where(app.wallets.c.id==wallet['id']))
+        return r.one()._mapping
+
+
+async def send(app, sender, recipient, amount):
+    async with app.AsyncSessionLocal() as db:
+        return await app.transfer_funds(sender, recipient, amount, db=db)
+
+
+async def balance_of(app, wallet):
+    async with app.AsyncSessionLocal() as db:
+        r = await db.execute(sa.select(app.wallets.c.balance).where(app.wallets.c.id==wallet['id']))
+        return r.scalar_one()
+
+
+async def statuses(app, ref):
+    async with app.AsyncSessionLocal() as db:
+        r = await db.execute(
+            sa.select(app.transactions.c.status).where(app.transactions.c.external_ref==ref)
+        )
+        return sorted(r.scalars())
+
+
+@pytest.mark.asyncio
+async def test_hot_recipient_postgres(app, telegram_id):
+    """Many senders paying one wallet at once: all land, nothing is lost"""
+    recipient = await make_wallet(app, telegram_id)
+    senders = [await make_wallet(app, telegram_id, Decimal("10")) for _ in range(SENDERS)]
+
+    refs = await asyncio.gather(*(send(app, s, recipient, Decimal("2.5")) for s in senders))
+
+    assert all(refs)
+    assert await balance_of(app, recipient) == Decimal("2.5") * SENDERS
+    for s in senders:
+        assert await balance_of(app, s) == Decimal("7.5")
+    for ref in refs:
+        assert await statuses(app, ref) == ["completed", "completed"]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_overdraft_postgres(app, telegram_id):
+    """Concurrent sends from one wallet never take it below zero"""
+    sender = await make_wallet(app, telegram_id, Decimal("10"))
+    recipient = await make_wallet(app, telegram_id)
+
+    refs = await asyncio.gather(*(send(app, sender, recipient, Decimal("3")) for _ in range(10)))
+
+    assert len([ref for ref in refs if ref]) == 3
+    assert await balance_of(app, sender) == Decimal("1")
+    assert await balance_of(app, recipient) == Decimal("9")
+
+
+@pytest.mark.asyncio
+async def test_hot_recipient_redis(app, telegram_id):
+    """Same storm through the Redis ledger, across and within buckets"""
+    app.ledger = AtomicLedger(app.redis)
+    await app.ledger.load()
+    recipient = await make_wallet(app, telegram_id)
+    senders = [await make_wallet(app, telegram_id, Decimal("10")) for _ in range(SENDERS)]
+    assert len({bucket(s['user_id']) for s in senders}) > 1
+
+    refs = await asyncio.gather(*(send(app, s, recipient, Decimal("2.5")) for s in senders))
+
+    assert all(refs)
+    assert await app.ledger.get_balance(recipient['user_id'], "ETB") == Decimal("2.5") * SENDERS
+    for s in senders:
+        assert await app.ledger.get_balance(s['user_id'], "ETB") == Decimal("7.5")
+    for ref in refs:
+        assert await statuses(app, ref) == ["completed", "completed"]
+
+
+@pytest.mark.asyncio
+async def test_ledger_error_before_debit_fails_rows(app, telegram_id, monkeypatch):
+    """An unexpected ledger error that moved nothing fails both rows"""
+    app.ledger = AtomicLedger(app.redis)
+    await app.ledger.load()
+    sender = await make_wallet(app, telegram_id, Decimal("10"))
+    recipient = await make_wallet(app, telegram_id)
+
+    async def broken(*args, **kwargs):
+        raise ConnectionError("redis went away")
+    monkeypatch.setattr(app, "ledger_transfer", broken)
+
+    assert await send(app, sender, recipient, Decimal("4")) is None
+    async with app.AsyncSessionLocal() as db:
+        r = await db.execute(
+            sa.select(app.transactions.c.external_ref).where(app.transactions.c.wallet_id==sender['id'])
+        )
+        ref = r.scalar_one()
+    assert await statuses(app, ref) == ["failed", "failed"]
+    assert await app.ledger.seed_balance(sender['user_id'], "ETB", sender['balance']) == Decimal("10")
+
+
+@pytest.mark.asyncio
+async def test_ledger_error_after_debit_completes_rows(app, telegram_id, monkeypatch):
+    """If the debit went through, the rows complete and the credit is owed"""
+    app.ledger = AtomicLedger(app.redis)
+    await app.ledger.load()
+    sender = await make_wallet(app, telegram_id, Decimal("10"))
+    recipient = await make_wallet(app, telegram_id)
+    while bucket(recipient['user_id']) == bucket(sender['user_id']):
+        recipient = await make_wallet(app, telegram_id)
+    await app.wallet_balance(sender['user_id'], sender)
+    await app.wallet_balance(recipient['user_id'], recipient)
+
+    apply = app.ledger.apply
+    async def credit_fails(user_id, *args, **kwargs):
+        if user_id == recipient['user_id']:
+            raise ConnectionError("redis went away")
+        return await apply(user_id, *args, **kwargs)
+    monkeypatch.setattr(app.ledger, "apply", credit_fails)
+
+    ref = await send(app, sender, recipient, Decimal("4"))
+    assert ref is not None
+    assert await statuses(app, ref) == ["completed", "completed"]
+
+    monkeypatch.setattr(app.ledger, "apply", apply)
+    assert await app.ledger.complete_transfers(seed=None, min_age=0) == 1
+    assert await app.ledger.get_balance(sender['user_id'], "ETB") == Decimal("6")
+    assert await app.ledger.get_balance(recipient['user_id'], "ETB") == Decimal("4")
@@ -0,0 +1,193 @@
+import json
+import uuid
+from decimal import Decimal
+
+import httpx
+import pytest
+import sqlalchemy as sa
+
+
+async def make_tx(worker, telegram_id, type, amount, balance="0"):
+    """An open transaction on a new wallet; returns (tx_id, wallet_id)"""
+    async with worker.engine.begin() as conn:
+        uid = (await conn.execute(
+            worker.users.insert().values(telegram_id=telegram_id()).returning(worker.users.c.id)
+        )).scalar_one()
+        wallet_id = (await conn.execute(
+            worker.wallets.insert().values(user_id=uid, currency="ETB", balance=Decimal(balance))
+            .returning(worker.wallets.c.id)
+        )).scalar_one()
+        tx_id = (await conn.execute(
+            worker.transactions.insert().values(
+                wallet_id=wallet_id, type=type, amount=Decimal(amount), currency="ETB",
+                status="pending", idempotency_key=uuid.uuid4().hex
+            ).returning(worker.transactions.c.id)
+        )).scalar_one()
+    return tx_id, wallet_id
+
+
+async def enqueue(queue, tx_id, action):
+    raw = json.dumps({"tx_id": tx_id, "action": action, "provider": "mpesa", "phone": "+251900000000"})
+    await queue.redis.lpush(queue.queue_key, raw)
+    return raw.encode()
+
+
+async def tx_state(worker, tx_id, wallet_id):
+    """(tx status, wallet balance, wallet reserved)"""
+    async with worker.engine.connect() as conn:
+        status = (await conn.execute(
+            sa.select(worker.transactions.c.status).where(worker.transactions.c.id==tx_id)
+        )).scalar_one()
+        balance, reserved = (await conn.execute(
+            sa.select(worker.wallets.c.balance, worker.wallets.c.reserved)
+            .where(worker.wallets.c.id==wallet_id)
+        )).one()
+    return status, balance, reserved
+
+
+async def db_down(*args, **kwargs):
+    raise ConnectionError("database went away")
+
+
+@pytest.mark.asyncio
+async def test_db_error_hands_the_job_back(worker, queue, telegram_id, monkeypatch):
+    """DB trouble mid-job neither fails the tx nor drops the job"""
+    tx_id, wallet_id = await make_tx(worker, telegram_id, "withdraw", "10", balance="100")
+    raw = await enqueue(queue, tx_id, "withdraw")
+
+    monkeypatch.setattr(worker, "claim_transaction", db_down)
+
+    with pytest.raises(ConnectionError):
+        await worker.process_one(queue, timeout=1)
+
+    assert await queue.redis.lrange(queue.queue_key, 0, -1) == [raw]
+    assert await queue.redis.llen(queue.processing_key) == 0
+    assert await tx_state(worker, tx_id, wallet_id) == ("pending", Decimal("100"), Decimal("0"))
+
+
+@pytest.mark.asyncio
+async def test_unknown_payout_keeps_its_reservation(worker, telegram_id, monkeypatch):
+    """A payout that may have gone out is never released, even when its marker can't be read"""
+    tx_id, wallet_id = await make_tx(worker, telegram_id, "withdraw", "10", balance="100")
+    payload = {"tx_id": tx_id, "provider": "mpesa"}
+
+    async def read_timeout(*args, **kwargs):
+        raise httpx.ReadTimeout("no reply")
+    monkeypatch.setattr(worker.registry, "payout", read_timeout)
+    with pytest.raises(worker.RetryLater):
+        await worker.handle_payment(payload)
+
+    monkeypatch.setattr(worker.attempts, "get", db_down)
+    with pytest.raises(worker.RetryLater):
+        await worker.handle_payment(payload)
+
+    assert await tx_state(worker, tx_id, wallet_id) == ("processing", Decimal("90"), Decimal("10"))
+
+
+@pytest.mark.asyncio
+async def test_unrecorded_charge_is_queried_not_failed(worker, telegram_id, monkeypatch):
+    """A charge whose reply can't be stored is retried by status query, never failed or charged twice"""
+    tx_id, wallet_id = await make_tx(worker, telegram_id, "deposit", "25")
+    payload = {"tx_id": tx_id, "provider": "mpesa"}
+    calls = []
+
+    async def charge(name, tx_id, *args, **kwargs):
+        calls.append("charge")
+        return {"status": "success", "ref": f"CHG-{tx_id}", "raw": {}}
+
+    async def query_status(name, ref, operation="charge"):
+        calls.append(("query", ref))
+        return {"status": "success", "ref": ref, "raw": {}}
+
+    record = worker.attempts.record
+    async def reply_not_stored(tx_id, provider, outcome, **kwargs):
+        if outcome == "success":
+            raise ConnectionError("database went away")
+        return await record(tx_id, provider, outcome, **kwargs)
+
+    monkeypatch.setattr(worker.registry, "charge", charge)
+    monkeypatch.setattr(worker.registry, "query_status", query_status)
+    monkeypatch.setattr(worker.attempts, "record", reply_not_stored)
+    with pytest.raises(worker.RetryLater):
+        await worker.handle_payment(payload)
+    assert (await tx_state(worker, tx_id, wallet_id))[0] == "pending"
+
+    monkeypatch.setattr(worker.attempts, "record", record)
+    await worker.handle_payment(payload)
+
+    assert calls == ["charge", ("query", f"MAH-{tx_id}")]
+    assert await tx_state(worker, tx_id, wallet_id) == ("completed", Decimal("25"), Decimal("0"))
+
+
+@pytest.fixture
+def worker_on_fake(worker, registry, monkeypatch):
+    """The worker calling the fake provider, with pending jobs due again right away"""
+    monkeypatch.setattr(worker, "registry", registry)
+    monkeypatch.setattr(worker, "PENDING_POLL_INTERVAL", 0)
+    return worker
+
+
+async def job_counts(queue):
+    return (
+        await queue.redis.llen(queue.queue_key),
+        await queue.redis.llen(queue.processing_key),
+        await queue.redis.zcard(queue.delayed_key)
+    )
+
+
+@pytest.mark.asyncio
+async def test_deposit_is_charged_and_credited(worker_on_fake, queue, fake_provider, telegram_id):
+    worker = worker_on_fake
+    tx_id, wallet_id = await make_tx(worker, telegram_id, "deposit", "40")
+    await enqueue(queue, tx_id, "deposit")
+
+    assert await worker.process_one(queue, timeout=1)
+
+    assert await tx_state(worker, tx_id, wallet_id) == ("completed", Decimal("40"), Decimal("0"))
+    assert fake_provider.RequestHandlerClass.operations[f"MAH-{tx_id}"]["status"] == "success"
+    assert await job_counts(queue) == (0, 0, 0)
+
+
+@pytest.mark.asyncio
+async def test_rejected_payout_releases_the_reservation(worker_on_fake, queue, fake_provider, telegram_id):
+    worker = worker_on_fake
+    fake_provider.RequestHandlerClass.reject_rate = 1.0
+    tx_id, wallet_id = await make_tx(worker, telegram_id, "withdraw", "30", balance="100")
+    await enqueue(queue, tx_id, "withdraw")
+
+    assert await worker.process_one(queue, timeout=1)
+
+    assert await tx_state(worker, tx_id, wallet_id) == ("failed", Decimal("100"), Decimal("0"))
+    assert await job_counts(queue) == (0, 0, 0)
+
+
+@pytest.mark.asyncio
+async def test_lost_payout_reply_is_resolved_by_status_query(
+    worker_on_fake, queue, registry, fake_provider, telegram_id, monkeypatch
+):
+    """A 502 after the payout went out: the reference is queried, not paid out again"""
+    worker = worker_on_fake
+    handler = fake_provider.RequestHandlerClass
+    handler.lost_reply_rate = 1.0
+    payouts = []
+    payout = registry.payout
+    async def counted(*args, **kwargs):
+        payouts.append(args)
+        return await payout(*args, **kwargs)
+    monkeypatch.setattr(registry, "payout", counted)
+    tx_id, wallet_id = await make_tx(worker, telegram_id, "withdraw", "30", balance="100")
+    await enqueue(queue, tx_id, "withdraw")
+
+    assert await worker.process_one(queue, timeout=1)
+    assert await tx_state(worker, tx_id, wallet_id) == ("processing", Decimal("70"), Decimal("30"))
+    assert await job_counts(queue) == (0, 0, 1)
+
+    handler.lost_reply_rate = 0.0
+    assert await queue.promote_due() == 1
+    assert await worker.process_one(queue, timeout=1)
+
+    assert await tx_state(worker, tx_id, wallet_id) == ("completed", Decimal("70"), Decimal("0"))
+    assert len(payouts) == 1
+    assert await job_counts(queue) == (0, 0, 0)
+    row = await worker.attempts.get(tx_id)
+    assert (row.status, row.provider_ref, row.attempt_count) == ("completed", f"MAH-PAYOUT-{tx_id}", 1)
@@ -0,0 +1,168 @@
+# worker/jobqueue.py
+import os
+import socket
+import time
+import uuid
+
+# Move up to ARGV[2] jobs due by ARGV[1] from the delayed set onto the
+# consuming end of the queue, atomically so concurrent promoters never
+# duplicate a job
+PROMOTE_DUE_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #due > 0 then
+    redis.call('RPUSH', KEYS[2], unpack(due))
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return #due
+"""
+
+# Delete a lease only if it is still held by ARGV[1]
+UNLEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class ReliableQueue:
+    """
+    At-least-once job queue on top of a Redis list
+
+    Jobs are moved atomically (BLMOVE) from the shared queue into a
+    per-worker processing list and only removed from there once acked.
+    Every worker keeps a heartbeat key alive; the reaper hands the
+    processing list of any worker whose heartbeat expired back to the
+    shared queue, so killing a worker never loses a job.
+
+    Jobs that should not run yet are parked in a sorted set scored by due
+    time (`defer`) and moved back in bulk by `promote_due`.
+    """
+
+    def __init__(self, redis, queue_key="payments:queue", worker_id=None, heartbeat_ttl=30):
+        self.redis = redis
+        self.queue_key = queue_key
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.heartbeat_ttl = heartbeat_ttl
+        self.processing_key = self._processing_key(self.worker_id)
+        self.heartbeat_key = self._heartbeat_key(self.worker_id)
+        self.delayed_key = f"{queue_key}:delayed"
+        self._promote = redis.register_script(PROMOTE_DUE_LUA)
+        self._unlease = redis.register_script(UNLEASE_LUA)
+
+    def _processing_key(self, worker_id):
+        return f"{self.queue_key}:processing:{worker_id}"
+
+    def _heartbeat_key(self, worker_id):
+        return f"{self.queue_key}:heartbeat:{worker_id}"
+
+    async def fetch(self, timeout):
+        """Block up to `timeout` seconds for a job; returns the raw payload or None"""
+        # Producers LPUSH, so the oldest job sits at the right end
+        return await self.redis.blmove(
+            self.queue_key, self.processing_key, timeout, "RIGHT", "LEFT"
+        )
+
+    async def fetch_batch(self, size, timeout):
+        """Block for the first job, then take up to `size - 1` more without waiting"""
+        first = await self.fetch(timeout)
+        if first is None:
+            return []
+        if size <= 1:
+            return [first]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for _ in range(size - 1):
+                pipe.lmove(self.queue_key, self.processing_key, "RIGHT", "LEFT")
+            rest = await pipe.execute()
+        return [first] + [raw for raw in rest if raw is not None]
+
+    async def ack(self, raw):
+        """Job is done (or deliberately dropped); forget it"""
+        await self.redis.lrem(self.processing_key, 1, raw)
+
+    async def ack_many(self, raws):
+        """Ack several jobs in one round trip"""
+        if not raws:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for raw in raws:
+                pipe.lrem(self.processing_key, 1, raw)
+            await pipe.execute()
+
+    async def nack(self, raw):
+        """Hand a job back to the shared queue to be picked up again"""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(self.queue_key, raw)
+            pipe.lrem(self.processing_key, 1, raw)
+            await pipe.execute()
+
+    async def defer(self, raw, delay):
+        """Take a job out of processing and park it for `delay` seconds"""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(self.delayed_key, {raw: time.time() + delay})
+            pipe.lrem(self.processing_key, 1, raw)
+            await pipe.execute()
+
+    async def promote_due(self, limit=500):
+        """Move due delayed jobs back onto the queue; returns how many moved"""
+        return await self._promote(
+            keys=[self.delayed_key, self.queue_key], args=[time.time(), limit]
+        )
+
+    async def next_due(self):
+        """Due time of the earliest delayed job, or None if there are none"""
+        first = await self.redis.zrange(self.delayed_key, 0, 0, withscores=True)
+        return first[0][1] if first else None
+
+    async def lease(self, name, ttl):
+        """
+        Take the exclusive lease `name` for up to `ttl` seconds
+
+        Keeps duplicate jobs for the same request from being worked on at
+        the same time. Returns False if another worker holds it.
+        """
+        key = f"{self.queue_key}:lease:{name}"
+        return bool(await self.redis.set(key, self.worker_id, nx=True, ex=max(1, int(ttl))))
+
+    async def unlease(self, name):
+        """Give up a lease taken with `lease`, unless it expired and moved on"""
+        await self._unlease(keys=[f"{self.queue_key}:lease:{name}"], args=[self.worker_id])
+
+    async def heartbeat(self):
+        """Mark this worker alive for the next `heartbeat_ttl` seconds"""
+        await self.redis.set(self.heartbeat_key, self.worker_id, ex=self.heartbeat_ttl)
+
+    async def _requeue(self, processing_key):
+        # Pop from the newest end and push onto the consuming end, so the
+        # oldest in-flight job ends up first in line again
+        moved = 0
+        while await self.redis.lmove(processing_key, self.queue_key, "LEFT", "RIGHT"):
+            moved += 1
+        return moved
+
+    async def reap(self, lock_ttl=10):
+        """
+        Return jobs held by workers with an expired heartbeat
+
+        Only one worker reaps per `lock_ttl` window. Returns the number of
+        jobs reclaimed.
+        """
+        lock_key = f"{self.queue_key}:reaper"
+        if not await self.redis.set(lock_key, self.worker_id, nx=True, ex=max(1, int(lock_ttl))):
+            return 0
+
+        prefix = self._processing_key("")
+        reclaimed = 0
+        async for key in self.redis.scan_iter(match=f"{prefix}*"):
+            key = key.decode() if isinstance(key, bytes) else key
+            worker_id = key[len(prefix):]
+            if await self.redis.exists(self._heartbeat_key(worker_id)):
+                continue
+            reclaimed += await self._requeue(key)
+        return reclaimed
+
+    async def release(self):
+        """On clean shutdown: requeue our unacked jobs and drop the heartbeat"""
+        moved = await self._requeue(self.processing_key)
+        await self.redis.delete(self.heartbeat_key)
+        return moved
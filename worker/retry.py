@@ -0,0 +1,109 @@
+# worker/retry.py
+import random
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+# Normalized provider outcome -> payment_requests.status. 'sending' marks
+# a charge or payout handed to the provider whose reply isn't recorded
+# yet, 'queued' one that never left (provider busy).
+REQUEST_STATUSES = {
+    "success": "completed",
+    "pending": "processing",
+    "failed": "failed",
+    "retrying": "retrying",
+    "sending": "sending",
+    "queued": "queued",
+}
+
+
+class RetryLater(Exception):
+    """Park the job and run it again after `retry_after` seconds"""
+
+    def __init__(self, retry_after, reason=""):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class ManualReview(Exception):
+    """Stop working the job: the outcome is unknown and a person must settle it"""
+
+
+def backoff_delay(attempt, base=2.0, cap=300.0):
+    """
+    Exponential backoff with equal jitter for the given attempt number
+
+    Half of the exponential step is fixed and half random, so retries of
+    a burst that failed together spread out without ever firing
+    immediately.
+    """
+    step = min(cap, base * 2 ** max(attempt - 1, 0))
+    return step / 2 + random.uniform(0, step / 2)
+
+
+class PaymentAttempts:
+    """
+    Records provider attempts for transactions in `payment_requests`
+
+    One row per transaction (unique transaction_id); every charge/payout
+    bumps attempt_count, status queries bump status_checks instead. A
+    retryable failure is stored as 'retrying' until attempt_count reaches
+    max_attempts, at which point the row turns 'failed' in the same
+    statement.
+    """
+
+    def __init__(self, session_factory, table, max_attempts=3):
+        self.session_factory = session_factory
+        self.table = table
+        self.max_attempts = max_attempts
+
+    async def record(self, tx_id, provider, outcome, ref=None, error=None, attempt=True, status_check=False):
+        """Upsert the outcome of one call; returns the row's (status, attempt_count, status_checks)"""
+        t = self.table
+        status = REQUEST_STATUSES[outcome]
+        bump = 1 if attempt else 0
+        checks = 1 if status_check else 0
+
+        first_status = status
+        if status == "retrying" and bump >= self.max_attempts:
+            first_status = "failed"
+        ins = pg_insert(t).values(
+            transaction_id=tx_id,
+            provider=provider,
+            provider_ref=ref,
+            status=first_status,
+            attempt_count=bump,
+            status_checks=checks,
+            max_attempts=self.max_attempts,
+            last_error=error,
+        )
+        new_count = t.c.attempt_count + bump
+        if status == "retrying":
+            status_expr = sa.case((new_count >= t.c.max_attempts, "failed"), else_="retrying")
+        else:
+            status_expr = sa.literal(status)
+        stmt = ins.on_conflict_do_update(
+            index_elements=[t.c.transaction_id],
+            set_={
+                "attempt_count": new_count,
+                "status_checks": t.c.status_checks + checks,
+                "status": status_expr,
+                "provider_ref": sa.func.coalesce(ins.excluded.provider_ref, t.c.provider_ref),
+                "last_error": sa.func.coalesce(ins.excluded.last_error, t.c.last_error),
+                "updated_at": sa.text("now()"),
+            },
+        ).returning(t.c.status, t.c.attempt_count, t.c.status_checks)
+
+        async with self.session_factory() as db:
+            row = (await db.execute(stmt)).first()
+            await db.commit()
+        return row
+
+    async def get(self, tx_id):
+        """The transaction's (status, provider_ref, attempt_count), or None"""
+        t = self.table
+        async with self.session_factory() as db:
+            r = await db.execute(
+                sa.select(t.c.status, t.c.provider_ref, t.c.attempt_count).where(t.c.transaction_id == tx_id)
+            )
+            return r.first()
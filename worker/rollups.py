@@ -0,0 +1,82 @@
+# worker/rollups.py
+from datetime import datetime, time, timedelta, timezone
+
+import sqlalchemy as sa
+
+# Transactions are bucketed by their UTC creation day
+DAY = "(created_at AT TIME ZONE 'UTC')::date"
+
+REBUILD_DAYS_SQL = f"""
+INSERT INTO transaction_daily_rollups (day, currency, type, status, tx_count, amount_sum)
+SELECT {DAY}, currency, type, status, COUNT(*), SUM(amount)
+FROM transactions
+WHERE created_at >= :lo AND created_at < :hi AND {DAY} = ANY(:days)
+GROUP BY 1, 2, 3, 4
+"""
+
+
+def _utc_midnight(day):
+    return datetime.combine(day, time.min, tzinfo=timezone.utc)
+
+
+class DailyRollups:
+    """
+    Maintains `transaction_daily_rollups` (per day, currency, type, status)
+
+    A refresh rebuilds whole days from `transactions`, so a status change
+    moves a transaction between rows without any bookkeeping. The first
+    refresh of a process rebuilds the last `lookback_days` (all history
+    while the table is empty); later ones only the days of transactions
+    updated since the previous refresh, minus `overlap` seconds for
+    writes that committed late. One refresh runs at a time across
+    workers; the others skip.
+    """
+
+    def __init__(self, engine, lookback_days=35, overlap=300):
+        self.engine = engine
+        self.lookback_days = lookback_days
+        self.overlap = overlap
+        self.since = None
+
+    async def _days(self, conn, now):
+        if self.since is not None:
+            r = await conn.execute(
+                sa.text(f"SELECT DISTINCT {DAY} FROM transactions WHERE updated_at >= :since"),
+                {"since": self.since}
+            )
+            return sorted(r.scalars())
+
+        start = (now - timedelta(days=self.lookback_days)).date()
+        r = await conn.execute(sa.text("SELECT EXISTS (SELECT 1 FROM transaction_daily_rollups)"))
+        if not r.scalar():
+            r = await conn.execute(sa.text(f"SELECT MIN({DAY}) FROM transactions"))
+            start = min(start, r.scalar() or start)
+        return [start + timedelta(days=n) for n in range((now.date() - start).days + 1)]
+
+    async def refresh_once(self):
+        """Rebuild the days that changed; returns how many, or None if skipped"""
+        async with self.engine.begin() as conn:
+            r = await conn.execute(
+                sa.text("SELECT pg_try_advisory_xact_lock(hashtext('transaction_daily_rollups'))")
+            )
+            if not r.scalar():
+                return None
+            r = await conn.execute(sa.text("SELECT now() AT TIME ZONE 'UTC'"))
+            now = r.scalar().replace(tzinfo=timezone.utc)
+
+            days = await self._days(conn, now)
+            if days:
+                await conn.execute(
+                    sa.text("DELETE FROM transaction_daily_rollups WHERE day = ANY(:days)"),
+                    {"days": days}
+                )
+                await conn.execute(
+                    sa.text(REBUILD_DAYS_SQL),
+                    {
+                        "lo": _utc_midnight(days[0]),
+                        "hi": _utc_midnight(days[-1] + timedelta(days=1)),
+                        "days": days
+                    }
+                )
+        self.since = now - timedelta(seconds=self.overlap)
+        return len(days)
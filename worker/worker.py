@@ -1,166 +1,1011 @@
 # worker/worker.py
 import os
+import sys
 import asyncio
 import json
 import logging
+import signal
+import time
 from dotenv import load_dotenv
-import aioredis
+from redis import asyncio as aioredis
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 import sqlalchemy as sa
 from decimal import Decimal
-import httpx
-from datetime import datetime
+from collections import defaultdict
+from prometheus_client import start_http_server
+
+# providers/ and ledger/ sit at the repository root (copied next to this file in the image)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jobqueue import ReliableQueue
+from retry import ManualReview, PaymentAttempts, RetryLater, backoff_delay
+from rollups import DailyRollups
+from providers import ProviderRegistry, ProviderBusy, ProviderError, PENDING, FAILED, is_transient, never_sent
+from ledger import AtomicLedger, BalanceNotLoaded, InsufficientFunds, JournalFlusher, Reconciler
 
 load_dotenv()
 REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
 DATABASE_URL = os.getenv("DATABASE_URL")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "10"))
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", "30"))
+WORKER_POP_TIMEOUT = int(os.getenv("WORKER_POP_TIMEOUT", "5"))
+
+WORKER_BATCH_SIZE = int(os.getenv("WORKER_BATCH_SIZE", "1"))
+WORKER_HEARTBEAT_TTL = int(os.getenv("WORKER_HEARTBEAT_TTL", "30"))
+WORKER_REAP_INTERVAL = float(os.getenv("WORKER_REAP_INTERVAL", "10"))
+WORKER_PROMOTE_INTERVAL = float(os.getenv("WORKER_PROMOTE_INTERVAL", "1"))
+# Upper bound on how long one job may hold its transaction's lease
+WORKER_LEASE_TTL = int(os.getenv("WORKER_LEASE_TTL", "120"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+PAYMENT_MAX_ATTEMPTS = int(os.getenv("PAYMENT_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "2"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "300"))
+PENDING_POLL_INTERVAL = float(os.getenv("PENDING_POLL_INTERVAL", "15"))
+# Status checks before a still-pending payout is handed to manual review
+PAYOUT_MAX_STATUS_CHECKS = int(os.getenv("PAYOUT_MAX_STATUS_CHECKS", "240"))
+# postgres: wallets.balance is the live balance; redis: the AtomicLedger is,
+# with its journal written behind to wallets.balance
+LEDGER_MODE = os.getenv("LEDGER_MODE", "postgres")
+LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL", "0.5"))
+LEDGER_FLUSH_BATCH = int(os.getenv("LEDGER_FLUSH_BATCH", "500"))
+LEDGER_RECONCILE_INTERVAL = float(os.getenv("LEDGER_RECONCILE_INTERVAL", "300"))
+# transaction_daily_rollups, read by the admin stats and analytics endpoints
+ROLLUP_INTERVAL = float(os.getenv("ROLLUP_INTERVAL", "60"))
+ROLLUP_LOOKBACK_DAYS = int(os.getenv("ROLLUP_LOOKBACK_DAYS", "35"))
+
+QUEUE_KEY = "payments:queue"
+DEFAULT_PROVIDER = os.getenv("DEFAULT_PROVIDER", "mpesa")
+# Transactions the worker may still settle; anything else is final
+OPEN_STATUSES = ("pending", "processing")
+# payment_requests states of a charge or payout that may have reached the provider
+SENT_STATUSES = ("sending", "processing", "completed")
 
 logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger("mahavaba_worker")
 
-engine = create_async_engine(DATABASE_URL, future=True)
+# One pooled connection per in-flight job, plus headroom for bursts
+engine = create_async_engine(
+    DATABASE_URL,
+    future=True,
+    pool_size=WORKER_CONCURRENCY,
+    max_overflow=5
+)
 AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 metadata = sa.MetaData()
 
-# Define tables
-users = sa.Table("users", metadata, autoload_with=engine)
-wallets = sa.Table("wallets", metadata, autoload_with=engine)
-transactions = sa.Table("transactions", metadata, autoload_with=engine)
-payment_requests = sa.Table("payment_requests", metadata, autoload_with=engine)
+# Define tables (see migrations/schema.sql); an AsyncEngine can't reflect them at import
+users = sa.Table(
+    "users", metadata,
+    sa.Column("id", sa.BigInteger, primary_key=True),
+    sa.Column("telegram_id", sa.BigInteger, unique=True, nullable=False),
+    sa.Column("username", sa.String),
+    sa.Column("phone", sa.String),
+    sa.Column("email", sa.String),
+    sa.Column("kyc_status", sa.String),
+    sa.Column("kyc_data", sa.JSON),
+    sa.Column("created_at", sa.TIMESTAMP(timezone=True), server_default=sa.text("now()")),
+    sa.Column("updated_at", sa.TIMESTAMP(timezone=True), server_default=sa.text("now()"))
+)
+
+wallets = sa.Table(
+    "wallets", metadata,
+    sa.Column("id", sa.BigInteger, primary_key=True),
+    sa.Column("user_id", sa.BigInteger, sa.ForeignKey("users.id", ondelete="CASCADE")),
+    sa.Column("currency", sa.String, nullable=False),
+    sa.Column("balance", sa.Numeric(30,8), server_default="0"),
+    sa.Column("reserved", sa.Numeric(30,8), server_default="0"),
+    sa.Column("created_at", sa.TIMESTAMP(timezone=True), server_default=sa.text("now()")),
+    sa.Column("updated_at", sa.TIMESTAMP(timezone=True), server_default=sa.text("now()"))
+)
+
+transactions = sa.Table(
+    "transactions", metadata,
+    sa.Column("id", sa.BigInteger, primary_key=True),
+    sa.Column("wallet_id", sa.BigInteger, sa.ForeignKey("wallets.id")),
+    sa.Column("type", sa.String, nullable=False),
+    sa.Column("amount", sa.Numeric(30,8), nullable=False),
+    sa.Column("currency", sa.String, nullable=False),
+    sa.Column("status", sa.String, nullable=False, server_default="pending"),
+    sa.Column("external_ref", sa.String),
+    sa.Column("metadata", sa.JSON),
+    sa.Column("idempotency_key", sa.String, unique=True),
+    sa.Column("created_at", sa.TIMESTAMP(timezone=True), server_default=sa.text("now()")),
+    sa.Column("updated_at", sa.TIMESTAMP(timezone=True), server_default=sa.text("now()"))
+)
+
+payment_requests = sa.Table(
+    "payment_requests", metadata,
+    sa.Column("id", sa.BigInteger, primary_key=True),
+    sa.Column("transaction_id", sa.BigInteger, sa.ForeignKey("transactions.id"), unique=True),
+    sa.Column("provider", sa.String, nullable=False),
+    sa.Column("provider_ref", sa.String),
+    sa.Column("status", sa.String, server_default="queued"),
+    sa.Column("attempt_count", sa.Integer, server_default="0"),
+    sa.Column("status_checks", sa.Integer, server_default="0"),
+    sa.Column("max_attempts", sa.Integer, server_default="3"),
+    sa.Column("last_error", sa.String),
+    sa.Column("created_at", sa.TIMESTAMP(timezone=True), server_default=sa.text("now()")),
+    sa.Column("updated_at", sa.TIMESTAMP(timezone=True), server_default=sa.text("now()"))
+)
+
+# Dispatches on payload["provider"]; one pooled client and slot pool each
+registry = ProviderRegistry()
+attempts = PaymentAttempts(AsyncSessionLocal, payment_requests, PAYMENT_MAX_ATTEMPTS)
+
+# Jobs that should run again later rather than fail now; both carry retry_after
+DEFERRABLE = (ProviderBusy, RetryLater)
 
-async def process_one(redis):
-    """Process one payment request from the queue"""
-    raw = await redis.rpop("payments:queue")
-    if not raw:
+# Hot balances when LEDGER_MODE=redis; set up in run()
+ledger = None
+
+def tx_query():
+    """Select transactions along with the user owning their wallet"""
+    return sa.select(transactions, wallets.c.user_id).select_from(
+        transactions.join(wallets, wallets.c.id==transactions.c.wallet_id)
+    )
+
+async def process_one(queue, timeout=WORKER_POP_TIMEOUT):
+    """Process one payment request from the queue
+
+    Blocks for up to `timeout` seconds so idle workers sit on the
+    connection instead of polling; returns False if nothing arrived.
+    The job stays in this worker's processing list until it is acked,
+    so a crash mid-job leaves it for the reaper to hand back.
+    """
+    raw = await queue.fetch(timeout)
+    if raw is None:
         return False
     
-    payload = json.loads(raw)
+    try:
+        payload = json.loads(raw)
+    except ValueError:
+        logger.error("Dropping malformed payload: %r", raw)
+        await queue.ack(raw)
+        return True
+    
+    lease = job_lease(payload)
+    if not await queue.lease(lease, WORKER_LEASE_TTL):
+        # A duplicate payload of this request is running right now; once
+        # it's done this copy finds the tx closed and is skipped
+        logger.info("tx=%s already in progress, deferring duplicate", payload.get("tx_id"))
+        await queue.defer(raw, PENDING_POLL_INTERVAL)
+        return True
+    
+    try:
+        await handle_payment(payload)
+    except DEFERRABLE as e:
+        # Backoff, open circuit, saturated or pending provider: park the
+        # job in the delayed set and free the slot
+        logger.info("Retrying tx=%s in %.1fs: %s", payload.get("tx_id"), e.retry_after, e)
+        await queue.defer(raw, e.retry_after)
+        return True
+    except Exception:
+        # DB/Redis trouble: give the job back rather than lose it
+        await queue.nack(raw)
+        raise
+    finally:
+        await queue.unlease(lease)
+    await queue.ack(raw)
+    return True
+
+def job_lease(payload):
+    """Lease name shared by every payload (duplicates included) of one tx"""
+    return f"tx:{payload.get('tx_id')}"
+
+async def handle_payment(payload):
+    """Settle a single payment request against the database
+
+    Provider calls run with no session open: every DB step below uses its
+    own short transaction, so neither a pooled connection nor a row lock is
+    ever held while waiting on a third party.
+    """
     logger.info("Processing payment: %s", payload)
     
-    action = payload.get("action")
     tx_id = payload.get("tx_id")
     
     async with AsyncSessionLocal() as db:
         # Load transaction
-        qtx = sa.select(transactions).where(transactions.c.id==tx_id).limit(1)
+        qtx = tx_query().where(transactions.c.id==tx_id).limit(1)
         r = await db.execute(qtx)
         txrow = r.first()
-        
-        if not txrow:
-            logger.error("Transaction not found: %s", tx_id)
-            return True
-        
-        tx = txrow._mapping
-        
-        try:
-            if action == "deposit":
-                # Simulate provider confirmation (replace with real provider call)
-                logger.info("Processing deposit for tx=%s", tx_id)
-                
-                # Simulate MPesa/Telebirr/Chapa API call
-                await asyncio.sleep(0.1)  # Simulate network delay
-                prov = {
-                    "status": "success", 
-                    "ref": f"mpesa-{int(datetime.utcnow().timestamp()*1000)}"
-                }
-                
-                # Update wallet balance atomically
-                qw = sa.select(wallets).where(wallets.c.id==tx['wallet_id']).with_for_update()
-                rr = await db.execute(qw)
-                w = rr.first()._mapping
-                
-                new_balance = Decimal(w['balance']) + Decimal(tx['amount'])
-                upd = wallets.update().where(wallets.c.id==w['id']).values(balance=new_balance)
-                await db.execute(upd)
-                
-                # Update transaction status
-                upd_tx = transactions.update().where(transactions.c.id==tx['id']).values(
-                    status="completed", 
-                    external_ref=prov["ref"], 
-                    updated_at=sa.text("now()")
-                )
-                await db.execute(upd_tx)
-                await db.commit()
-                
-                logger.info("✅ Deposit completed: tx=%s, amount=%s %s", 
-                           tx_id, tx['amount'], tx['currency'])
-                
-            elif action == "withdraw":
-                # Simulate provider withdrawal
-                logger.info("Processing withdrawal for tx=%s", tx_id)
-                
-                # Check balance and deduct
-                qw = sa.select(wallets).where(wallets.c.id==tx['wallet_id']).with_for_update()
-                rr = await db.execute(qw)
-                w = rr.first()._mapping
+    
+    if not txrow:
+        logger.error("Transaction not found: %s", tx_id)
+        return
+    
+    tx = txrow._mapping
+    action = payload.get("action") or tx['type']
+    
+    # The payload must come from the request that created the tx
+    key = payload.get("idempotency_key")
+    if key and tx['idempotency_key'] and key != tx['idempotency_key']:
+        logger.error("Dropping payload for tx=%s: idempotency key %s doesn't match", tx_id, key)
+        return
+    
+    # Redelivered job (reaper, nack): never settle the same tx twice
+    if tx['status'] not in OPEN_STATUSES:
+        logger.info("Skipping tx=%s, already %s", tx_id, tx['status'])
+        return
+    
+    try:
+        if action == "deposit":
+            logger.info("Processing deposit for tx=%s", tx_id)
+            prov = await confirm_deposit(tx, payload)
+            if prov["status"] == FAILED:
+                raise ProviderError(f"Deposit rejected by provider (ref={prov['ref']})")
+            try:
+                if prov["status"] == PENDING:
+                    async with AsyncSessionLocal() as db:
+                        await mark_in_flight(db, tx_id, prov["ref"])
+                    logger.info("⏳ Deposit awaiting provider: tx=%s, ref=%s", tx_id, prov["ref"])
+                    raise RetryLater(PENDING_POLL_INTERVAL, "awaiting provider confirmation")
                 
-                if Decimal(w['balance']) < Decimal(tx['amount']):
-                    upd_tx = transactions.update().where(transactions.c.id==tx['id']).values(
-                        status="failed", 
-                        metadata={"error": "Insufficient funds"}
-                    )
-                    await db.execute(upd_tx)
-                    await db.commit()
-                    logger.error("❌ Insufficient funds for tx=%s", tx_id)
-                else:
-                    # Simulate provider call
-                    await asyncio.sleep(0.1)
-                    prov = {
-                        "status": "success", 
-                        "ref": f"bank-{int(datetime.utcnow().timestamp()*1000)}"
-                    }
-                    
-                    new_balance = Decimal(w['balance']) - Decimal(tx['amount'])
-                    await db.execute(
-                        wallets.update().where(wallets.c.id==w['id']).values(balance=new_balance)
-                    )
-                    await db.execute(
-                        transactions.update().where(transactions.c.id==tx['id']).values(
-                            status="completed", 
-                            external_ref=prov["ref"], 
-                            updated_at=sa.text("now()")
-                        )
-                    )
-                    await db.commit()
-                    
-                    logger.info("✅ Withdrawal completed: tx=%s, amount=%s %s", 
-                               tx_id, tx['amount'], tx['currency'])
+                async with AsyncSessionLocal() as db:
+                    if not await credit_deposit(db, tx, prov["ref"]):
+                        logger.info("Skipping tx=%s, settled concurrently", tx_id)
+                        return
+            except DEFERRABLE:
+                raise
+            except Exception as e:
+                # Accepted by the provider and maybe credited in Redis
+                # already: retry the bookkeeping, never fail the deposit
+                logger.exception("❌ Recording deposit tx=%s failed: %s", tx_id, e)
+                raise RetryLater(PENDING_POLL_INTERVAL, f"recording deposit {prov['ref']} failed: {e}")
+            
+            logger.info("✅ Deposit completed: tx=%s, amount=%s %s", 
+                       tx_id, tx['amount'], tx['currency'])
+            
+        elif action == "withdraw":
+            logger.info("Processing withdrawal for tx=%s", tx_id)
+            await process_withdrawal(tx, payload)
+        else:
+            logger.warning("Unknown action: %s", action)
+            
+    except DEFERRABLE:
+        raise
+    except ManualReview as e:
+        await hold_for_review(tx_id, e)
+    except (ProviderError, InsufficientFunds) as e:
+        # Rejected: the tx is over. Anything else (DB, Redis) propagates
+        # so the job is handed back and redelivered instead.
+        logger.exception("❌ Error processing tx %s: %s", tx_id, e)
+        async with AsyncSessionLocal() as db:
+            if action == "withdraw":
+                await fail_withdrawal(db, tx, str(e))
             else:
-                logger.warning("Unknown action: %s", action)
-                
+                await mark_failed(db, tx['id'], str(e))
+
+async def process_withdrawal(tx, payload):
+    """Reserve funds, pay out through the provider, then finalize or release"""
+    tx_id = tx['id']
+    
+    # 1. Reserve: move the amount from balance to reserved and mark the
+    #    tx processing in one short commit. A redelivered 'processing'
+    #    tx already holds its reservation.
+    if tx['status'] == "pending":
+        async with AsyncSessionLocal() as db:
+            if not await claim_transaction(db, tx_id):
+                await db.rollback()
+                logger.info("Skipping tx=%s, claimed concurrently", tx_id)
+                return
+            if await reserve_funds(db, tx) is None:
+                await db.rollback()
+                await mark_failed(db, tx_id, "Insufficient funds")
+                logger.error("❌ Insufficient funds for tx=%s", tx_id)
+                return
+            await db.commit()
+    
+    # 2. Provider call, outside any transaction. A deferred job keeps its
+    #    reservation; the requeued job resumes from here.
+    try:
+        prov = await send_withdrawal(tx, payload)
+        if prov["status"] == FAILED:
+            raise ProviderError(f"Payout rejected by provider (ref={prov['ref']})")
+    except DEFERRABLE:
+        raise
+    except ManualReview as e:
+        await hold_for_review(tx_id, e)
+        return
+    except ProviderError as e:
+        # Rejected, or refused before it was sent: the payout never
+        # happened, so release the reservation
+        logger.exception("❌ Withdrawal failed for tx=%s: %s", tx_id, e)
+        async with AsyncSessionLocal() as db:
+            await fail_withdrawal(db, tx, str(e))
+        return
+    except Exception as e:
+        # DB or Redis trouble says nothing about the payout, which may
+        # have gone out: keep the reservation and try again
+        logger.exception("❌ Withdrawal tx=%s interrupted: %s", tx_id, e)
+        raise RetryLater(PENDING_POLL_INTERVAL, f"payout interrupted: {e}")
+    
+    # 3. The provider has the payout: from here on nothing may fail the
+    #    tx or release its reservation. DB trouble retries the job, which
+    #    finds the recorded reply and resumes from a status query.
+    try:
+        await finalize_withdrawal(tx, prov)
+    except DEFERRABLE:
+        raise
+    except ManualReview as e:
+        await hold_for_review(tx_id, e)
+    except Exception as e:
+        logger.exception("❌ Recording accepted payout for tx=%s failed: %s", tx_id, e)
+        raise RetryLater(PENDING_POLL_INTERVAL, f"payout {prov['ref']} accepted, recording it failed: {e}")
+
+async def finalize_withdrawal(tx, prov):
+    """Record an accepted payout: in flight while pending, else capture the reservation"""
+    tx_id = tx['id']
+    if prov["status"] == PENDING:
+        async with AsyncSessionLocal() as db:
+            await mark_in_flight(db, tx_id, prov["ref"])
+        logger.info("⏳ Withdrawal awaiting provider: tx=%s, ref=%s", tx_id, prov["ref"])
+        raise RetryLater(PENDING_POLL_INTERVAL, "awaiting provider confirmation")
+    
+    # The reserved funds have left the wallet
+    async with AsyncSessionLocal() as db:
+        if not await mark_settled(db, tx_id, prov["ref"]):
+            await db.rollback()
+            logger.info("Skipping tx=%s, settled concurrently", tx_id)
+            return
+        try:
+            captured = await capture_reserved(db, tx)
+        except InsufficientFunds:
+            captured = None
+        if captured is None:
+            await db.rollback()
+            raise ManualReview(f"payout {prov['ref']} went through but its reservation is gone")
+        await db.commit()
+    
+    logger.info("✅ Withdrawal completed: tx=%s, amount=%s %s", 
+               tx_id, tx['amount'], tx['currency'])
+
+async def hold_for_review(tx_id, reason):
+    """Park a transaction whose provider outcome can't be settled automatically"""
+    try:
+        async with AsyncSessionLocal() as db:
+            await mark_review(db, tx_id, str(reason))
+    except Exception as e:
+        # Never fall through to failing (and releasing) the withdrawal
+        raise RetryLater(PENDING_POLL_INTERVAL, f"holding for review failed: {e}")
+    logger.warning("⚠️ tx=%s held for review: %s", tx_id, reason)
+
+async def confirm_deposit(tx, payload):
+    """Collect a deposit through the payload's provider"""
+    return await call_provider(tx, payload, "charge")
+
+async def credit_deposit(db, tx, external_ref):
+    """Complete one confirmed deposit and credit its wallet in one commit"""
+    # Claim the transaction first; a concurrent duplicate blocks
+    # here and then matches zero rows
+    if not await mark_settled(db, tx['id'], external_ref):
+        await db.rollback()
+        return False
+    
+    if LEDGER_MODE == "redis":
+        # The claim's row lock is held until commit; a crash in between
+        # redoes the claim and the credit is applied only once per tx
+        await ledger_call(tx, "credit")
+    else:
+        await apply_balance_delta(db, tx['wallet_id'], Decimal(tx['amount']))
+    await db.commit()
+    return True
+
+async def send_withdrawal(tx, payload):
+    """Pay out a withdrawal through the payload's provider"""
+    return await call_provider(tx, payload, "payout")
+
+async def call_provider(tx, payload, operation):
+    """Run a charge or payout through the registry and record the attempt
+
+    A transaction that already has an external_ref was sent before
+    (redelivery, pending outcome), so only its status is queried (see
+    poll_provider), which doesn't count as an attempt. Transient failures
+    raise RetryLater with an exponential backoff until
+    payment_requests.max_attempts is used up; after that, and for
+    outright rejections, the error propagates.
+    
+    Every charge and payout is marked 'sending' in payment_requests,
+    under a reference derived from the tx id, before it goes out. A run
+    that finds the marker (or any recorded reply) with no external_ref on
+    the tx died mid-call or before storing the ref, so it queries that
+    reference instead of charging or paying out twice.
+    A payout failure that may have reached the provider (read timeout,
+    5xx, a reply we can't make sense of) leaves the marker in place the
+    same way: its outcome is unknown, so it is queried, never resent and
+    never failed. ProviderError therefore means a payout that provably
+    never happened: rejected, or refused before sending on every attempt.
+    
+    payment_requests trouble (DB errors) raises RetryLater: it says
+    nothing about the charge or payout, so it never fails the tx.
+    """
+    provider = payload.get("provider") or DEFAULT_PROVIDER
+    if tx['external_ref']:
+        return await poll_provider(tx, provider, tx['external_ref'], operation)
+    
+    try:
+        sent = await attempts.get(tx['id'])
+    except Exception as e:
+        raise RetryLater(PENDING_POLL_INTERVAL, f"looking up earlier attempts failed: {e}")
+    if sent is not None and sent.status in SENT_STATUSES:
+        ref = sent.provider_ref or registry.get(provider).reference(tx['id'], operation)
+        logger.warning("tx=%s was sent before (%s), querying %s", tx['id'], sent.status, ref)
+        return await poll_provider(tx, provider, ref, operation)
+    if sent is not None and sent.status == "failed":
+        # Settled as failed before recording it on the tx failed: don't resend
+        raise ProviderError(f"{operation} for tx={tx['id']} already failed at {provider}")
+    
+    kwargs = (payload.get("destination") or {}) if operation == "payout" else {}
+    await record_attempt(
+        tx, provider, "sending", ref=registry.get(provider).reference(tx['id'], operation), attempt=False
+    )
+    
+    try:
+        prov = await getattr(registry, operation)(
+            provider, tx['id'], tx['amount'], tx['currency'], payload.get("phone"), **kwargs
+        )
+    except ProviderBusy:
+        # Refused before the request left: clear the marker
+        await record_attempt(tx, provider, "queued", attempt=False)
+        raise
+    except Exception as e:
+        retryable = is_transient(e)
+        if operation == "payout" and not never_sent(e) and (retryable or not isinstance(e, ProviderError)):
+            await record_attempt(tx, provider, "sending", error=str(e))
+            raise RetryLater(PENDING_POLL_INTERVAL, f"payout outcome unknown: {e}")
+        row = await record_attempt(tx, provider, "retrying" if retryable else FAILED, error=str(e))
+        if retryable and row.status == "retrying":
+            raise RetryLater(
+                backoff_delay(row.attempt_count, RETRY_BASE_DELAY, RETRY_MAX_DELAY),
+                f"attempt {row.attempt_count} failed: {e}"
+            )
+        if isinstance(e, ProviderError):
+            raise
+        raise ProviderError(f"{operation} failed after {row.attempt_count} attempt(s): {e}") from e
+    
+    await record_attempt(tx, provider, prov["status"], ref=prov["ref"])
+    return prov
+
+async def record_attempt(tx, provider, outcome, **kwargs):
+    """Record a call in payment_requests; DB trouble retries the job, it never fails the tx"""
+    try:
+        return await attempts.record(tx['id'], provider, outcome, **kwargs)
+    except Exception as e:
+        raise RetryLater(PENDING_POLL_INTERVAL, f"recording {outcome} for tx={tx['id']} failed: {e}")
+
+async def poll_provider(tx, provider, ref, operation):
+    """Query the outcome of a charge or payout sent earlier
+
+    Nothing is failed on a status query error: those retry or, if the
+    provider won't answer for the ref, raise ManualReview, as does a
+    payout still pending after PAYOUT_MAX_STATUS_CHECKS queries.
+    """
+    try:
+        prov = await registry.query_status(provider, ref, operation)
+    except ProviderBusy:
+        raise
+    except Exception as e:
+        if is_transient(e):
+            raise RetryLater(PENDING_POLL_INTERVAL, f"status query failed: {e}")
+        raise ManualReview(f"status query for {ref} failed: {e}")
+    
+    row = await record_attempt(tx, provider, prov["status"], ref=prov["ref"], attempt=False, status_check=True)
+    if operation == "payout" and prov["status"] == PENDING and row.status_checks >= PAYOUT_MAX_STATUS_CHECKS:
+        raise ManualReview(f"payout {ref} still pending after {row.status_checks} status checks")
+    return prov
+
+async def fail_withdrawal(db, tx, error):
+    """Fail an open withdrawal, releasing its reservation if it holds one"""
+    for status in ("processing", "pending"):
+        res = await db.execute(
+            transactions.update().where(
+                transactions.c.id==tx['id'],
+                transactions.c.status==status
+            ).values(
+                status="failed",
+                metadata={"error": error}
+            )
+        )
+        if res.rowcount == 1:
+            # Only 'processing' withdrawals have reserved funds
+            if status == "processing":
+                await release_reserved(db, tx)
+            break
+    await db.commit()
+
+async def apply_balance_delta(db, wallet_id, delta, reserved_delta=0):
+    """
+    Add `delta` to a wallet balance in a single round trip
+
+    The balance is computed by Postgres, so the row lock lasts only for
+    the rest of the caller's transaction. `reserved_delta` moves funds in
+    or out of `wallets.reserved` in the same statement. Returns the new
+    balance, or None if the wallet doesn't exist or either column would
+    go below zero.
+    """
+    res = await db.execute(
+        wallets.update().where(
+            wallets.c.id==wallet_id,
+            wallets.c.balance + delta >= 0,
+            wallets.c.reserved + reserved_delta >= 0
+        ).values(
+            balance=wallets.c.balance + delta,
+            reserved=wallets.c.reserved + reserved_delta
+        ).returning(wallets.c.balance)
+    )
+    return res.scalar_one_or_none()
+
+async def ledger_call(tx, op):
+    """
+    Run `op` (credit, reserve, release, capture) for tx's amount against
+    its Redis balance, once per (tx, op)
+
+    A balance Redis doesn't hold yet is seeded from the wallet row first:
+    with no key there are no unflushed journal entries for it, so Postgres
+    is current. Raises InsufficientFunds.
+    """
+    method = {
+        "credit": ledger.apply,
+        "reserve": ledger.reserve_funds,
+        "release": ledger.release_reserved,
+        "capture": ledger.capture_reserved
+    }[op]
+    args = (tx['user_id'], tx['currency'], Decimal(tx['amount']))
+    ref = f"tx:{tx['id']}:{op}"
+    try:
+        return await method(*args, ref=ref)
+    except BalanceNotLoaded:
+        async with AsyncSessionLocal() as db:
+            r = await db.execute(
+                sa.select(wallets.c.balance, wallets.c.reserved).where(wallets.c.id==tx['wallet_id'])
+            )
+            balance, reserved = r.one()
+            await ledger.seed_balance(tx['user_id'], tx['currency'], balance, reserved)
+        return await method(*args, ref=ref)
+
+async def reserve_funds(db, tx):
+    """Hold the tx amount of the available balance for an in-flight payout"""
+    if LEDGER_MODE == "redis":
+        try:
+            return await ledger_call(tx, "reserve")
+        except InsufficientFunds:
+            return None
+    amount = Decimal(tx['amount'])
+    return await apply_balance_delta(db, tx['wallet_id'], -amount, amount)
+
+async def release_reserved(db, tx):
+    """Return a held amount to the available balance"""
+    if LEDGER_MODE == "redis":
+        return await ledger_call(tx, "release")
+    amount = Decimal(tx['amount'])
+    return await apply_balance_delta(db, tx['wallet_id'], amount, -amount)
+
+async def capture_reserved(db, tx):
+    """Consume a held amount once the payout went through"""
+    if LEDGER_MODE == "redis":
+        return await ledger_call(tx, "capture")
+    return await apply_balance_delta(db, tx['wallet_id'], 0, -Decimal(tx['amount']))
+
+async def claim_transaction(db, tx_id):
+    """Move a pending transaction to processing; False if someone else did"""
+    res = await db.execute(
+        transactions.update().where(
+            transactions.c.id==tx_id,
+            transactions.c.status=="pending"
+        ).values(status="processing")
+    )
+    return res.rowcount == 1
+
+async def mark_failed(db, tx_id, error):
+    """Record an open transaction as failed with the reason in its metadata"""
+    await db.execute(
+        transactions.update().where(
+            transactions.c.id==tx_id,
+            transactions.c.status.in_(OPEN_STATUSES)
+        ).values(
+            status="failed",
+            metadata={"error": error}
+        )
+    )
+    await db.commit()
+
+async def mark_review(db, tx_id, reason):
+    """Hold an open transaction for manual settlement; reserved funds stay held"""
+    await db.execute(
+        transactions.update().where(
+            transactions.c.id==tx_id,
+            transactions.c.status.in_(OPEN_STATUSES)
+        ).values(
+            status="review",
+            metadata={"review": reason},
+            updated_at=sa.text("now()")
+        )
+    )
+    await db.commit()
+
+async def mark_in_flight(db, tx_id, external_ref):
+    """Record the provider ref of an operation whose outcome isn't known yet"""
+    await db.execute(
+        transactions.update().where(
+            transactions.c.id==tx_id,
+            transactions.c.status.in_(OPEN_STATUSES)
+        ).values(
+            status="processing",
+            external_ref=external_ref
+        )
+    )
+    await db.commit()
+
+async def mark_settled(db, tx_id, external_ref):
+    """Move an open transaction to completed; False if it was already closed"""
+    res = await db.execute(
+        transactions.update().where(
+            transactions.c.id==tx_id,
+            transactions.c.status.in_(OPEN_STATUSES)
+        ).values(
+            status="completed", 
+            external_ref=external_ref, 
+            updated_at=sa.text("now()")
+        )
+    )
+    return res.rowcount == 1
+
+async def process_batch(queue, size=WORKER_BATCH_SIZE, timeout=WORKER_POP_TIMEOUT):
+    """Process up to `size` queued jobs, settling deposits together
+
+    Deposits are settled in one DB transaction by settle_deposit_batch();
+    everything else (withdrawals, or deposits when the batch fails) goes
+    through handle_payment() one by one so a bad item only affects itself.
+    """
+    raws = await queue.fetch_batch(size, timeout)
+    if not raws:
+        return False
+    
+    jobs, done, leases = [], [], []
+    for raw in raws:
+        try:
+            payload = json.loads(raw)
+        except ValueError:
+            logger.error("Dropping malformed payload: %r", raw)
+            done.append(raw)
+            continue
+        # Duplicates of a tx in flight (here or elsewhere) wait their turn
+        if not await queue.lease(job_lease(payload), WORKER_LEASE_TTL):
+            logger.info("tx=%s already in progress, deferring duplicate", payload.get("tx_id"))
+            await queue.defer(raw, PENDING_POLL_INTERVAL)
+            continue
+        leases.append(job_lease(payload))
+        jobs.append((raw, payload))
+    
+    try:
+        await settle_jobs(queue, jobs, done)
+    finally:
+        for lease in leases:
+            await queue.unlease(lease)
+    return True
+
+async def settle_jobs(queue, jobs, done):
+    """Settle leased batch jobs, acking `done` (dropped payloads) along the way"""
+    try:
+        leftovers, deferred = await settle_deposit_batch(jobs)
+    except Exception as e:
+        # Safe to redo: handle_payment() skips anything already closed
+        logger.exception("Batch settlement failed, settling %s job(s) one by one: %s", len(jobs), e)
+        leftovers, deferred = jobs, []
+    
+    left = {id(job) for job in leftovers} | {id(job) for job, _ in deferred}
+    done.extend(job[0] for job in jobs if id(job) not in left)
+    await queue.ack_many(done)
+    for (raw, payload), delay in deferred:
+        await queue.defer(raw, delay)
+    
+    for raw, payload in leftovers:
+        try:
+            await handle_payment(payload)
+        except DEFERRABLE as e:
+            logger.info("Retrying tx=%s in %.1fs: %s", payload.get("tx_id"), e.retry_after, e)
+            await queue.defer(raw, e.retry_after)
+            continue
         except Exception as e:
-            logger.exception("❌ Error processing tx %s: %s", tx_id, e)
-            # Update transaction as failed
+            logger.exception("Worker error on tx %s: %s", payload.get("tx_id"), e)
+            await queue.nack(raw)
+            continue
+        await queue.ack(raw)
+
+async def settle_deposit_batch(jobs):
+    """Settle the deposit jobs in `jobs` with set-based statements
+
+    Returns `(leftovers, deferred)`: jobs it did not handle (non-deposits)
+    and `(job, delay)` pairs to park in the delayed set (backoff, busy or
+    still pending at the provider). Provider confirmations run
+    concurrently before any lock is taken.
+    """
+    ids = [payload.get("tx_id") for _, payload in jobs]
+    async with AsyncSessionLocal() as db:
+        r = await db.execute(tx_query().where(transactions.c.id.in_(ids)))
+        txs = {row._mapping['id']: row._mapping for row in r}
+    
+    leftovers, deferred, deposits = [], [], []
+    for job in jobs:
+        tx = txs.get(job[1].get("tx_id"))
+        if tx is None:
+            logger.error("Transaction not found: %s", job[1].get("tx_id"))
+        elif tx['status'] not in OPEN_STATUSES:
+            logger.info("Skipping tx=%s, already %s", tx['id'], tx['status'])
+        elif job[1].get("idempotency_key") and tx['idempotency_key'] \
+                and job[1]["idempotency_key"] != tx['idempotency_key']:
+            logger.error("Dropping payload for tx=%s: idempotency key doesn't match", tx['id'])
+        elif (job[1].get("action") or tx['type']) == "deposit":
+            deposits.append((job, tx))
+        else:
+            leftovers.append(job)
+    if not deposits:
+        return leftovers, deferred
+    
+    results = await asyncio.gather(
+        *(confirm_deposit(tx, job[1]) for job, tx in deposits), return_exceptions=True
+    )
+    confirmed = []
+    async with AsyncSessionLocal() as db:
+        for (job, tx), prov in zip(deposits, results):
+            if isinstance(prov, DEFERRABLE):
+                deferred.append((job, prov.retry_after))
+            elif isinstance(prov, ManualReview):
+                logger.warning("⚠️ tx=%s held for review: %s", tx['id'], prov)
+                await mark_review(db, tx['id'], str(prov))
+            elif isinstance(prov, ProviderError) or (not isinstance(prov, Exception) and prov["status"] == FAILED):
+                error = str(prov) if isinstance(prov, Exception) else "Deposit rejected by provider"
+                logger.error("❌ Error processing tx %s: %s", tx['id'], error)
+                await mark_failed(db, tx['id'], error)
+            elif isinstance(prov, Exception):
+                # Not a provider outcome (DB, Redis): retry, never fail for it
+                logger.error("Confirming tx=%s failed, retrying: %s", tx['id'], prov)
+                deferred.append((job, PENDING_POLL_INTERVAL))
+            elif prov["status"] == PENDING:
+                await mark_in_flight(db, tx['id'], prov["ref"])
+                deferred.append((job, PENDING_POLL_INTERVAL))
+            else:
+                confirmed.append((job, tx, prov["ref"]))
+    if not confirmed:
+        return leftovers, deferred
+    
+    try:
+        async with AsyncSessionLocal() as db:
+            settled = await apply_deposit_batch(db, [(tx, ref) for _, tx, ref in confirmed])
+    except Exception as e:
+        logger.exception("Batch commit failed, crediting %s deposit(s) one by one: %s", len(confirmed), e)
+        settled = None
+    
+    if settled is None:
+        # Per-item isolation: the provider already confirmed these, so only
+        # the crediting step is repeated, each in its own transaction
+        settled = set()
+        for job, tx, ref in confirmed:
             try:
-                await db.execute(
-                    transactions.update().where(transactions.c.id==tx['id']).values(
-                        status="failed",
-                        metadata={"error": str(e)}
-                    )
-                )
-                await db.commit()
-            except:
-                pass
+                async with AsyncSessionLocal() as db:
+                    await credit_deposit(db, tx, ref)
+            except Exception as e:
+                # Confirmed, and maybe credited in Redis: retry, never fail
+                logger.exception("❌ Error processing tx %s: %s", tx['id'], e)
+                deferred.append((job, PENDING_POLL_INTERVAL))
+                continue
+            settled.add(tx['id'])
     
-    return True
+    logger.info("✅ Batch settled %s deposit(s)", len(settled))
+    return leftovers, deferred
 
-async def run():
-    """Main worker loop"""
-    redis = await aioredis.from_url(REDIS_URL)
-    logger.info("🚀 MahavabaPay Worker started")
-    logger.info("📡 Connected to Redis: %s", REDIS_URL)
-    logger.info("🗄️  Connected to Database")
+async def apply_deposit_batch(db, settlements):
+    """Complete and credit many deposits in a single DB transaction
+
+    `settlements` is a list of (tx, external_ref). Returns the ids that
+    were actually claimed; already-closed transactions are left untouched.
+    """
+    by_id = {tx['id']: tx for tx, _ in settlements}
+    # VALUES lists with bound parameters: refs come from providers
+    settled_v = sa.values(
+        sa.column("id", sa.BigInteger),
+        sa.column("ref", sa.String),
+        name="settled"
+    ).data([(tx['id'], ref) for tx, ref in settlements])
+    res = await db.execute(
+        transactions.update().where(
+            transactions.c.id==settled_v.c.id,
+            transactions.c.status.in_(OPEN_STATUSES)
+        ).values(
+            status="completed",
+            external_ref=settled_v.c.ref,
+            updated_at=sa.text("now()")
+        ).returning(transactions.c.id, transactions.c.wallet_id, transactions.c.amount)
+    )
+    claimed = res.fetchall()
+    if not claimed:
+        await db.rollback()
+        return set()
     
-    while True:
+    if LEDGER_MODE == "redis":
+        # Credits are applied once per tx, so redoing the batch is safe;
+        # all of them go out in one pipelined round trip
+        credited = [by_id[row.id] for row in claimed]
+        results = await ledger.apply_many(
+            (tx['user_id'], tx['currency'], Decimal(tx['amount']), f"tx:{tx['id']}:credit")
+            for tx in credited
+        )
+        for tx, res in zip(credited, results):
+            if isinstance(res, BalanceNotLoaded):
+                await ledger_call(tx, "credit")
+            elif isinstance(res, Exception):
+                raise res
+        await db.commit()
+        return {row.id for row in claimed}
+    
+    credits = defaultdict(Decimal)
+    for row in claimed:
+        credits[row.wallet_id] += Decimal(row.amount)
+    
+    # Lock wallets in id order so concurrent batches can't deadlock
+    await db.execute(
+        sa.select(wallets.c.id).where(wallets.c.id.in_(list(credits)))
+        .order_by(wallets.c.id).with_for_update()
+    )
+    credits_v = sa.values(
+        sa.column("wallet_id", sa.BigInteger),
+        sa.column("delta", sa.Numeric(30, 8)),
+        name="credits"
+    ).data(sorted(credits.items()))
+    await db.execute(
+        wallets.update().where(wallets.c.id==credits_v.c.wallet_id).values(
+            balance=wallets.c.balance + credits_v.c.delta
+        )
+    )
+    await db.commit()
+    return {row.id for row in claimed}
+
+async def consume(queue, stopping):
+    """Pull and process jobs until shutdown is requested"""
+    while not stopping.is_set():
         try:
-            got = await process_one(redis)
-            if not got:
-                await asyncio.sleep(0.2)  # Reduce CPU when idle
+            if WORKER_BATCH_SIZE > 1:
+                await process_batch(queue)
+            else:
+                await process_one(queue)
         except Exception as e:
             logger.exception("Worker error: %s", e)
             await asyncio.sleep(1)
 
+async def maintain(queue):
+    """Keep this worker's heartbeat alive and reclaim jobs of dead workers"""
+    while True:
+        try:
+            await queue.heartbeat()
+            reclaimed = await queue.reap(lock_ttl=WORKER_REAP_INTERVAL)
+            if reclaimed:
+                logger.warning("♻️  Reclaimed %s job(s) from dead workers", reclaimed)
+        except Exception as e:
+            logger.exception("Queue maintenance error: %s", e)
+        await asyncio.sleep(WORKER_REAP_INTERVAL)
+
+async def promote_delayed(queue):
+    """Move due delayed jobs back onto the queue
+
+    Sleeps until the earliest due time (at most WORKER_PROMOTE_INTERVAL,
+    so jobs deferred meanwhile by other workers aren't missed) instead of
+    polling in a tight loop.
+    """
+    while True:
+        try:
+            moved = await queue.promote_due()
+            if moved:
+                logger.info("⏰ Promoted %s delayed job(s)", moved)
+                continue
+            due = await queue.next_due()
+            wait = WORKER_PROMOTE_INTERVAL if due is None else due - time.time()
+            await asyncio.sleep(min(max(wait, 0.01), WORKER_PROMOTE_INTERVAL))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Delayed job promotion error: %s", e)
+            await asyncio.sleep(WORKER_PROMOTE_INTERVAL)
+
+async def flush_ledger(flusher):
+    """Write the ledger journal behind to Postgres, batch after batch"""
+    while True:
+        try:
+            flushed = await flusher.flush_once()
+            if flushed >= flusher.batch_size:
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Ledger flush error: %s", e)
+        await asyncio.sleep(LEDGER_FLUSH_INTERVAL)
+
+async def reconcile_ledger(reconciler):
+    """Periodically repair drift between Redis balances and Postgres"""
+    while True:
+        await asyncio.sleep(LEDGER_RECONCILE_INTERVAL)
+        try:
+            drifted = await reconciler.run_once()
+            if drifted:
+                logger.warning("⚖️  Reconciled %s drifted balance(s)", drifted)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Ledger reconciliation error: %s", e)
+
+async def refresh_rollups(rollups):
+    """Keep the daily transaction rollups current"""
+    while True:
+        try:
+            days = await rollups.refresh_once()
+            if days:
+                logger.debug("Rebuilt %s day(s) of transaction rollups", days)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Rollup refresh error: %s", e)
+        await asyncio.sleep(ROLLUP_INTERVAL)
+
+async def run():
+    """Main worker loop: WORKER_CONCURRENCY consumers share one event loop"""
+    redis = await aioredis.from_url(REDIS_URL)
+    queue = ReliableQueue(redis, QUEUE_KEY, heartbeat_ttl=WORKER_HEARTBEAT_TTL)
+    await queue.heartbeat()
+    logger.info("🚀 MahavabaPay Worker %s started (concurrency=%s)",
+                queue.worker_id, WORKER_CONCURRENCY)
+    logger.info("📡 Connected to Redis: %s", REDIS_URL)
+    logger.info("🗄️  Connected to Database")
+    
+    # SIGTERM/SIGINT stop new pickups; in-flight jobs are allowed to finish
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+    
+    start_http_server(METRICS_PORT)
+    
+    # Keeps heartbeating through the drain so in-flight jobs aren't reaped
+    maintainer = asyncio.create_task(maintain(queue))
+    promoter = asyncio.create_task(promote_delayed(queue))
+    background = [maintainer, promoter]
+    background.append(asyncio.create_task(
+        refresh_rollups(DailyRollups(engine, lookback_days=ROLLUP_LOOKBACK_DAYS))
+    ))
+    if LEDGER_MODE == "redis":
+        global ledger
+        ledger = AtomicLedger(redis)
+        await ledger.load()
+        background.append(asyncio.create_task(
+            flush_ledger(JournalFlusher(redis, engine, batch_size=LEDGER_FLUSH_BATCH))
+        ))
+        background.append(asyncio.create_task(reconcile_ledger(Reconciler(redis, engine))))
+        logger.info("📒 Balances served from the Redis ledger (write-behind)")
+    consumers = [
+        asyncio.create_task(consume(queue, stopping))
+        for _ in range(WORKER_CONCURRENCY)
+    ]
+    await stopping.wait()
+    
+    logger.info("🛑 Shutdown requested, draining in-flight jobs...")
+    done, pending = await asyncio.wait(consumers, timeout=WORKER_DRAIN_TIMEOUT)
+    if pending:
+        logger.warning("Drain timed out, cancelling %s consumer(s)", len(pending))
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    
+    # Anything still unacked goes straight back instead of waiting for a reaper
+    returned = await queue.release()
+    if returned:
+        logger.warning("Returned %s unfinished job(s) to the queue", returned)
+    
+    await registry.aclose()
+    await redis.close()
+    await engine.dispose()
+    logger.info("👋 Worker stopped")
+
 if __name__ == "__main__":
     asyncio.run(run())